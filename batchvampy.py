@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+"""Batch analysis of micropipette aspiration experiments without GUI.
+
+Every folder must contain images and vampy.cfg with image settings
+as saved from the VAMPy GUI (Save Image Info). Pressures are taken from
+image file names if 'fromnames' is set there, otherwise from the pressure
+protocol file given with -P. Geometry and tensions are saved to each folder
+(or to --outdir) as images.dat and tensions.dat, like the GUI does.
+With --population, fitted parameters of all folders are also saved to one table.
+
+usage: python batchvampy.py [-w 4] [-e png] [-P pressures.txt] folder [folder ...]
+"""
+import argparse, os, sys
+
+from calc import batch, features, resample, smooth
+from calc.analysis import TENSMODELS
+from calc.common import STACKFORMATS, DEFAULT_SCALE, DEFAULT_PRESSACC
+from calc.fitting import TENSFITMODELS, TENSNLSFITS
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('folders', nargs='+', help='experiment folders')
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help='processes used, all CPUs by default; folders are processed '
+                             'at once, a single folder locates features on all of them')
+    parser.add_argument('-e', '--ext', default='png',
+                        choices=['png', 'tif'] + sorted(STACKFORMATS),
+                        help='image file type')
+    parser.add_argument('--no-cache', dest='cache', action='store_false',
+                        help='do not keep decoded images in the folder')
+    parser.add_argument('--stream', action='store_true',
+                        help='read image files one by one as they are analysed')
+    parser.add_argument('--roi', action='store_true',
+                        help='read only the band of images around the pipette axis')
+    parser.add_argument('-P', '--pressfile', default=None,
+                        help='pressure protocol file name in every folder')
+    parser.add_argument('-s', '--stage', type=int, default=1, choices=(1, 2),
+                        help='pressure stage used')
+    parser.add_argument('--scale', type=float, default=DEFAULT_SCALE,
+                        help='micrometer per pixel')
+    parser.add_argument('--pressacc', type=float, default=DEFAULT_PRESSACC,
+                        help='pressure accuracy, Pa')
+    parser.add_argument('--smoothing', default='Savitzky-Golay',
+                        choices=sorted(smooth.SMOOTHFILTERS))
+    parser.add_argument('--order', type=float, default=2.)
+    parser.add_argument('--window', type=float, default=11.)
+    parser.add_argument('--mismatch', type=float, default=3.)
+    parser.add_argument('--subpix', action='store_true')
+    parser.add_argument('--subpix-method', default='parabolic', dest='subpixmethod',
+                        choices=features.SUBPIXMETHODS)
+    parser.add_argument('--subpix-fit', action='store_true', dest='subpixfit',
+                        help='fit features where subpixel estimate is beyond mismatch')
+    parser.add_argument('--track', action='store_true',
+                        help='search features near their positions on the previous image')
+    parser.add_argument('-t', '--tension', default='Evans', choices=sorted(TENSMODELS),
+                        help='tension model')
+    parser.add_argument('-f', '--fitmodel', default='Bend Evans',
+                        choices=sorted(TENSFITMODELS), help='tension fit model')
+    parser.add_argument('-r', '--range', type=int, nargs=2, default=None,
+                        dest='fitrange', metavar=('LOW', 'HIGH'),
+                        help='pressures fitted, from 1 to their number')
+    parser.add_argument('--resample', default=None, choices=resample.RESAMPLING,
+                        help='confidence intervals of fitted parameters by resampling')
+    parser.add_argument('--samples', type=int, default=2000,
+                        help='number of resampled data sets')
+    parser.add_argument('--linearised', dest='exact', action='store_false',
+                        help='refit resampled data by linear forms of models '
+                             'instead of ODR, faster but without errors of tension')
+    parser.add_argument('--population', default=None, metavar='FILE',
+                        help='save fits of all folders to one table')
+    parser.add_argument('--population-model', default=None, dest='popmodel',
+                        choices=sorted(TENSFITMODELS) + sorted(TENSNLSFITS),
+                        help='tension fit model of population table, --fitmodel by default')
+    parser.add_argument('-o', '--outdir', default=None,
+                        help='save results here instead of experiment folders')
+    options = parser.parse_args()
+
+    settings = vars(options).copy()
+    del settings['folders'], settings['population']
+    settings['stage'] = options.stage - 1
+    folders = map(os.path.abspath, options.folders)
+    failed = 0
+    done = []
+    for folder, results, mesg in batch.process_folders(folders, settings, options.workers):
+        if mesg:
+            failed += 1
+            print '%s\tERROR: %s'%(folder, mesg)
+            continue
+        line = folder
+        for i, (key, (value, error)) in enumerate(results['fitted']):
+            paramname, texparamname, paramdim, texparamdim = key
+            line += '\t%s = %f +- %f %s'%(paramname, value, error, paramdim)
+            report = results['uncertainty']
+            if report:
+                line += ' [%f .. %f %s]'%(tuple(report['interval'][i]) +
+                                          (batch.resampling_label(report),))
+        print line
+        done.append((folder, results))
+    if failed:
+        print '%i of %i folders failed'%(failed, len(folders))
+    if options.population and done:
+        report, mesg = batch.fit_folders([results for folder, results in done],
+                                         settings, options.workers)
+        if not mesg:
+            mesg = batch.save_population(options.population,
+                                         [folder for folder, results in done], report)
+        if mesg:
+            print 'Population fit ERROR: %s'%mesg
+            return 1
+        print 'population fit: %s model, %s, %i of %i failed'%(report['model'],
+                report['method'], report['failed'].sum(), len(report['failed']))
+        for i, (paramname, texparamname, paramdim, texparamdim) in enumerate(report['params']):
+            print 'population %s = %f +- %f %s (median %f)'%(paramname,
+                    report['mean'][i], report['sd'][i], paramdim, report['median'][i])
+    return failed and 1 or 0
+
+if __name__ == '__main__':
+    sys.exit(main())
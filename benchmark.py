@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+"""Benchmarks of the VAMPy calc pipeline on synthetic aspiration images.
+
+Every stage (features.locate and its per-frame reference locate_serial,
+analysis.get_geometry, tension models, fitting of tension models)
+is timed on stacks of different sizes, each run in a fresh process.
+Throughput (frames/s), peak memory and accuracy of located features
+against the ground truth are reported and saved as JSON,
+so that runs before and after a change can be compared.
+
+usage: python benchmark.py [-s 10 100 1000 10000] [-m phc] [-o benchmark.json]
+"""
+import argparse, json, multiprocessing, platform, sys, time
+try:
+    import resource
+except ImportError:
+    resource = None  # peak memory is not reported then (e.g. on Windows)
+
+import numpy as np
+import scipy
+
+from calc import analysis, features, fitting, synthetic
+from calc.common import DEFAULT_PRESSACC, DEFAULT_SCALE
+
+STAGES = ('locate', 'locate_serial', 'geometry', 'tension', 'fit')
+LOCATORS = {'locate':features.locate, 'locate_serial':features.locate_serial}
+
+def peak_memory():
+    '''peak resident memory of this process in MB'''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak / 2.0**20  # in bytes on Mac OS X
+    return peak / 1024.0  # in kilobytes elsewhere
+
+def timed(func, args, repeat):
+    '''best time of several calls of func, and the result of the last one'''
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        result = func(*args)
+        seconds = time.time() - start
+        if best is None or seconds < best:
+            best = seconds
+    return best, result
+
+def accuracy(out, truth):
+    '''errors of located features vs ground truth, in pixels'''
+    report = {}
+    for key, truekey in (('pips', 'pips'), ('asps', 'asps'),
+                         ('vess', 'vess'), ('piprads', 'piprad')):
+        error = out[key][0] - truth[truekey]
+        report[key] = {'mean_abs':float(np.fabs(error).mean()),
+                       'max_abs':float(np.fabs(error).max()),
+                       'bias':float(error.mean())}
+    return report
+
+def run_stage(stage, N, options):
+    '''run the stage on N frames, returns list of results'''
+    truth = synthetic.aspiration_truth(N, shape=tuple(options.shape))
+    results = []
+    if stage in LOCATORS:
+        params = synthetic.aspiration_params(truth, options.mode, options.polar)
+        params['images'] = synthetic.aspiration_images(truth, options.mode,
+                                                       options.polar, options.noise)
+        params['workers'] = options.workers
+        startmem = peak_memory()
+        seconds, (out, extra_out) = timed(LOCATORS[stage], (params,), options.repeat)
+        result = {'accuracy':accuracy(out, truth)}
+        results.append((stage, seconds, startmem, result))
+    else:
+        geometry, mesg = analysis.get_geometry(synthetic.aspiration_features(truth))
+        pressures = synthetic.aspiration_pressures(N)
+        tensargs = (pressures, DEFAULT_PRESSACC, DEFAULT_SCALE, geometry)
+        startmem = peak_memory()
+        if stage == 'geometry':
+            seconds, (geometry, mesg) = timed(analysis.get_geometry,
+                            (synthetic.aspiration_features(truth),), options.repeat)
+            results.append((stage, seconds, startmem, {'error':mesg}))
+        elif stage == 'tension':
+            for name, model in sorted(analysis.TENSMODELS.items()):
+                seconds, tensions = timed(model, tensargs, options.repeat)
+                results.append(('%s:%s'%(stage, name), seconds, startmem, {}))
+        elif stage == 'fit':
+            tensions = analysis.TENSMODELS['Evans'](*tensargs)
+            # skip zero tension, it is out of domain for log models
+            tension = tensions['tension'][:,1:]
+            dilation = tensions['dilation'][:,1:]
+            for name, model in sorted(fitting.TENSFITMODELS.items()):
+                fitmodel = analysis.TensionFitModel(tension, dilation, model,
+                                                    tensions['tensdim'])
+                seconds, report = timed(fitmodel.fit, (), options.repeat)
+                fitted = {'fit':map(float, report['fit']),
+                          'sd_fit':map(float, report['sd_fit'])}
+                results.append(('%s:%s'%(stage, name), seconds, startmem, fitted))
+
+    endmem = peak_memory()
+    reports = []
+    for name, seconds, startmem, result in results:
+        result.update({'stage':name, 'frames':N, 'seconds':seconds,
+                       'fps':N / seconds if seconds > 0 else None,
+                       'peak_mb':endmem,
+                       'extra_peak_mb':endmem - startmem if endmem else None})
+        reports.append(result)
+    return reports
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-s', '--sizes', type=int, nargs='+',
+                        default=[10, 100, 1000, 10000], help='numbers of frames')
+    parser.add_argument('-t', '--stages', nargs='+', default=list(STAGES),
+                        choices=STAGES, help='stages to benchmark')
+    parser.add_argument('-m', '--mode', default='phc', choices=('phc', 'dic'))
+    parser.add_argument('-p', '--polar', default='left', choices=('left', 'right'))
+    parser.add_argument('--shape', type=int, nargs=2, default=[128, 256],
+                        help='height and width of images')
+    parser.add_argument('--noise', type=float, default=2.0, help='noise level')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='best of that many runs is reported')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='worker processes for locate')
+    parser.add_argument('--serial-max', type=int, default=1000,
+                        help='largest stack for locate_serial')
+    parser.add_argument('-o', '--output', default='benchmark.json',
+                        help='JSON file to save results to')
+    options = parser.parse_args()
+
+    meta = {'date':time.strftime('%Y-%m-%d %H:%M:%S'),
+            'platform':platform.platform(),
+            'python':platform.python_version(),
+            'numpy':np.__version__, 'scipy':scipy.__version__,
+            'options':vars(options)}
+    results = []
+    print '%-28s %8s %10s %12s %10s'%('stage', 'frames', 'seconds', 'frames/s', 'peak MB')
+    for N in options.sizes:
+        for stage in options.stages:
+            if stage == 'locate_serial' and N > options.serial_max:
+                continue
+            # fresh process for every run, so that peak memory is its own
+            pool = multiprocessing.Pool(1)
+            try:
+                reports = pool.apply(run_stage, (stage, N, options))
+            finally:
+                pool.close()
+                pool.join()
+            for report in reports:
+                print '%-28s %8i %10.4f %12.1f %10s'%(report['stage'], N,
+                        report['seconds'], report['fps'] or 0, report['peak_mb'])
+            results.extend(reports)
+
+    outfile = open(options.output, 'w')
+    json.dump({'meta':meta, 'results':results}, outfile, indent=1, sort_keys=True)
+    outfile.close()
+    print 'Results saved to %s'%options.output
+
+if __name__ == '__main__':
+    main()
@@ -3,5 +3,5 @@
 
 """
 
-import analysis, common, features, fitting, load, output, smooth, contour
+import analysis, common, features, fitting, load, output, smooth, contour, synthetic, cache, resample, population, pipeline, batch
 
@@ -29,71 +29,114 @@ def averageImages(aver, **kwargs):
                 kwargs[key] = np.asarray((averval, avererr))
     return kwargs
 
-def get_geometry(argsdict):
-    '''Calculate geometry of the system based on extracted features'''
+def pad_features(featurelist):
+    '''Features of many vesicles as one dictionary for get_geometry_batch
+
+    @param featurelist: list of features dictionaries as returned by features.locate,
+                        vesicles may have different numbers of frames
+    returns dictionary of 2 x vesicles x frames arrays,
+    frames missing in shorter series are filled with NaN
+    '''
+    frames = max([len(features['pips'][0]) for features in featurelist])
+    keys = ['metrics', 'piprads', 'pips', 'asps', 'vess']
+    if all(['vesrads' in features for features in featurelist]):
+        keys.append('vesrads')
+    padded = {}
+    for key in keys:
+        values = np.empty((2, len(featurelist), frames))
+        values.fill(np.nan)
+        for i, features in enumerate(featurelist):
+            value = np.asarray(features[key])
+            values[:, i, :value.shape[-1]] = value
+        padded[key] = values
+    return padded
+
+def get_geometry_batch(argsdict):
+    '''Calculate geometry of many vesicles at once
+
+    @param argsdict: features as returned by features.locate, but every array
+                     is 2 x vesicles x frames (see pad_features), NaN for missing frames,
+                     optionally 'vesrads' - radii of circles fitted to whole outlines
+                     of vesicles (see contour.vesicle_radii), used instead of the radius
+                     of the outer cap calculated from its length and pipette radius
+    returns dictionary as get_geometry, with 2 x vesicles x frames arrays
+    (piprad is 2 x vesicles), and 'valid' vesicles x frames boolean mask
+    of frames with consistent features; geometry of other frames is NaN
+    '''
     metrics, metrics_err = argsdict['metrics']
     piprads, piprads_err = argsdict['piprads']
     pips, pips_err = argsdict['pips']
     asps, asps_err = argsdict['asps']
     vess, vess_err = argsdict['vess']
 
-    # since piprad is tilt-corrected already, no scaling with metric is needed
-    piprad = piprads.mean()
-    piprad_err = sqrt(square(piprads_err).sum())/len(piprads_err)
-
-    aspl = (pips - asps) * metrics
-    aspl_err = sqrt((pips_err**2 + asps_err**2) * metrics**2 + (pips - asps)**2 * metrics_err**2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # since piprad is tilt-corrected already, no scaling with metric is needed
+        # one pipette radius per vesicle, averaged over its frames
+        known = np.isfinite(piprads)
+        count = known.sum(axis=-1)
+        piprad = np.where(known, piprads, 0).sum(axis=-1)/count
+        piprad_err = sqrt(np.where(known, square(piprads_err), 0).sum(axis=-1))/count
+        # broadcast over frames of each vesicle
+        piprad = piprad[..., np.newaxis]
+        piprad_err = piprad_err[..., np.newaxis]
+
+        aspl = (pips - asps) * metrics
+        aspl_err = sqrt((pips_err**2 + asps_err**2) * metrics**2 + (pips - asps)**2 * metrics_err**2)
+
+        vesl = (vess - pips) * metrics
+        vesl_err = sqrt((pips_err**2 + vess_err**2) * metrics**2 + (vess-pips)**2 * metrics_err**2)
+
+        ### outer vesicle radius
+        if 'vesrads' in argsdict:
+            vesrad, vesrad_err = argsdict['vesrads']
+        else:
+            vesrad = 0.5 * (vesl**2 + piprad**2) / vesl
+            term = piprad**2 / (vesl**2)
+            vesrad_err = sqrt(term * piprad_err**2 + (1+term)**2 * vesl_err**2 * 0.25)
+
+        ### total vesicle surface and area
+        ### outer part
+        area = pi*(vesl**2 + piprad**2)
+        area_err = 2*pi * sqrt(vesl**2 * vesl_err**2 + piprad**2 * piprad_err**2)
+        volume = (3*piprad**2 + vesl**2) * vesl * pi/6.0
+        volume_err = 0.5*pi * sqrt(4 * piprad**2 * vesl**2 * piprad_err**2 +
+                                    vesl_err**2 * (piprad**2 + vesl**2)**2)
+
+        ### plus aspirated part depending on the length of aspirated part
+        cond1 = (piprad <= aspl)
+        cond2 = (aspl < piprad) & (aspl >= 2*vesrad - vesl)
+        # XOR, frames where they are not complimentary (including NaN) are invalid
+        valid = cond1 ^ cond2
+
+        area += np.where(cond1, 2 * pi * piprad * aspl, 0)
+        area += np.where(cond2, pi * (piprad**2 + aspl**2), 0)
+
+        area_err += np.where(cond1, 2*pi * sqrt(aspl**2 * piprad_err**2 +
+                                                piprad**2 * aspl_err**2), 0)
+        area_err += np.where(cond2, 2*pi * sqrt(aspl**2 * aspl_err**2 +
+                                                piprad**2 * piprad_err**2), 0)
+
+        volume += np.where(cond1, pi * piprad**2 * (aspl - piprad/3.0), 0)
+        volume += np.where(cond2, (3*piprad**2 + aspl**2) * aspl * pi/6.0, 0)
+
+        volume_err += np.where(cond1, pi * piprad * sqrt(
+                                    piprad**2 * aspl_err**2 +
+                                    piprad_err**2 * (2*aspl-piprad)**2), 0)
+        volume_err += np.where(cond2, 0.5*pi * sqrt(
+                                    4 * piprad**2 * aspl**2 * piprad_err**2 +
+                                    aspl_err**2 * (piprad**2 + aspl**2)**2), 0)
 
-    vesl = (vess - pips) * metrics
-    vesl_err = sqrt((pips_err**2 + vess_err**2) * metrics**2 + (vess-pips)**2 * metrics_err**2)
-    
-    ### outer vesicle radius
-    vesrad = 0.5 * (vesl**2 + piprad**2) / vesl
-    term = piprad**2 / (vesl**2)
-    vesrad_err = sqrt(term * piprad_err**2 + (1+term)**2 * vesl_err**2 * 0.25)
-
-    ### total vesicle surface and area
-    ### outer part
-    area = pi*(vesl**2 + piprad**2)
-    area_err = 2*pi * sqrt(vesl**2 * vesl_err**2 + piprad**2 * piprad_err**2)
-    volume = (3*piprad**2 + vesl**2) * vesl * pi/6.0
-    volume_err = 0.5*pi * sqrt(4 * piprad**2 * vesl**2 * piprad_err**2 +
-                                vesl_err**2 * (piprad**2 + vesl**2)**2)
-
-    ### plus aspirated part depending on the length of aspirated part
-    cond1 = (piprad <= aspl)
-    cond2 = (aspl < piprad) & (aspl >= 2*vesrad - vesl)
-    if not np.all(cond1^cond2): # XOR, checking that they are complimentary
-        mesg = "Error with detected features in aspirated part\n"
-        mesg += "Detected aspirated tip is closer\
-                to the pipette mouth than possible\n"
-        mesg += "Exiting..."
-        return None, mesg
-    area[cond1] += (2 * pi * piprad * aspl)[cond1]
-    area[cond2] += (pi * (piprad**2 + aspl**2))[cond2]
-
-    area_err[cond1] += (2*pi * sqrt(aspl**2 * piprad_err**2 +
-                                    piprad**2 * aspl_err**2))[cond1]
-    area_err[cond2] += (2*pi * sqrt(aspl**2 * aspl_err**2 +
-                                    piprad**2 * piprad_err**2))[cond2]
-
-    volume[cond1] += (pi * piprad**2 * (aspl - piprad/3.0))[cond1]
-    volume[cond2] += ((3*piprad**2 + aspl**2) * aspl * pi/6.0)[cond2]
-
-    volume_err[cond1] += (pi * piprad * sqrt(
-                                piprad**2 * aspl_err**2 +
-                                piprad_err**2 * (2*aspl-piprad)**2))[cond1]
-    volume_err[cond2] += (0.5*pi * sqrt(
-                                4 * piprad**2 * aspl**2 * piprad_err**2 +
-                                aspl_err**2 * (piprad**2 + aspl**2)**2))[cond2]
     results = {}
     results['aspl'] = np.asarray((aspl,aspl_err))
     results['vesl'] = np.asarray((vesl,vesl_err))
     results['vesrad'] = np.asarray((vesrad,vesrad_err))
     results['area'] = np.asarray((area,area_err))
     results['volume'] = np.asarray((volume,volume_err))
-    results['piprad'] = np.asarray((piprad,piprad_err))
+    for key in ('aspl', 'vesl', 'vesrad', 'area', 'volume'):
+        results[key][:, ~valid] = np.nan
+    results['piprad'] = np.asarray((piprad[..., 0], piprad_err[..., 0]))
     results['metrics'] = argsdict['metrics']
+    results['valid'] = valid
     
     #problems with error calculations on perfectly horizontal lines, i.e metrics=1
 #    ax_angle = np.arccos(1/metrics)
@@ -102,6 +145,25 @@ def get_geometry(argsdict):
     
     return results, None
 
+def get_geometry(argsdict):
+    '''Calculate geometry of the system based on extracted features'''
+    batchargs = {}
+    for key in ('metrics', 'piprads', 'pips', 'asps', 'vess', 'vesrads'):
+        if key in argsdict:
+            batchargs[key] = np.asarray(argsdict[key])[:, np.newaxis]
+    batch, mesg = get_geometry_batch(batchargs)
+    if not batch['valid'].all():
+        mesg = "Error with detected features in aspirated part\n"
+        mesg += "Detected aspirated tip is closer\
+                to the pipette mouth than possible\n"
+        mesg += "Exiting..."
+        return None, mesg
+    results = {}
+    for key in ('aspl', 'vesl', 'vesrad', 'area', 'volume', 'piprad'):
+        results[key] = batch[key][:, 0]
+    results['metrics'] = argsdict['metrics']
+    return results, None
+
 GEOMDATAKEYS = ('aspl','vesl','vesrad','area','volume','piprad','metrics')
 
 class TensionFitModel(object):
@@ -128,8 +190,14 @@ class TensionFitModel(object):
     def fit(self):
         data = odr.RealData(self.x, self.y, sx=self.x_err, sy=self.y_err)
         fitter = odr.ODR(data, self.model)
+        if self.model.fjacb is not None and self.model.fjacd is not None:
+            # ODRPACK uses finite differences unless told otherwise,
+            # analytic Jacobians are checked by fitting.check_jacobians in tests
+            fitter.set_job(deriv=3)
         out = fitter.run()
-        report = self.model.meta
+        # a copy, so that reports of different fits do not share the same dict
+        report = dict(self.model.meta)
+        report['params'] = list(report['params'])
         report['fit'] = out.beta
         report['sd_fit'] = out.sd_beta
         return report
@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+'''Part of VAMP project, only for import.
+
+Non-interactive analysis of experiment folders, as done in the GUI
+by opening the folder and pressing Analyse, but with all choices
+taken from the folder's configuration file and a settings dictionary,
+so that many folders can be processed on a machine without display.
+
+prerequisites - installed numpy, scipy
+'''
+import glob, multiprocessing, os
+
+from cache import ResultCache, files_digest, stage_key
+from common import SIDES, CFG_FILENAME, STACKFORMATS, DEFAULT_SCALE, DEFAULT_PRESSACC
+from common import split_to_int
+from output import DataWriter
+from pipeline import AnalysisPipeline
+from population import fit_population, population_data
+import load
+
+GEOMETRY_FILENAME = 'images.dat'
+TENSIONS_FILENAME = 'tensions.dat'
+
+# parameters of the analysis which are not stored in configuration file,
+# defaults are the same as in the GUI
+DEFAULT_SETTINGS = {'ext':'png', 'cache':True, 'roi':False, 'stream':False, 'pressfile':None,
+                    'stage':0, 'scale':DEFAULT_SCALE, 'pressacc':DEFAULT_PRESSACC,
+                    'smoothing':'Savitzky-Golay', 'order':2., 'window':11.,
+                    'mismatch':3., 'subpix':False, 'subpixmethod':'parabolic',
+                    'subpixfit':False, 'track':False, 'extra':False,
+                    'tension':'Evans', 'fitmodel':'Bend Evans', 'fitrange':None,
+                    'resample':None, 'samples':2000, 'exact':True,
+                    'popmodel':None, 'outdir':None,
+                    'workers':1}
+
+def folder_images(folder, ext):
+    '''sorted image files in the folder for ext (png, tif or one of STACKFORMATS)'''
+    fileext = STACKFORMATS.get(ext, ext)
+    filenames = sorted(glob.glob(os.path.join(folder, '*.'+fileext)))
+    if ext in STACKFORMATS:
+        # stacks are the only files of their type in experiment folders
+        filenames = filenames[:1]
+    return filenames
+
+def folder_params(imgcfg):
+    '''image parameters for features.locate from configuration file as saved by GUI
+
+    returns dictionary of parameters and error message if any
+    '''
+    params = {}
+    params['orient'] = imgcfg.get('orient', SIDES[0])
+    params['mode'] = imgcfg.get('mode', 'phc')
+    params['polar'] = imgcfg.get('polar', 'left')
+    params['crop'] = dict([(side, int(imgcfg.get(side, 0))) for side in SIDES])
+    for key in ('fromnames', 'darktip'):
+        params[key] = bool(int(imgcfg.get(key, 0)))
+    for key in ('aspves', 'tip', 'axis', 'pipette'):
+        value, mesg = split_to_int(imgcfg.get(key, ''), (0, 0))
+        if mesg or key not in imgcfg:
+            return None, 'Wrong or missing %s in %s'%(key, CFG_FILENAME)
+        params[key] = value
+    return params, None
+
+def folder_pressures(folder, filenames, imgsNo, settings):
+    '''pressures and number of images per pressure, as in VampyFrame.GetExtraUserData'''
+    if settings['fromnames']:
+        return load.read_pressures_filenames(filenames, settings['stage'])
+    if not settings['pressfile']:
+        return None, None, 'No pressure protocol file given'
+    pressfilename = os.path.join(folder, settings['pressfile'])
+    pressures, mesg = load.read_pressures_file(pressfilename, settings['stage'])
+    if mesg:
+        return None, None, mesg
+    if imgsNo % len(pressures) != 0:
+        return None, None, 'Number of images is not multiple of number of pressures!'
+    return pressures, imgsNo/len(pressures), None
+
+def analyse_folder(folder, settings=None):
+    '''Analyse images in the experiment folder
+
+    Goes through the same steps as the GUI: locate features, get geometry,
+    average images per pressure, calculate tensions and fit the tension model.
+    With 'roi' setting, only the region of images around the pipette axis
+    is read (see load.roi_region). With 'stream' setting, image files are
+    read one by one as features are located (see features.locate_stream)
+    and are neither kept in memory nor cached, stacks are always memory-mapped.
+    @param folder: folder with images and configuration file
+    @param settings: dictionary updating DEFAULT_SETTINGS
+    returns dictionary of results and error message if any
+    '''
+    opts = dict(DEFAULT_SETTINGS)
+    opts.update(settings or {})
+    imgcfg = load.read_conf_file(os.path.join(folder, CFG_FILENAME))
+    if not imgcfg:
+        return None, 'No %s found'%CFG_FILENAME
+    params, mesg = folder_params(imgcfg)
+    if mesg:
+        return None, mesg
+    opts['fromnames'] = params['fromnames']
+
+    filenames = folder_images(folder, opts['ext'])
+    if len(filenames) == 0:
+        return None, 'No %s files found'%opts['ext']
+    rawshape = None
+    if opts['ext'] in STACKFORMATS:
+        rawshape, mesg = split_to_int(imgcfg.get('rawshape', ''))
+        rawheader = int(imgcfg.get('rawheader', 0))
+    region = None
+    if opts['roi']:
+        shape, mesg = load.frame_shape(filenames[0], rawshape)
+        if mesg:
+            return None, mesg
+        region, rows = load.roi_region(shape, params)
+        params = load.roi_params(params, rows)
+    images = frames = None
+    if opts['ext'] in STACKFORMATS:
+        images, mesg = load.read_stack_file(filenames[0], rawshape, rawheader, region)
+        imagekey = stage_key('images', files_digest(filenames),
+                             {'rawshape':rawshape, 'rawheader':rawheader})
+    elif opts['stream']:
+        frames = lambda: load.iter_grey_images(filenames, params['orient'],
+                                               params['crop'], region)
+        imagekey, mesg = files_digest(filenames), None
+    else:
+        images, mesg = load.read_image_stack(filenames, opts['cache'] and folder or None,
+                                             region=region)
+        imagekey = files_digest(filenames)
+    if mesg:
+        return None, mesg
+    if region is not None:
+        imagekey = stage_key('images', imagekey, {'region':region})
+    if images is not None:
+        images = load.preproc_images(images, params['orient'], params['crop'])
+        imgsNo = len(images)
+    else:
+        imgsNo = len(filenames)
+
+    pressures, aver, mesg = folder_pressures(folder, filenames, imgsNo, opts)
+    if mesg:
+        return None, mesg
+
+    pipeline = AnalysisPipeline(ResultCache(opts['cache'] and folder or None))
+    for key in ('smoothing', 'order', 'window', 'mismatch', 'subpix',
+                'subpixmethod', 'subpixfit', 'track', 'extra'):
+        params[key] = opts[key]
+    pipeline.set(images=images, frames=frames,
+                 imagekey=imagekey, locate=params, aver=aver,
+                 tensmodel=opts['tension'], pressures=pressures,
+                 pressacc=opts['pressacc'], scale=opts['scale'],
+                 fitmodel=opts['fitmodel'], fitrange=opts['fitrange'],
+                 resample=opts['resample'], samples=opts['samples'],
+                 exact=opts['exact'], workers=opts['workers'])
+    result, mesg = pipeline.get('fit')
+    if mesg:
+        return None, mesg
+    fittedparams = zip(result['params'], zip(result['fit'], result['sd_fit']))
+    results = {'geometry':pipeline.get('averaged')[0], 'tensions':pipeline.get('tensions')[0],
+               'fitted':fittedparams, 'uncertainty':None}
+    if opts['resample']:
+        results['uncertainty'], mesg = pipeline.get('uncertainty')
+        if mesg:
+            return None, mesg
+    return results, None
+
+def save_results(folder, results, settings=None):
+    '''Write geometry and tensions files the same way as the GUI does
+
+    returns error message if any
+    '''
+    opts = dict(DEFAULT_SETTINGS)
+    opts.update(settings or {})
+    if opts['outdir']:
+        # results of many folders in one place are told apart by folder name
+        prefix = os.path.join(opts['outdir'], os.path.basename(folder)+'-')
+    else:
+        prefix = os.path.join(folder, '')
+    writer = DataWriter(results['geometry'], title='Vesicle geometry')
+    mesg = writer.write_file(prefix+GEOMETRY_FILENAME)
+    if mesg:
+        return mesg
+    header = 'Vesicle tensions, %s model\n'%opts['tension']
+    for key, (value, error) in results['fitted']:
+        paramname, texparamname, paramdim, texparamdim = key
+        header += '#%s = %f +- %f %s\n'%(paramname, value, error, paramdim)
+    report = results['uncertainty']
+    if report:
+        for i, (paramname, texparamname, paramdim, texparamdim) in enumerate(report['params']):
+            header += '#%s %g%% interval (%s, %i samples) = %f .. %f %s\n'%(
+                            paramname, report['level']*100, resampling_label(report),
+                            report['size'], report['interval'][i][0],
+                            report['interval'][i][1], paramdim)
+    header +='#'
+    writer = DataWriter(results['tensions'], title=header)
+    return writer.write_file(prefix+TENSIONS_FILENAME)
+
+def resampling_label(report):
+    '''resampling method of uncertainty report, marked if samples were refitted
+    by linear forms of models and not by ODR like the fit itself'''
+    if report['exact']:
+        return report['method']
+    return report['method'] + ' linearised'
+
+def process_folder(task):
+    '''analyse folder and save results, task is a (folder, settings) tuple
+
+    returns folder, results (see analyse_folder) and error message if any
+    '''
+    folder, settings = task
+    try:
+        results, mesg = analyse_folder(folder, settings)
+        if not mesg:
+            mesg = save_results(folder, results, settings)
+    except Exception, value:
+        # one bad folder should not stop the whole batch
+        return folder, None, '%s: %s'%(type(value).__name__, value)
+    if mesg:
+        return folder, None, str(mesg)
+    return folder, results, None
+
+def process_folders(folders, settings=None, workers=None):
+    '''Process experiment folders concurrently on a pool of processes
+
+    A single folder gets all processes for locating features in it instead,
+    processes of the pool locate features on their own.
+    @param workers: number of processes, all CPUs by default
+    yields (folder, results, error message) as folders are done,
+    in the order they were given
+    '''
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if workers == 1 or len(folders) < 2:
+        settings = dict(settings or {}, workers=workers)
+        for folder in folders:
+            yield process_folder((folder, settings))
+        return
+    # processes of the pool can not start pools of their own
+    tasks = [(folder, dict(settings or {}, workers=1)) for folder in folders]
+    pool = multiprocessing.Pool(workers)
+    try:
+        for result in pool.imap(process_folder, tasks):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+def fit_folders(resultslist, settings=None, workers=None):
+    '''Fit tension model to results of many folders at once
+
+    The model is 'popmodel' of settings, or 'fitmodel' if it is not given,
+    fitted in 'fitrange' of every folder (see population.fit_population)
+    returns report dictionary and error message if any
+    '''
+    opts = dict(DEFAULT_SETTINGS)
+    opts.update(settings or {})
+    low, high = opts['fitrange'] or (1, None)
+    tension = [results['tensions']['tension'][:,low-1:high] for results in resultslist]
+    dilation = [results['tensions']['dilation'][:,low-1:high] for results in resultslist]
+    return fit_population(tension, dilation, opts['popmodel'] or opts['fitmodel'],
+                          resultslist[0]['tensions']['tensdim'], workers=workers)
+
+def save_population(filename, folders, report):
+    '''Write fitted parameters of every folder, numbered in the order of folders
+
+    returns error message if any
+    '''
+    header = 'Population fit, %s model, %s\n'%(report['model'], report['method'])
+    for i, folder in enumerate(folders):
+        header += '#%i: %s\n'%(i+1, folder)
+    header += '#'
+    writer = DataWriter(population_data(report), title=header)
+    return writer.write_file(filename)
+
+if __name__ == '__main__':
+    # this is executed only if this source file is run separately
+    # and not imported as module to another source file.
+    print __doc__
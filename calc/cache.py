@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+'''Part of VAMP project, only for import.
+
+On-disk cache of analysis results of an experiment folder.
+
+Results of every stage (features, geometry, tensions, fit) are stored
+in the folder under a key which is a hash of everything they depend on:
+identity of image files (names, modification times and sizes),
+parameters of the stage, key of the stage they were calculated from
+and the version of the calc code. Unchanged stages are then just loaded,
+and a changed parameter invalidates only the stages downstream of it.
+
+prerequisites - installed numpy
+'''
+import cPickle, glob, hashlib, os
+
+import numpy as np
+
+from common import RESULT_CACHE_PREFIX
+
+RESULT_CACHE_SIZE = 64  # results kept per folder, oldest are removed
+
+_code_version = None
+
+def code_version():
+    '''hash of the source of calc package, so that results of old code are not reused'''
+    global _code_version
+    if _code_version is None:
+        digest = hashlib.md5()
+        for filename in sorted(glob.glob(os.path.join(os.path.dirname(__file__), '*.py'))):
+            digest.update(open(filename, 'rb').read())
+        _code_version = digest.hexdigest()
+    return _code_version
+
+def files_digest(filenames):
+    '''hash of names, modification times and sizes of files'''
+    digest = hashlib.md5()
+    for filename in filenames:
+        stat = os.stat(filename)
+        digest.update('%s\t%r\t%i\n'%(os.path.basename(filename),
+                                       stat.st_mtime, stat.st_size))
+    return digest.hexdigest()
+
+def params_digest(params):
+    '''hash of dictionary of parameters, arrays are hashed by content'''
+    digest = hashlib.md5()
+    for key in sorted(params):
+        value = params[key]
+        digest.update('%s\t'%key)
+        if isinstance(value, np.ndarray):
+            digest.update('%s%r\t'%(value.dtype.str, value.shape))
+            digest.update(np.ascontiguousarray(value).tostring())
+        elif isinstance(value, dict):
+            digest.update(params_digest(value))
+        else:
+            digest.update(repr(value))
+        digest.update('\n')
+    return digest.hexdigest()
+
+def stage_key(stage, parent, params=None):
+    '''key of the stage results
+
+    @param stage: name of the stage
+    @param parent: key of the stage the results are calculated from,
+                   or files_digest of images for the first stage
+    @param params: dictionary of parameters of the stage
+    '''
+    digest = hashlib.md5()
+    digest.update('%s\t%s\t%s\t'%(stage, parent, code_version()))
+    digest.update(params_digest(params or {}))
+    return digest.hexdigest()
+
+class ResultCache(object):
+    '''Results of analysis stages stored in a folder under their keys
+
+    With folder None nothing is stored, and every stage is calculated.
+    '''
+    def __init__(self, folder, size=RESULT_CACHE_SIZE):
+        self.folder = folder
+        self.size = size
+
+    def filename(self, key):
+        return os.path.join(self.folder, RESULT_CACHE_PREFIX+key+'.pkl')
+
+    def get(self, key):
+        '''cached result for key, None if there is none'''
+        if self.folder is None:
+            return None
+        try:
+            cachefile = open(self.filename(key), 'rb')
+        except IOError:
+            return None
+        try:
+            try:
+                result = cPickle.load(cachefile)
+            except Exception:  # truncated or written by incompatible code
+                return None
+        finally:
+            cachefile.close()
+        try:
+            os.utime(self.filename(key), None)  # recently used, keep it longer
+        except OSError:
+            pass
+        return result
+
+    def put(self, key, result):
+        '''store result under the key, silently giving up if folder is not writable'''
+        if self.folder is None:
+            return
+        filename = self.filename(key)
+        try:
+            cachefile = open(filename+'.part', 'wb')
+            try:
+                cPickle.dump(result, cachefile, cPickle.HIGHEST_PROTOCOL)
+            finally:
+                cachefile.close()
+            os.rename(filename+'.part', filename)
+        except (IOError, OSError, cPickle.PicklingError):
+            return
+        self._trim()
+
+    def _trim(self):
+        '''remove least recently used results over the size of the cache'''
+        filenames = glob.glob(os.path.join(self.folder, RESULT_CACHE_PREFIX+'*.pkl'))
+        if len(filenames) <= self.size:
+            return
+        filenames.sort(key=os.path.getmtime)
+        for filename in filenames[:-self.size]:
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+
+if __name__ == '__main__':
+    # this is executed only if this source file is run separately
+    # and not imported as module to another source file.
+    print __doc__
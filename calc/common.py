@@ -11,6 +11,10 @@ OWNPATH = dirname(argv[0])
 SIDES = ['left','right','top','bottom']
 DATWILDCARD = "Data files (TXT, CSV, DAT)|*.txt;*.TXT;*.csv;*.CSV;*.dat;*.DAT | All files (*.*)|*.*"
 CFG_FILENAME = 'vampy.cfg'
+STACK_CACHE_PREFIX = '.vampy-stack-'  # memory-mapped cache of decoded images
+RESULT_CACHE_PREFIX = '.vampy-result-'  # cached results of analysis stages
+# formats of single-file image stacks and extensions of respective files
+STACKFORMATS = {'tif stack':'tif', 'raw stream':'raw'}
 
 DEFAULT_SCALE = 0.31746  # micrometer/pixel, Teli CS3960DCL, 20x overall magnification, from the ruler
 DEFAULT_PRESSACC = 0.00981  # 1 micrometer of water stack in Pascals
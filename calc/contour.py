@@ -1,37 +1,143 @@
 #!/usr/bin/env python
-"""
+"""Part of VAMP project, only for import.
+
+Outlines of vesicles - brightness of images is resampled onto a polar grid
+around the vesicle centre (every row is a ray at some angle), and the rim
+is the steepest change of brightness along every ray.
 """
 
 import numpy as np
-from scipy.odr import Model
+from scipy.odr import Model, ODR, RealData
 from scipy.optimize import leastsq
 from scipy import ndimage
-from scipy.ndimage import gaussian_gradient_magnitude
 from scipy.ndimage import map_coordinates
 
 from common import PIX_ERR
-from features import line_profile
+from features import refine_extrema, SPLINE_MARGIN, STACK_CHUNK_BYTES
+
+def polar_resample(images, center, radii, angles, **mapkwargs):
+    '''Brightness of image or stack of images on polar grid around the centre
+    
+    All points of the grid (of all images) are interpolated in one
+    map_coordinates call, only the part of images covered by the grid is used.
+    Interpolation is linear by default - the rim is searched for on smoothed
+    gradient anyway, and cubic splines over a stack are several times slower.
+    @param images: 2d image, or 3d stack of images
+    @param center: (y, x) of the centre, for a stack also one centre per image (shape (N,2))
+    @param radii: 1d array of distances from the centre
+    @param angles: 1d array of angles of rays (from x axis towards y axis)
+    other keyword arguments are passed to map_coordinates
+    returns brightness and boolean mask of grid points inside the image,
+    both of shape (angles, radii), with leading image axis for a stack
+    '''
+    stack = images.ndim == 3
+    sizey, sizex = images.shape[-2:]
+    center = np.asarray(center, dtype=float)
+    if stack:
+        center = center * np.ones((images.shape[0], 2))
+    cy = center[..., 0, np.newaxis, np.newaxis]
+    cx = center[..., 1, np.newaxis, np.newaxis]
+    y = cy + np.sin(angles)[:, np.newaxis] * radii
+    x = cx + np.cos(angles)[:, np.newaxis] * radii
+    inside = (y >= 0) & (y <= sizey - 1) & (x >= 0) & (x <= sizex - 1)
+    
+    # part of images covered by the grid, with the margin large enough
+    # for spline prefiltering not to feel its borders
+    top = min(max(0, int(np.floor(y.min())) - SPLINE_MARGIN), sizey - 1)
+    bottom = max(min(sizey, int(np.ceil(y.max())) + SPLINE_MARGIN + 1), top + 1)
+    left = min(max(0, int(np.floor(x.min())) - SPLINE_MARGIN), sizex - 1)
+    right = max(min(sizex, int(np.ceil(x.max())) + SPLINE_MARGIN + 1), left + 1)
+    coords = [y - top, x - left]
+    if stack:
+        # image index is always integer, so that interpolation along it is exact
+        z = np.arange(images.shape[0], dtype=float)[:, np.newaxis, np.newaxis]
+        coords = np.broadcast_arrays(z, *coords)
+    mapkwargs.setdefault('order', 1)
+    mapkwargs.setdefault('mode', 'nearest')
+    mapkwargs['output'] = float
+    polar = map_coordinates(images[..., top:bottom, left:right], coords, **mapkwargs)
+    return polar, inside
+
+def find_rims(polar, inside, sigma=1, presmooth=0):
+    '''Positions of the rim along every ray of polar images (see polar_resample)
+    
+    The rim is the maximum of gradient magnitude along the ray,
+    refined to subpixel resolution (see features.refine_extrema).
+    @param sigma: width of gaussian derivative filter
+    @param presmooth: width of gaussian filter applied to rays before that, none if 0
+    returns indices of the rim along rays and their errors
+    '''
+    if presmooth:
+        polar = ndimage.gaussian_filter1d(polar, presmooth, axis=-1)
+    grad = np.fabs(ndimage.gaussian_filter1d(polar, sigma, axis=-1, order=1))
+    grad[~inside] = 0
+    grad = grad.reshape(-1, grad.shape[-1])
+    pix = np.argmax(grad, axis=-1)
+    rims, rims_err = refine_extrema(grad, pix)
+    refined = np.isfinite(rims_err)
+    rims = np.where(refined, rims, pix)
+    rims_err = np.where(refined, rims_err, PIX_ERR)
+    return rims.reshape(polar.shape[:-1]), rims_err.reshape(polar.shape[:-1])
+
+def vesicle_outline(images, center, rmax, rmin=0, angles=360, rstep=1.0,
+                    sigma=1, presmooth=0, **mapkwargs):
+    '''Outline of the vesicle on image or on every image of the stack
+    
+    @param images: 2d image, or 3d stack of images
+    @param center: (y, x) of the vesicle centre, or one per image (shape (N,2))
+    @param rmax, rmin: range of distances from the centre to look for the rim in
+    @param angles: number of rays evenly spread around the centre, or array of their angles
+    @param rstep: distance between points along rays
+    sigma and presmooth are passed to find_rims, other keyword arguments to map_coordinates
+    returns x and y coordinates of the rim points and the error of their distance
+    from the centre, of shape (angles) or (images, angles) for a stack
+    '''
+    if np.isscalar(angles):
+        angles = np.linspace(0, 2*np.pi, angles, endpoint=False)
+    radii = np.arange(rmin, rmax + rstep/2.0, rstep)
+    center = np.asarray(center, dtype=float)
+    if images.ndim == 2:
+        polar, inside = polar_resample(images, center, radii, angles, **mapkwargs)
+        rims, rims_err = find_rims(polar, inside, sigma, presmooth)
+    else:
+        center = center * np.ones((images.shape[0], 2))
+        # the polar stack is made in chunks of images, so that it fits in memory
+        chunk = max(1, int(STACK_CHUNK_BYTES / (len(angles) * len(radii) * 8)))
+        rims = np.empty((images.shape[0], len(angles)))
+        rims_err = np.empty_like(rims)
+        for start in range(0, images.shape[0], chunk):
+            stop = min(start + chunk, images.shape[0])
+            polar, inside = polar_resample(images[start:stop], center[start:stop],
+                                           radii, angles, **mapkwargs)
+            rims[start:stop], rims_err[start:stop] = find_rims(polar, inside, sigma, presmooth)
+    dist = rmin + rims * rstep
+    x = center[..., 1, np.newaxis] + dist * np.cos(angles)
+    y = center[..., 0, np.newaxis] + dist * np.sin(angles)
+    return x, y, rims_err * rstep
+
+def vesicle_radii(images, center, rmax, rmin=0, angles=360, method='taubin',
+                  refine=False, **outlinekwargs):
+    '''Radius of the vesicle on every image from circle fitted to its whole outline
+    
+    Parameters are the same as for vesicle_outline and fit_circles.
+    returns 2xN array of radii and their errors (as 'vesrads' for analysis.get_geometry)
+    and centres of circles as (y, x), one per image
+    '''
+    x, y, dist_err = vesicle_outline(images, center, rmax, rmin, angles, **outlinekwargs)
+    fit, sd_fit = fit_circles(x, y, method, refine)
+    return np.asarray((fit[0], sd_fit[0])), np.column_stack((fit[2], fit[1]))
 
 def contour(img, A0, R0, phi1=-np.pi/2, phi2=np.pi/2, dphi=np.pi/180, DR=0.2,
             sigma=3):
-#this is just a rough draft not intended to be working
-    y0, x0 = A0
+    '''
+    Rim of the vesicle with centre A0=(y,x) and approximate radius R0
+    within DR*R0 from that radius, for angles from phi1 to phi2 with step dphi
+    returns array of (y,x) of rim points
+    '''
     phi = np.arange(phi1, phi2, dphi)
-    x1 =  x0+R0*(1-DR)*np.cos(phi)
-    y1 =  y0+R0*(1-DR)*np.sin(phi)
-    x2 =  x0+R0*(1+DR)*np.cos(phi)
-    y2 =  y0+R0*(1+DR)*np.sin(phi)
-    rim=[]
-    Nphi, = phi.shape
-    for i in range(Nphi):
-        A1 = np.asarray(((y1[i],x1[i]),(PIX_ERR, PIX_ERR)))
-        A2 = np.asarray(((y2[i],x2[i]),(PIX_ERR, PIX_ERR)))
-        metrics, metrics_err, profile = line_profile(img, A1[i], A2[i])
-        rel_rim = find_rim(profile, sigma)*metrics
-        
-        real_rim = A1 + rel_rim
-        rim.append(real_rim)
-    return rim
+    x, y, dist_err = vesicle_outline(img, A0, R0*(1+DR), R0*(1-DR), phi,
+                                     sigma=sigma, presmooth=sigma)
+    return np.column_stack((y, x))
 
 def find_rim(profile, sigma=3):
     grad = ndimage.gaussian_gradient_magnitude(
@@ -60,6 +166,13 @@ def line_perpendicular(k,b,x):
     b_perp = (k - k_perp) * x + b
     return k_perp, b_perp
 
+# algebraic circle fits, see fit_circles
+CIRCLEFITS = ('kasa', 'pratt', 'taubin')
+# largest number of Newton steps in Pratt and Taubin fits
+CIRCLE_NEWTON_STEPS = 20
+# relative change of the root at which Newton steps stop
+CIRCLE_NEWTON_TOL = 1e-12
+
 def circle_fcn(B, x, y):
     return B[0]**2 - (B[1]-x)**2 - (B[2]-y)**2
 
@@ -73,7 +186,7 @@ def _circle_fjacb(B,x,y):
 def _circle_fjacd(B,x,y):
     fjacd = np.empty((x.shape[0],2))
     fjacd[:,0] = 2*(B[1]-x)
-    fjacd[:,1] = 2*(B[1]-y)
+    fjacd[:,1] = 2*(B[2]-y)
     return fjacd
 
 def _circle_est(x,y):
@@ -82,9 +195,12 @@ def _circle_est(x,y):
 def _circle_meta():
     return {'name':'Equation of a circle'}
 
-circle_model = Model(circle_fcn, estimate=_circle_est, 
-                     fjacb=_circle_fjacb, fjacd=_circle_fjacd, 
-                     meta=_circle_meta, implicit=True)
+# ODR passes both coordinates as one 2xN array x, and wants Jacobians transposed
+circle_model = Model(lambda B, x: circle_fcn(B, x[0], x[1]),
+                     estimate=lambda data: _circle_est(data.x[0], data.x[1]),
+                     fjacb=lambda B, x: _circle_fjacb(B, x[0], x[1]).T,
+                     fjacd=lambda B, x: _circle_fjacd(B, x[0], x[1]).T,
+                     meta=_circle_meta(), implicit=True)
 
 def FitCircle(x,y):
     '''
@@ -92,6 +208,126 @@ def FitCircle(x,y):
     '''
     return leastsq(circle_fcn, _circle_est(x,y), (x, y), Dfun=_circle_fjacb, full_output=1)
 
+def _newton_root(poly, dpoly, shape):
+    '''root of polynomials of many circle fits by Newton steps from 0
+    
+    As in Chernov's reference implementations, the root of a fit is reset
+    to 0 where its step increases the polynomial (Newton diverges), where
+    it does not converge in CIRCLE_NEWTON_STEPS or converges to a negative root.
+    '''
+    root = np.zeros(shape)
+    value = poly(root)
+    active = np.isfinite(value)
+    converged = np.zeros(shape, dtype=bool)
+    for step in range(CIRCLE_NEWTON_STEPS):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            new = root - value/dpoly(root)
+            newvalue = poly(new)
+            active &= np.fabs(newvalue) <= np.fabs(value)
+            done = active & (np.fabs(new - root) <= CIRCLE_NEWTON_TOL*np.fabs(new))
+        root = np.where(active, new, root)
+        value = np.where(active, newvalue, value)
+        converged |= done
+        active &= ~done
+        if not active.any():
+            break
+    return np.where(converged & (root >= 0), root, 0)
+
+def fit_circles(x, y, method='taubin', refine=False):
+    '''Fit circles to many sets of points at once
+    
+    @param x, y: coordinates of points along the last axis, one set per
+                 the rest of axes, non-finite points are left out
+    @param method: one of CIRCLEFITS - algebraic fits of Kasa (simplest,
+                   biased to smaller circles on short arcs), Pratt or Taubin
+                   (Chernov's Newton-based implementations), all are closed-form
+                   with moments of points calculated for all sets at once
+    @param refine: refine every fit by ODR with the implicit circle_model
+                   (geometric fit, one set at a time)
+    returns arrays of (R, xc, yc) and their errors, of shape (3,) + shape of sets,
+    errors are from the scatter of distances of points from the circle
+    '''
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    valid = np.isfinite(x) & np.isfinite(y)
+    n = valid.sum(axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # moments are taken around the centroid of points for precision
+        xmean = np.where(valid, x, 0).sum(axis=-1)/n
+        ymean = np.where(valid, y, 0).sum(axis=-1)/n
+        X = np.where(valid, x - xmean[..., np.newaxis], 0)
+        Y = np.where(valid, y - ymean[..., np.newaxis], 0)
+        Z = X*X + Y*Y
+        Mxx, Myy, Mxy, Mxz, Myz, Mzz = [(a*b).sum(axis=-1)/n for a, b in
+                                        ((X,X), (Y,Y), (X,Y), (X,Z), (Y,Z), (Z,Z))]
+        Mz = Mxx + Myy
+        Cov_xy = Mxx*Myy - Mxy*Mxy
+        if method == 'kasa':
+            # linear least squares of x^2+y^2+D*x+E*y+F, with centred points F=-Mz
+            xc = 0.5*(Mxz*Myy - Myz*Mxy)/Cov_xy
+            yc = 0.5*(Myz*Mxx - Mxz*Mxy)/Cov_xy
+            R = np.sqrt(xc*xc + yc*yc + Mz)
+        elif method == 'pratt':
+            A2 = 4*Cov_xy - 3*Mz*Mz - Mzz
+            A1 = Mzz*Mz + 4*Cov_xy*Mz - Mxz*Mxz - Myz*Myz - Mz*Mz*Mz
+            A0 = (Mxz*Mxz*Myy + Myz*Myz*Mxx - Mzz*Cov_xy - 2*Mxz*Myz*Mxy +
+                  Mz*Mz*Cov_xy)
+            root = _newton_root(lambda t: A0 + t*(A1 + t*(A2 + 4*t*t)),
+                                lambda t: A1 + t*(2*A2 + 16*t*t), Mz.shape)
+            det = root*root - root*Mz + Cov_xy
+            xc = 0.5*(Mxz*(Myy - root) - Myz*Mxy)/det
+            yc = 0.5*(Myz*(Mxx - root) - Mxz*Mxy)/det
+            R = np.sqrt(xc*xc + yc*yc + Mz + 2*root)
+        elif method == 'taubin':
+            Var_z = Mzz - Mz*Mz
+            A3 = 4*Mz
+            A2 = -3*Mz*Mz - Mzz
+            A1 = Var_z*Mz + 4*Cov_xy*Mz - Mxz*Mxz - Myz*Myz
+            A0 = Mxz*(Mxz*Myy - Myz*Mxy) + Myz*(Myz*Mxx - Mxz*Mxy) - Var_z*Cov_xy
+            root = _newton_root(lambda t: A0 + t*(A1 + t*(A2 + t*A3)),
+                                lambda t: A1 + t*(2*A2 + 3*A3*t), Mz.shape)
+            det = root*root - root*Mz + Cov_xy
+            xc = 0.5*(Mxz*(Myy - root) - Myz*Mxy)/det
+            yc = 0.5*(Myz*(Mxx - root) - Mxz*Mxy)/det
+            R = np.sqrt(xc*xc + yc*yc + Mz)
+        else:
+            raise ValueError('Unknown circle fit %s'%method)
+        fit = np.asarray((R, xc + xmean, yc + ymean))
+    
+    if refine:
+        flat = fit.reshape(3, -1)
+        xs, ys, valids = [a.reshape(-1, a.shape[-1]) for a in (x, y, valid)]
+        for i in range(flat.shape[1]):
+            if not np.isfinite(flat[:,i]).all() or valids[i].sum() < 3:
+                continue
+            data = RealData(np.asarray((xs[i][valids[i]], ys[i][valids[i]])), 1)
+            fitter = ODR(data, circle_model, flat[:,i])
+            fitter.set_job(deriv=3)
+            flat[:,i] = fitter.run().beta
+        fit = flat.reshape(fit.shape)
+        fit[0] = np.fabs(fit[0])
+    return fit, _circle_errors(fit, x, y, valid)
+
+def _circle_errors(fit, x, y, valid):
+    '''errors of (R, xc, yc) of circles from distances of points to them,
+    by linearisation of distances around the fit'''
+    R, xc, yc = [p[..., np.newaxis] for p in fit]
+    n = valid.sum(axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dist = np.hypot(x - xc, y - yc)
+        resid = np.where(valid, dist - R, 0)
+        var = (resid*resid).sum(axis=-1)/(n - 3)
+        # Jacobian of distances, d(dist - R)/d(R, xc, yc)
+        jac = np.asarray((-np.ones_like(dist), (xc - x)/dist, (yc - y)/dist))
+        jac = np.where(valid, jac, 0)
+        normal = np.einsum('i...k,j...k->...ij', jac, jac)
+        bad = ~np.isfinite(normal).all(axis=(-2, -1)) | (n < 4)
+        normal[bad] = np.eye(3)
+        cov = np.linalg.inv(normal)
+        err = np.sqrt(np.diagonal(cov, axis1=-2, axis2=-1)*var[..., np.newaxis])
+    err[bad] = np.nan
+    return np.rollaxis(err, -1)
+
 def section_profile(img, point1, point2):
     '''define the brightness profile along the line defined by 2 points
 
@@ -133,29 +369,6 @@ def CircleFunc(r, N=100):
     return r*np.cos(phi), r*np.sin(phi)
     
 def VesicleEdge_phc(img, x0, y0, r0, N=100, phi1=0, phi2=2*np.pi, sigma=1):
-    Xedge = np.empty(N)
-    Yedge = np.empty(N)
-    for i, phi in enumerate(np.linspace(phi1, phi2, N)):
-        x = x0+r0*np.cos(phi)
-        y = y0+r0*np.sin(phi)
-        if x < 0:
-            x = 0
-            y = y0+(x-x0)*np.tan(phi)
-        elif x > img.shape[1]-1:
-            x = img.shape[1]-1
-            y = y0+(x-x0)*np.tan(phi)
-        if y < 0:
-            y = 0
-            x = x0+(y-y0)/np.tan(phi)
-        elif y > img.shape[0]-1:
-            y = img.shape[1]-1
-            x = x0+(y-y0)/np.tan(phi)
-        
-        point1 = np.asarray(((y0,x0),(PIX_ERR, PIX_ERR)))
-        point2 = np.asarray(((y,x),(PIX_ERR, PIX_ERR)))
-        metric, metric_err, line = section_profile(img, point1, point2)
-        grad = gaussian_gradient_magnitude(line,sigma)
-        pos = np.argmax(grad)
-        Xedge[i] = x0+pos*np.cos(phi)*metric
-        Yedge[i] = y0+pos*np.sin(phi)*metric
+    phi = np.linspace(phi1, phi2, N)
+    Xedge, Yedge, dist_err = vesicle_outline(img, (y0, x0), r0, angles=phi, sigma=sigma)
     return Xedge, Yedge
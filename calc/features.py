@@ -10,16 +10,44 @@ more details are documented in vamp.tex
 
 prerequisites - installed numpy, scipy
 '''
+import collections, logging, mmap, multiprocessing, os, shutil, tempfile
+
 #for arrays and math
 from numpy import sqrt, square, sum  # these are the most common ones just for convenience
 import numpy as np
 from scipy import ndimage
 
-from fitting import fit_err
+from fitting import fit_err, fit_gauss
 import smooth
 
 from common import PIX_ERR
 
+# number of extra rows around the axis band used when interpolating profiles,
+# beyond it spline prefilter does not feel the band border
+SPLINE_MARGIN = 32
+# approximate size of a chunk of images interpolated at once (bytes of floats)
+STACK_CHUNK_BYTES = 64*2**20
+# number of chunks of images per worker process in locate_parallel
+CHUNKS_PER_WORKER = 4
+# number of images processed at once by locate_stream
+STREAM_CHUNK = 16
+# estimators of subpixel positions of extrema, see refine_extrema
+SUBPIXMETHODS = ('parabolic', 'gaussian', 'centroid')
+# points to both sides of an extremum used by centroid estimator
+CENTROID_HALFWIDTH = 2
+# points to both sides of an extremum fitted by fit_extremum
+SUBPIXFIT_HALFWIDTH = 4
+# points to both sides of previous position searched by tracking, see track_extrema
+TRACK_WINDOW = 5
+# share of previous contrast of a tracked extremum below which it is searched for again
+TRACK_CONFIDENCE = 0.5
+
+log = logging.getLogger(__name__)
+
+class StackShapeError(ValueError):
+    '''Images can not be processed as one stack, e.g. their axis profiles
+    have different length, see locate_stack'''
+
 def section_profile(img, point1, point2, **mapkwargs):
     '''define the brightness profile along the section between 2 points
 
@@ -113,32 +141,93 @@ def line_profile(img, point1, point2, **mapkwargs):
     so that axis intersects left and right image sides
     '''
     # define the line going though 2 points
-    y1,x1,dy1,dx1 = point1.flatten()
-    y2,x2,dy2,dx2 = point2.flatten()
-    k = (y2 - y1) / (x2 - x1)
-    b = y1 - k*x1
-    
-    dk = sqrt(dy1*dy1 + dy2*dy2 + k*k*(dx1*dx1+dx2*dx2) )/np.fabs(x2-x1)
+    k, b, dk = line_params(point1, point2)
 
     # number of points for profile
     # it is assumed that pipette is more or less horizontal
     # so that axis intersects left and right image sides
-    nPoints = max(np.fabs(k) * (img.shape[1] - 1) + 1, img.shape[1])
+    nPoints = profile_length(k, img.shape[1])
 
     #coordinates of points in the profile
-    x = np.linspace(0, img.shape[1] - 1, nPoints)
-    y = np.linspace(b, k * (img.shape[1] - 1) + b, nPoints)
+    x, y = profile_coords(k, b, img.shape[1], nPoints)
 
     #calculate profile metric - coefficient for lengths in profile vs pixels
-    if np.fabs(k) <=1:
-        metric = sqrt(1 + k*k)
-        metric_err = np.fabs(k)*dk/metric
-    else:
-        metric = sqrt(1 + 1/(k*k))
-        metric_err = dk/np.fabs(metric * k*k*k)
+    metric, metric_err = profile_metric(k, dk)
     #output interpolated values at points of profile and profile metric
+    profile = band_profile(img, y, x, **mapkwargs)
+    return metric, metric_err, profile
+
+def line_profile_stack(images, point1, point2, **mapkwargs):
+    '''define brightness profiles along lines across every image in the stack
+
+    stacked version of line_profile - point1 and point2 hold one point
+    per image, i.e. have shape (N,2,2), images have shape (N,H,W).
+    All profiles must have the same length (see profile_length),
+    otherwise StackShapeError is raised.
+    Every profile is interpolated on its own image exactly as in line_profile.
+    '''
+    imgN, sizey, sizex = images.shape
+    k, b, dk = line_params(point1, point2)
+    nPoints = profile_length(k, sizex)
+    if np.any(nPoints != nPoints[0]):
+        raise StackShapeError('Profiles of different length can not be stacked')
+    nPoints = nPoints[0]
+    metric, metric_err = profile_metric(k, dk)
+
+    profiles = np.empty((imgN, nPoints))
+    for index in range(imgN):
+        x, y = profile_coords(k[index], b[index], sizex, nPoints)
+        profiles[index] = band_profile(images[index], y, x, **mapkwargs)
+    return metric, metric_err, profiles
+
+def profile_coords(k, b, width, nPoints):
+    '''x and y coordinates of nPoints of the line with slope k and intercept b
+    evenly spaced across the image of given width'''
+    x = np.linspace(0, width - 1, nPoints)
+    y = np.linspace(b, k * (width - 1) + b, nPoints)
+    return x, y
+
+def band_profile(img, y, x, **mapkwargs):
+    '''interpolate the image at points (y, x)
+
+    Only the horizontal band of the image around the points is interpolated,
+    with SPLINE_MARGIN rows to both sides, so that spline prefilter
+    is not calculated for the whole image.
+    '''
+    sizey = img.shape[0]
+    top = min(max(0, int(np.floor(y.min())) - SPLINE_MARGIN), sizey - 1)
+    bottom = max(min(sizey, int(np.ceil(y.max())) + SPLINE_MARGIN + 1), top + 1)
     mapkwargs['output'] = float
-    return metric, metric_err, ndimage.map_coordinates(img, [y, x], **mapkwargs)
+    return ndimage.map_coordinates(img[top:bottom], [y - top, x], **mapkwargs)
+
+def line_params(point1, point2):
+    '''slope, intercept and slope error of the line defined by 2 points
+
+    coordinates of points with their errors are supplied as numpy arrays 
+    in notation array((y,x),(dy,dx)), possibly with extra leading dimensions
+    '''
+    y1,x1,dy1,dx1 = _point_coords(point1)
+    y2,x2,dy2,dx2 = _point_coords(point2)
+    k = (y2 - y1) / (x2 - x1)
+    b = y1 - k*x1
+    dk = sqrt(dy1*dy1 + dy2*dy2 + k*k*(dx1*dx1+dx2*dx2) )/np.fabs(x2-x1)
+    return k, b, dk
+
+def profile_length(k, width):
+    '''number of points in the profile along the line with slope k
+    crossing the image of given width'''
+    return np.maximum(np.fabs(k) * (width - 1) + 1, width).astype(int)
+
+def profile_metric(k, dk):
+    '''profile metric - coefficient for lengths in profile vs pixels'''
+    k = np.asarray(k, dtype=float)
+    steep = np.fabs(k) > 1
+    flat_k = np.where(steep, 1, k)
+    steep_k = np.where(steep, k, 1)
+    metric = np.where(steep, sqrt(1 + 1/(steep_k*steep_k)), sqrt(1 + flat_k*flat_k))
+    metric_err = np.where(steep, dk/np.fabs(metric * steep_k**3),
+                          np.fabs(flat_k)*dk/metric)
+    return metric[()], metric_err[()]  # scalars for a single line
 
 def point_to_line_dist(point, point1, point2):
     '''Point to line distance.
@@ -147,10 +236,12 @@ def point_to_line_dist(point, point1, point2):
     point1, point2 - 2 points forming the line from which distance is calculated (with errors)
 
     all arguments are in numpy-array notation, i.e. array((y,x),(dy,dx))!
+    arguments may carry extra leading dimensions (e.g. one point per image),
+    the result is then calculated for every one of them.
     '''
-    y0,x0,dy0,dx0 = point.flatten()
-    y1,x1,dy1,dx1 = point1.flatten()
-    y2,x2,dy2,dx2 = point2.flatten()
+    y0,x0,dy0,dx0 = _point_coords(point)
+    y1,x1,dy1,dx1 = _point_coords(point1)
+    y2,x2,dy2,dx2 = _point_coords(point2)
     
     k = (y2-y1)/(x2-x1)
     b = y1-k*x1
@@ -162,9 +253,26 @@ def point_to_line_dist(point, point1, point2):
                     k*k*dk*dk*(k*x0+b-y0)**2/(1+k*k))/(1+k*k)
     return np.asarray((np.fabs(dist), dist_err))
 
-def wall_points_subpix(img, refsx, mode):
-#    return refssub, refs_err, extra_walls
-    return
+def _point_coords(point):
+    '''Unpack point(s) in notation array((y,x),(dy,dx)) to y, x, dy, dx'''
+    point = np.asarray(point, dtype=float)
+    return point[...,0,0], point[...,0,1], point[...,1,0], point[...,1,1]
+
+def wall_points_subpix(images, refs, mismatch, method='parabolic', fallback=False):
+    '''Refine reference points on pipette walls to subpixel resolution
+    
+    Walls are minima of brightness across the pipette, see refine_features
+    @param images: stack of images
+    @param refs: reference points of all images as returned by wall_points_pix_stack
+    returns refs with subpixel y coordinates and their errors where they were refined
+    '''
+    refs = np.array(refs, dtype=float)
+    for index in range(refs.shape[1]):
+        columns = images[:, :, int(refs[0, index, 0, 1])]
+        wall, = refine_features([(columns, refs[:, index, 0, 0], None)],
+                                mismatch, method, fallback)
+        refs[:, index, 0, 0], refs[:, index, 1, 0] = wall
+    return refs
 
 def split_two_peaks(ar, mode):
     """
@@ -206,22 +314,58 @@ def wall_points_pix(img, refsx, axis, pipette):
         refs = np.append(refs, ref)
     return refs.reshape(-1,2,2)
 
+def wall_points_pix_stack(images, refsx, axis, pipette):
+    '''stacked version of wall_points_pix
+    
+    finds reference points on pipette walls for all images at once,
+    returns array of shape (N,4,2,2) - for every image the same as wall_points_pix
+    '''
+    piprad, pipthick = pipette
+    N=2
+    refs = np.empty((images.shape[0], N*len(refsx), 2, 2))
+    for index, refx in enumerate(refsx):
+        center = axis[index]
+        lower = images[:, center-piprad-pipthick:center-piprad, refx]
+        upper = images[:, center+piprad:center+piprad+pipthick, refx]
+        refs[:, N*index, 0, 0] = np.argmin(lower, axis=1)+center-piprad-pipthick
+        refs[:, N*index+1, 0, 0] = np.argmin(upper, axis=1)+center+piprad
+        refs[:, N*index:N*index+N, 0, 1] = refx
+        refs[:, N*index:N*index+N, 1, :] = (PIX_ERR, 0)
+    return refs
+
+def wall_points_track(images, refs, axis, pipette, window=TRACK_WINDOW):
+    '''reference points on pipette walls tracked from image to image
+    
+    @param refs: reference points of all images found by wall_points_pix_stack,
+                 used where tracking falls back to the full search
+    returns refs with tracked y coordinates, see track_extrema
+    '''
+    piprad, pipthick = pipette
+    refs = np.array(refs)
+    for index in range(refs.shape[1]):
+        center = axis[index/2]
+        if index % 2:
+            limits = (center+piprad, center+piprad+pipthick)
+        else:
+            limits = (center-piprad-pipthick, center-piprad)
+        columns = images[:, :, int(refs[0, index, 0, 1])]
+        refs[:, index, 0, 0] = track_extrema(columns, limits, -1, refs[:, index, 0, 0], window)
+    return refs
+
 def line_to_line(refs):
     '''
     Return mean distance between two (not parallel) lines
-    @param refs: 3d numpy array, each refs[i,:] is a point with errors ((y,x),(dy,dx)).
-                first line is defined by refs[0] & refs[2], second line by refs[1] & refs[3] 
+    @param refs: numpy array, each refs[...,i,:,:] is a point with errors ((y,x),(dy,dx)).
+                first line is defined by refs[0] & refs[2], second line by refs[1] & refs[3]
+                extra leading dimensions (e.g. one set of points per image) are allowed 
     '''
-    #TODO: rewrite it in cycle, maybe rearrange refs for this
-   
-    dists = np.empty((2,4))
-    
-    dists[:,0] = point_to_line_dist(refs[0,:], refs[1,:], refs[3,:])
-    dists[:,1] = point_to_line_dist(refs[1,:], refs[0,:], refs[2,:])
-    dists[:,2] = point_to_line_dist(refs[2,:], refs[1,:], refs[3,:])
-    dists[:,3] = point_to_line_dist(refs[3,:], refs[0,:], refs[2,:])
-    dist = dists[0].mean()
-    dist_err = sqrt(sum(square(dists[1])))/4
+    ref0, ref1, ref2, ref3 = [refs[...,i,:,:] for i in range(4)]
+    dists = np.asarray((point_to_line_dist(ref0, ref1, ref3),
+                        point_to_line_dist(ref1, ref0, ref2),
+                        point_to_line_dist(ref2, ref1, ref3),
+                        point_to_line_dist(ref3, ref0, ref2)))
+    dist = dists[:,0].mean(axis=0)
+    dist_err = sqrt(sum(square(dists[:,1]), axis=0))/4
     
     return np.asarray((dist, dist_err))
 
@@ -297,32 +441,521 @@ def extract_pix_dic(polar, profile, minaspest, minvesest, tiplimits, darktip):
         ves = np.argmin(profile[minvesest:]) + minvesest
     return pip, asp, ves
 
-def extract_subpix(profile, pip, asp, ves, mode):
+def extract_pix_stack(mode, profiles, minaspest, minvesest, tiplimits, darktip, smoothing):
+    """
+    Stacked version of extract_pix, profiles is a 2D array with one profile per row.
+    Returns arrays of positions of pipette tip, aspirated vesicle tip
+    and outer vesicle edge with pixel resolution.
+    """
     imgtype, polar = mode
+    tiplimleft, tiplimright = tiplimits
+    tipprofs = profiles[:, tiplimleft:tiplimright]
     if imgtype == 'phc':
-        return extract_subpix_phc(profile, pip, asp, ves)
+        if darktip:
+            pips = np.empty(profiles.shape[0], int)
+            for index, tipprof in enumerate(tipprofs):
+                peak1, peak2 = split_two_peaks(tipprof, 1)
+                pips[index] = np.argmin(tipprof[peak1:peak2])+peak1
+        else:
+            pips = np.argmax(tipprofs, axis=1)
+        grads = smooth.smooth1d(profiles, smoothing['mode'], smoothing['order'],
+                                smoothing['window'], diff=1, axis=1)
+        asps = np.argmax(abs(grads[:, :minaspest]), axis=1)
+        vess = np.argmax(abs(grads[:, minvesest:]), axis=1) + minvesest
     elif imgtype == 'dic':
-        return extract_subpix_dic(profile, pip, asp, ves, polar)
-
-#TODO: more accurate subpix code for phase contrast
-def extract_subpix_phc(profile, pip, asp, ves):
-#    pipfit = fit_peak(profile, pip)
-#    aspfit = fit_edge_phc(profile, asp)
-#    vesfit = fit_edge_phc(profile, ves)
-#    return pipfit, aspfit, vesfit
-    return
-
-#TODO: more accurate subpix code for DIC
-def extract_subpix_dic(profile, pip, asp, ves, polar):
-#    pipfit = fit_peak(profile, pip)
-#    aspfit = fit_peak(profile, asp)
-#    vesfit = fit_peak(profile, ves)
-#    return pipfit, aspfit, vesfit
-    return
+        pips = np.argmax(tipprofs, axis=1)
+        if polar == 'right':
+            asps = np.argmin(profiles[:, :minaspest], axis=1)
+            vess = np.argmax(profiles[:, minvesest:], axis=1) + minvesest
+        elif polar == 'left':
+            asps = np.argmax(profiles[:, :minaspest], axis=1)
+            vess = np.argmin(profiles[:, minvesest:], axis=1) + minvesest
+    return pips + tiplimleft, asps, vess
+
+def profile_noise(profiles):
+    '''noise level of every profile (last axis), from median of absolute second differences,
+    which is not sensitive to edges and peaks of the profile'''
+    d2 = np.diff(profiles, n=2, axis=-1)
+    return 1.4826*np.median(np.fabs(d2), axis=-1)/sqrt(6)
+
+def smoothing_gain(smoothing, size):
+    '''factor of noise of the smoothed gradient of profile of that size to noise of profile'''
+    impulse = np.zeros(size)
+    impulse[size/2] = 1
+    response = smooth.smooth1d(impulse, smoothing['mode'], smoothing['order'],
+                               smoothing['window'], diff=1)
+    return sqrt(sum(square(response)))
+
+def _three_point(a, b, c, sa, sb, sc):
+    '''offset of the vertex of parabola through (-1,a), (0,b), (1,c) and its error
+    propagated from errors of a, b and c'''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        curv = a - 2*b + c
+        offset = 0.5*(a - c)/curv
+        err = sqrt((c-b)**2*sa**2 + (a-c)**2*sb**2 + (b-a)**2*sc**2)/curv**2
+    return offset, err
+
+def refine_extrema(profiles, positions, method='parabolic', noise=None):
+    '''Subpixel positions of extrema of profiles, closed-form for all profiles at once
+    
+    @param profiles: 2d array, one profile per row
+    @param positions: pixel position of the extremum on every profile
+    @param method: one of SUBPIXMETHODS - vertex of parabola through three points
+                   around the extremum, the same for logarithm of profile
+                   (Gaussian peak, only for positive maxima, parabola is used for others),
+                   or centroid of the peak over CENTROID_HALFWIDTH points to both sides
+    @param noise: noise level of every profile, estimated by profile_noise by default
+    returns positions and their errors, NaN where there is no extremum to refine
+    (position is not a local extremum or is too close to the end of profile)
+    '''
+    profiles = np.asarray(profiles, dtype=float)
+    positions = np.asarray(positions).astype(int)
+    if noise is None:
+        noise = profile_noise(profiles)
+    rows = np.arange(profiles.shape[0])
+    size = profiles.shape[1]
+    center = np.clip(positions, 1, size - 2)
+    a, b, c = [profiles[rows, center + shift] for shift in (-1, 0, 1)]
+    offset, err = _three_point(a, b, c, noise, noise, noise)
+    with np.errstate(invalid='ignore'):
+        # vertex of parabola through a local extremum is not further than half a pixel
+        extremum = (positions == center) & (np.fabs(offset) <= 0.5)
+        if method == 'gaussian':
+            positive = (a > 0) & (b > 0) & (c > 0) & (b >= a) & (b >= c)
+            with np.errstate(divide='ignore'):
+                loga, logb, logc = [np.log(np.where(positive, value, 1)) for value in (a, b, c)]
+                goffset, gerr = _three_point(loga, logb, logc, noise/a, noise/b, noise/c)
+            offset = np.where(positive, goffset, offset)
+            err = np.where(positive, gerr, err)
+        elif method == 'centroid':
+            half = CENTROID_HALFWIDTH
+            window = np.arange(-half, half + 1)
+            index = np.clip(positions[:, np.newaxis] + window, 0, size - 1)
+            # minima are turned to maxima, and the peak is taken above its lowest point
+            peaks = np.where(a - 2*b + c > 0, -1, 1)[:, np.newaxis]*profiles[rows[:, np.newaxis], index]
+            weights = peaks - peaks.min(axis=1)[:, np.newaxis]
+            total = weights.sum(axis=1)
+            with np.errstate(divide='ignore'):
+                offset = (weights*window).sum(axis=1)/total
+                err = noise*sqrt(sum(square(window - offset[:, np.newaxis]), axis=1))/total
+            extremum &= (positions >= half) & (positions <= size - 1 - half)
+    return np.where(extremum, center + offset, np.nan), np.where(extremum, err, np.nan)
+
+def fit_extremum(profile, position, halfwidth=SUBPIXFIT_HALFWIDTH):
+    '''Subpixel position of an extremum of single profile by nonlinear fit of Gaussian
+    
+    returns position and its error, NaN if the fit failed
+    '''
+    start = max(int(position) - halfwidth, 0)
+    y = np.asarray(profile[start:int(position) + halfwidth + 1], dtype=float)
+    if y.size < 5:
+        return np.nan, np.nan
+    sgn = 1
+    if y[int(position) - start] < y.mean():
+        sgn = -1
+    try:
+        fit = fit_gauss(y, sgn)
+    except Exception: # e.g. leastsq errors on flat profiles
+        return np.nan, np.nan
+    err = fit_err(fit)
+    if fit[-1] not in (1, 2, 3, 4) or err is None:
+        return np.nan, np.nan
+    return fit[0][2] + start, err[2]
+
+def refine_features(targets, mismatch, method='parabolic', fallback=False):
+    '''Subpixel positions of features where they agree with pixel ones
+    
+    @param targets: list of (profiles, positions, noise) for every feature -
+                    2d array of profiles where it is an extremum, its pixel positions
+                    and noise level of profiles (None to estimate it from profiles)
+    @param mismatch: largest allowed distance between subpixel and pixel positions
+    @param method: one of SUBPIXMETHODS
+    @param fallback: fit Gaussian to extrema of profiles where closed-form subpixel
+                     position is not found or is beyond the mismatch (see fit_extremum)
+    returns list of 2xN arrays of positions and their errors for every feature,
+    positions that were not refined stay pixel ones with PIX_ERR
+    '''
+    refined = []
+    for profiles, positions, noise in targets:
+        positions = np.asarray(positions, dtype=float)
+        pos, err = refine_extrema(profiles, positions, method, noise)
+        with np.errstate(invalid='ignore'):
+            good = np.isfinite(err) & (np.fabs(pos - positions) < mismatch)
+        if fallback and not good.all():
+            for index in np.flatnonzero(~good):
+                pos[index], err[index] = fit_extremum(profiles[index], positions[index])
+            with np.errstate(invalid='ignore'):
+                good = np.isfinite(err) & (np.fabs(pos - positions) < mismatch)
+        refined.append(np.asarray((np.where(good, pos, positions),
+                                   np.where(good, err, PIX_ERR))))
+    return refined
+
+def track_extrema(rows, limits, sgn, full, window=TRACK_WINDOW, confidence=TRACK_CONFIDENCE):
+    '''Position of extremum on every row, searched for near its position on the previous row
+    
+    Search window spans window points to both sides of the previous position,
+    plus twice the last displacement, so that it widens when features move faster.
+    The full search is used for the first row, and where the extremum is found
+    on the border of the window (it has moved further) or its contrast against
+    the window falls below confidence of the previous one.
+    Tracking is sequential, and the full search is done for all rows anyway
+    (vectorized, it is cheaper than the windowed one), so it does not make
+    locate faster, it keeps positions from jumping to spurious extrema.
+    @param rows: 2d array, e.g. profiles of consecutive images
+    @param limits: (start, stop) of the full search range
+    @param sgn: 1 if extremum is a maximum, -1 if minimum
+    @param full: positions on every row found by the full search
+    returns array of positions
+    '''
+    start, stop = limits
+    positions = np.empty(len(rows), int)
+    contrast = None
+    for index in range(len(rows)):
+        row = rows[index]
+        if index == 0:
+            found = None
+        else:
+            prev = positions[index-1]
+            width = window
+            if index > 1:
+                width += 2*abs(prev - positions[index-2])
+            left = max(start, prev - width)
+            right = min(stop, prev + width + 1)
+            found = np.argmax(sgn*row[left:right]) + left
+            strength = sgn*(row[found] - row[left:right].mean())
+            if ((found == left and left > start) or (found == right-1 and right < stop) or
+                not strength >= confidence*contrast):
+                found = None
+        if found is None:
+            found = int(full[index])
+            left = max(start, found - window)
+            strength = sgn*(row[found] - row[left:min(stop, found + window + 1)].mean())
+        positions[index] = found
+        contrast = strength
+    return positions
+
+def extract_pix_track(mode, profiles, minaspest, minvesest, tiplimits, darktip,
+                      smoothing, window=TRACK_WINDOW):
+    """
+    Tracking version of extract_pix_stack, every feature is searched for
+    near its position on the previous profile (see track_extrema),
+    with the full search of extract_pix_stack where tracking fails.
+    """
+    imgtype, polar = mode
+    size = profiles.shape[1]
+    fullpips, fullasps, fullvess = extract_pix_stack(mode, profiles, minaspest, minvesest,
+                                                     tiplimits, darktip, smoothing)
+    if imgtype == 'phc':
+        pipsgn = darktip and -1 or 1
+        grads = np.fabs(smooth.smooth1d(profiles, smoothing['mode'], smoothing['order'],
+                                        smoothing['window'], diff=1, axis=1))
+        aspsgn = vessgn = 1
+        asprows = vesrows = grads
+    elif imgtype == 'dic':
+        pipsgn = 1
+        aspsgn = polar == 'right' and -1 or 1
+        vessgn = -aspsgn
+        asprows = vesrows = profiles
+    pips = track_extrema(profiles, tiplimits, pipsgn, fullpips, window)
+    asps = track_extrema(asprows, (0, minaspest), aspsgn, fullasps, window)
+    vess = track_extrema(vesrows, (minvesest, size), vessgn, fullvess, window)
+    return pips, asps, vess
+
+def extract_subpix(mode, profiles, pips, asps, vess, smoothing, mismatch,
+                   method='parabolic', fallback=False):
+    """
+    Refine positions of pipette tip, aspirated vesicle tip and outer vesicle edge
+    found with pixel resolution to subpixel one, for all profiles at once.
+    @param mode: 2-tuple of strings of image type and additional type parameter
+    @param profiles: 2D array with one profile per row
+    @param pips, asps, vess: positions found by extract_pix_stack
+    @param smoothing: pre-smoothing parameters for various filters
+    other parameters are the same as for refine_features
+    returns 2xN arrays of positions and their errors of pip, asp and ves
+    """
+    imgtype, polar = mode
+    if imgtype == 'phc':
+        return extract_subpix_phc(profiles, pips, asps, vess, smoothing, mismatch, method, fallback)
+    elif imgtype == 'dic':
+        return extract_subpix_dic(profiles, pips, asps, vess, mismatch, method, fallback)
+
+def extract_subpix_phc(profiles, pips, asps, vess, smoothing, mismatch, method, fallback):
+    """
+    Subpixel positions of features for Phase Contrast images.
+    Pipette tip is an extremum of brightness, vesicle edges are peaks
+    of the absolute smoothed gradient, as in extract_pix_phc.
+    """
+    grads = np.fabs(smooth.smooth1d(profiles, smoothing['mode'], smoothing['order'],
+                                    smoothing['window'], diff=1, axis=1))
+    noise = profile_noise(profiles)
+    # second differences of smoothed gradient underestimate its noise
+    gradnoise = np.maximum(noise*smoothing_gain(smoothing, profiles.shape[1]),
+                           profile_noise(grads))
+    return refine_features([(profiles, pips, noise), (grads, asps, gradnoise),
+                            (grads, vess, gradnoise)], mismatch, method, fallback)
+
+def extract_subpix_dic(profiles, pips, asps, vess, mismatch, method, fallback):
+    """
+    Subpixel positions of features for DIC images,
+    all features are extrema of brightness, as in extract_pix_dic.
+    """
+    noise = profile_noise(profiles)
+    return refine_features([(profiles, pips, noise), (profiles, asps, noise),
+                            (profiles, vess, noise)], mismatch, method, fallback)
 
 def locate(argsdict):
     '''Extracts features of interest from set of images.
 
+    Uses vectorized locate_stack when possible, and falls back to
+    image-by-image locate_serial (logging it) when axis profiles of images
+    have different length.
+    With 'track', walls and features are searched for near their positions
+    on the previous image (see track_extrema), within 'trackwindow' points,
+    TRACK_WINDOW by default. Every chunk of images processed on its own
+    (by locate_parallel or locate_stream) starts with the full search,
+    images with profiles of different length (locate_serial) are not tracked.
+    With 'subpix', positions are refined to subpixel resolution by estimator
+    'subpixmethod' (one of SUBPIXMETHODS, parabolic by default), where they are
+    within 'mismatch' of pixel ones; with 'subpixfit' a Gaussian is fitted to features
+    on images where that fails (see refine_features).
+    If argsdict has 'workers' > 1, images are processed by locate_parallel.
+    
+    extra_out is a list of dictionaries, with every dictionary corresponds to a single image.
+
+    '''
+    if argsdict.get('workers', 1) > 1:
+        return locate_parallel(argsdict, argsdict['workers'])
+    try:
+        return locate_stack(argsdict)
+    except StackShapeError as err:
+        log.info('%s, locating features image by image', err)
+        return locate_serial(argsdict)
+
+def locate_parallel(argsdict, workers=None):
+    '''Extracts features of interest from set of images on a pool of processes.
+    
+    The stack of images is split in chunks, every chunk is processed by locate
+    in a separate process. Workers map images from the file they are already
+    memory-mapped from (cropped and rotated views of it too, see _share_stack),
+    or from a temporary .npy file, not by pickling them.
+    Results are merged back in the order of images.
+    @param workers: number of processes, default is number of CPUs
+    '''
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    images = argsdict['images']
+    params = dict(argsdict)
+    del params['images']
+    params['workers'] = 1
+    imgN = images.shape[0]
+    if workers < 2 or imgN < 2*workers:
+        params['images'] = images
+        return locate(params)
+    
+    chunk = int(np.ceil(imgN / float(workers * CHUNKS_PER_WORKER)))
+    view, tmpdir = _share_stack(images)
+    try:
+        tasks = [(view, start, min(start+chunk, imgN), params)
+                 for start in range(0, imgN, chunk)]
+        pool = multiprocessing.Pool(workers)
+        try:
+            results = pool.map(_locate_chunk, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        if tmpdir:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+    
+    return _merge_located(results)
+
+def locate_stream(frames, argsdict, chunk=STREAM_CHUNK):
+    '''Extracts features of interest from images supplied one by one.
+    
+    Only a chunk of images is held in memory at a time, the rest is
+    just the accumulated feature positions, so that recordings much larger
+    than memory can be analysed straight from files.
+    With 'workers' > 1 chunks are processed on a single pool of processes,
+    at most one chunk more than there are workers is held at a time.
+    @param frames: iterable of 2d images, e.g. load.iter_grey_images
+    @param argsdict: same as for locate, 'images' are not needed
+    @param chunk: number of images processed at once
+    '''
+    params = dict(argsdict)
+    params.pop('images', None)
+    workers = params.get('workers', 1)
+    params['workers'] = 1
+    batches = _stream_batches(frames, chunk)
+    if workers < 2:
+        return _merge_located([_locate_batch((batch, params)) for batch in batches])
+    
+    pool = multiprocessing.Pool(workers)
+    try:
+        results = []
+        pending = collections.deque()
+        for batch in batches:
+            pending.append(pool.apply_async(_locate_batch, ((batch, params),)))
+            if len(pending) > workers:
+                results.append(pending.popleft().get())
+        results.extend(item.get() for item in pending)
+    except:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+    return _merge_located(results)
+
+def _stream_batches(frames, chunk):
+    '''group consecutive frames in stacks of chunk images'''
+    batch = []
+    for frame in frames:
+        batch.append(frame)
+        if len(batch) == chunk:
+            yield np.asarray(batch)
+            batch = []
+    if batch:
+        yield np.asarray(batch)
+
+def _locate_batch(task):
+    '''locate features in a stack of images, for worker processes'''
+    images, params = task
+    params = dict(params)
+    params['images'] = images
+    return locate(params)
+
+def _merge_located(results):
+    '''merge results of locate on consecutive chunks of images'''
+    outs, extra_outs = zip(*results)
+    out = {}
+    for key in outs[0]:
+        out[key] = np.concatenate([item[key] for item in outs], axis=-1)
+    extra_out = []
+    for item in extra_outs:
+        extra_out.extend(item)
+    return out, extra_out
+
+def _share_stack(images):
+    '''Get the geometry of images in the file they can be memory-mapped from.
+    
+    If images are memory-mapped (np.load with mmap_mode, load.read_tiff_stack)
+    or are any view of such array (see preproc_images), the geometry is
+    (filename, offset, shape, dtype, strides) of that view in the file.
+    Otherwise images are saved to a .npy file in temporary directory,
+    which is returned too so that it can be removed afterwards.
+    '''
+    view = _mapped_view(images)
+    if view is not None:
+        return view, None
+    tmpdir = tempfile.mkdtemp(prefix='vampy')
+    filename = os.path.join(tmpdir, 'images.npy')
+    np.save(filename, images)
+    return _mapped_view(np.load(filename, mmap_mode='r')), tmpdir
+
+def _mapped_view(images):
+    '''geometry of the array in the file it is memory-mapped from, None if it is not'''
+    root = images
+    while root is not None and not (isinstance(root, np.memmap) and
+                                    isinstance(root.base, mmap.mmap)):
+        root = getattr(root, 'base', None)
+    if root is None or not root.filename:
+        return None
+    address = images.__array_interface__['data'][0]
+    offset = root.offset + address - root.__array_interface__['data'][0]
+    return root.filename, offset, images.shape, images.dtype.str, images.strides
+
+def _open_view(view):
+    '''memory-map the array from its geometry in the file, see _share_stack'''
+    filename, offset, shape, dtype, strides = view
+    filebytes = np.memmap(filename, dtype=np.uint8, mode='r')
+    return np.ndarray(shape, dtype, filebytes, offset, strides)
+
+def _locate_chunk(task):
+    '''locate features in a chunk of memory-mapped images, for worker processes'''
+    view, start, stop, params = task
+    params = dict(params)
+    params['images'] = _open_view(view)[start:stop]
+    return locate(params)
+
+def locate_stack(argsdict):
+    '''Extracts features of interest from the whole stack of images at once.
+    
+    Vectorized version of locate_serial, takes and returns the same. Profiles
+    are interpolated image by image as in locate_serial, the search
+    for features is done on all of them at once.
+    Raises StackShapeError if axis profiles of different images can not be stacked together.
+    
+    '''
+    images = argsdict['images']
+    mode = argsdict['mode'], argsdict['polar']
+    smoothing = {'mode':argsdict['smoothing'],
+                 'window':argsdict['window'],
+                 'order':argsdict['order'],
+                 } 
+    minaspest, minvesest = argsdict['aspves']
+    tiplimits = argsdict['tip']
+    extra = argsdict['extra']
+    refsx = (0, minaspest)
+    axis = argsdict['axis']
+    pipette = argsdict['pipette']
+    darktip = argsdict['darktip']
+    subpix = argsdict['subpix']
+    mismatch = argsdict['mismatch']
+    method = argsdict.get('subpixmethod', 'parabolic')
+    fallback = argsdict.get('subpixfit', False)
+    track = argsdict.get('track', False)
+    window = argsdict.get('trackwindow', TRACK_WINDOW)
+    imgN = images.shape[0]
+    
+    #reference points on pipette walls (with respective errors)
+    refs = wall_points_pix_stack(images, refsx, axis, pipette)
+    if track:
+        refs = wall_points_track(images, refs, axis, pipette, window)
+    if subpix:
+        refs = wall_points_subpix(images, refs, mismatch, method, fallback)
+    #pipette radii
+    piprads, piprads_err = line_to_line(refs)/2
+    # extract brightness profiles along the axis
+    metrics, metrics_err, profiles = line_profile_stack(images, 
+                        (refs[:,0]+refs[:,1])/2., (refs[:,2]+refs[:,3])/2.)
+    #find features positions with pixel resolution
+    if track:
+        pips, asps, vess = extract_pix_track(mode, profiles, minaspest, minvesest,
+                                             tiplimits, darktip, smoothing, window)
+    else:
+        pips, asps, vess = extract_pix_stack(mode, profiles, minaspest, minvesest, 
+                                             tiplimits, darktip, smoothing)
+    pix_err = np.ones(imgN)*PIX_ERR
+    pips_err = asps_err = vess_err = pix_err
+    if subpix:
+        (pips, pips_err), (asps, asps_err), (vess, vess_err) = extract_subpix(
+                    mode, profiles, pips, asps, vess, smoothing, mismatch, method, fallback)
+    
+    extra_out = []
+    if extra:
+        for imgindex in range(imgN):
+            extra_img = {}
+            extra_img['refs'] = refs[imgindex]
+            extra_img['piprad'] = np.asarray((piprads[imgindex], PIX_ERR))
+            extra_img['profile'] = profiles[imgindex]
+            extra_img['pip'] = pips[imgindex]
+            extra_img['asp'] = asps[imgindex]
+            extra_img['ves'] = vess[imgindex]
+            extra_out.append(extra_img)
+    
+    out = {}
+    out['metrics'] = np.asarray((metrics, metrics_err))
+    out['piprads'] = np.asarray((piprads, piprads_err))
+    out['pips'] = np.asarray((pips, pips_err))
+    out['vess'] = np.asarray((vess, vess_err))
+    out['asps'] = np.asarray((asps, asps_err))
+    return out, extra_out
+
+def locate_serial(argsdict):
+    '''Extracts features of interest from set of images, one image at a time.
+
+    Reference implementation for locate_stack, also used for subpixel resolution.
     extra_out is a list of dictionaries, with every dictionary corresponds to a single image.
 
     '''
@@ -344,6 +977,8 @@ def locate(argsdict):
 
     subpix = argsdict['subpix'] #Bool, make subpixel resolution or not
     mismatch = argsdict['mismatch'] #int or float threshold to discard sub-pix resolution 
+    method = argsdict.get('subpixmethod', 'parabolic') #estimator of subpixel positions
+    fallback = argsdict.get('subpixfit', False) #Bool, fit features where estimator fails
     extra = argsdict['extra'] #Boolean, whether to return extra outputs
 
     refsx = (0, minaspest) #where to measure pipette radius
@@ -371,7 +1006,8 @@ def locate(argsdict):
         #reference points on pipette walls (with respective errors)
         refs = wall_points_pix(img, refsx, axis, pipette)
         if subpix:
-            refs, refs_err, extra_walls = wall_points_subpix(img, refs, mode)
+            refs = wall_points_subpix(img[np.newaxis], refs[np.newaxis],
+                                      mismatch, method, fallback)[0]
         #pipette radius
         piprad, piprad_err = line_to_line(refs)/2
 
@@ -393,22 +1029,15 @@ def locate(argsdict):
             extra_img['ves'] = ves
                 
         if subpix:
-            pipfit, aspfit, vesfit = extract_subpix(mode, profile, pip, asp, ves)
+            pipfit, aspfit, vesfit = extract_subpix(mode, profile[np.newaxis],
+                                        [pip], [asp], [ves], smoothing, mismatch, method, fallback)
+            pip, pip_err = pipfit[:,0]
+            asp, asp_err = aspfit[:,0]
+            ves, ves_err = vesfit[:,0]
             if extra:
-                extra_img['walls'] = extra_walls
-                extra_img['pipfit'] = pipfit
-                extra_img['aspfit'] = aspfit
-                extra_img['vesfit'] = vesfit
-            # use subpix only if it is within mismatch from pix
-            if pipfit[-1] == 1 and np.fabs(pip - pipfit[0][2]) < mismatch:
-                pip = pipfit[0][2]
-                pip_err = fit_err(pipfit)[2]
-            if aspfit[-1] == 1 and np.fabs(asp - aspfit[0][2]) < mismatch:
-                asp = aspfit[0][2]
-                asp_err = fit_err(aspfit)[2]
-            if vesfit[-1] == 1 and np.fabs(ves - vesfit[0][2]) < mismatch:
-                ves = vesfit[0][2]
-                ves_err = fit_err(vesfit)[2]
+                extra_img['pip'] = pip
+                extra_img['asp'] = asp
+                extra_img['ves'] = ves
         #populate arrays with results
         if extra:
             extra_out.append(extra_img)
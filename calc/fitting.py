@@ -8,7 +8,7 @@ classes:
 TODO: Add other fittings (improved bending/elasticity, stochastic fitting)
 
 """
-from numpy import diag, exp, linspace, sqrt, pi, log
+from numpy import asarray, concatenate, cumsum, diag, errstate, exp, isfinite, linspace, mgrid, nan, newaxis, ones_like, sqrt, pi, log, where
 from scipy.optimize import leastsq
 from scipy.special import sici
 from scipy.stats import linregress
@@ -16,6 +16,12 @@ from scipy.odr import models, RealData, ODR, Model
 
 #implemented models for fitting tension vs dilation
 TENSFITMODELS = {}
+#linear forms of them - (transform of tension, params from slope and intercept)
+TENSLINEARFITS = {}
+#nonlinear least squares fits - (fit function of tension and dilation, params)
+TENSNLSFITS = {}
+#success flag of fitcurve.fit when some parameters stay at their initial guess
+FIT_NOT_MOVED = -1
 
 class fitcurve():
     """
@@ -53,11 +59,18 @@ class fitcurve():
         """
         Fitting method
         Correction of raw covariance matrix with standard error of the estimate is implemented.
-        returns fit results with respective standard errors, and message and success flag from leastsq
+        returns fit results with respective standard errors, and message and success flag from leastsq,
+        leastsq may report success with parameters it did not change at all
+        (e.g. too insensitive at the initial guess), then the flag is FIT_NOT_MOVED
         """
         errfunc = lambda p, x, y: y - self.func(p, x)
         fit, cov, info, mesg, success = leastsq(
             errfunc, self.pinit, (self.x, self.y), Dfun = self.Dfun, full_output=1, **self.lsq_kwargs)
+        stuck = fit == asarray(self.pinit, dtype=float)
+        if stuck.any() and success in (1, 2, 3, 4):
+            mesg = ('Parameters %s did not move from initial guess in %i function calls'%
+                    (', '.join(str(i) for i in stuck.nonzero()[0]), info['nfev']))
+            success = FIT_NOT_MOVED
         df = len(self.x)-len(fit)
         ### this correction is according to http://thread.gmane.org/gmane.comp.python.scientific.user/19482
         see = sqrt((errfunc(fit, self.x, self.y)**2).sum()/df)
@@ -126,6 +139,16 @@ def nls_Rawitz(t, alpha, flag):
     Rawitz_fit = fitcurve(f, t, alpha, pinit)
     return Rawitz_fit.fit()
 
+_FOURNIER_PARAMS = [('alpha0',r'$\alpha_0$','',''),
+                    ('kappa',r'$\kappa$','kBT','$k_B T$'),
+                    ('K','$K$','TAU_UNITS','TAU_UNITS')]
+_RAWITZ_PARAMS = [('kappa',r'$\kappa$','kBT','$k_B T$'),
+                  ('tau0',r'$\tau_0$','TAU_UNITS','TAU_UNITS'),
+                  ('K','$K$','TAU_UNITS','TAU_UNITS')]
+TENSNLSFITS['Fournier'] = (nls_Fournier, _FOURNIER_PARAMS)
+TENSNLSFITS['Rawitz sphere'] = (lambda t, alpha: nls_Rawitz(t, alpha, 'sphere'), _RAWITZ_PARAMS)
+TENSNLSFITS['Rawitz plane'] = (lambda t, alpha: nls_Rawitz(t, alpha, 'plane'), _RAWITZ_PARAMS)
+
 def linregr(x,y):
     """
     Linear regression made with stats.linregress
@@ -139,6 +162,140 @@ def linregr(x,y):
     sd_slope = see/sqrt(sx2)
     return slope, sd_slope, intercept, sd_intercept
 
+def lsq_weights(sy):
+    """
+    Least squares weights 1/sy**2 from errors of data, points with zero error
+    get the largest weight of others, all weights are 1 if no error is positive
+    """
+    sy = asarray(sy, float)
+    positive = sy > 0
+    if not positive.any():
+        return ones_like(sy)
+    with errstate(divide='ignore'):
+        return where(positive, 1/sy**2, (1/sy[positive]**2).max())
+
+def weighted_lines(x, y, weights, minpoints=3):
+    """
+    Weighted least squares straight lines along the last axis of arrays,
+    so that many data sets are fitted at once
+    Non-finite points are left out, lines through less than minpoints points are NaN.
+    Errors are scaled with the standard error of the estimate, like in linregr,
+    and are NaN for lines through less than 3 points.
+    returns slopes, their errors, intercepts and their errors
+    """
+    valid = isfinite(x) & isfinite(y)
+    weights = where(valid, weights, 0)
+    x = where(valid, x, 0)
+    y = where(valid, y, 0)
+    n = valid.sum(-1)
+    with errstate(divide='ignore', invalid='ignore'):
+        ### sums are taken around the weighted mean to avoid loss of precision
+        Sw = weights.sum(-1)
+        xmean = (weights*x).sum(-1)/Sw
+        ymean = (weights*y).sum(-1)/Sw
+        dx = where(valid, x - xmean[...,newaxis], 0)
+        dy = where(valid, y - ymean[...,newaxis], 0)
+        Sxx = (weights*dx*dx).sum(-1)
+        slope = (weights*dx*dy).sum(-1)/Sxx
+        intercept = ymean - slope*xmean
+        chi2 = (weights*(dy - slope[...,newaxis]*dx)**2).sum(-1)
+        resvar = chi2/(n - 2)
+        sd_slope = sqrt(resvar/Sxx)
+        sd_intercept = sqrt(resvar*(1/Sw + xmean*xmean/Sxx))
+    few = n < minpoints
+    nodof = n < 3
+    return (where(few, nan, slope), where(few | nodof, nan, sd_slope),
+            where(few, nan, intercept), where(few | nodof, nan, sd_intercept))
+
+class RangeFits():
+    """
+    Least squares straight line fits of all contiguous sub-ranges of data.
+    Cumulative sums of data are calculated once, after that fit of any range
+    takes constant time, and fits of all ranges are calculated as arrays at once.
+    """
+    def __init__(self, x, y, sy=None):
+        """
+        Constructor method
+        @params x, y: 1d-numpy arrays of data to fit, non-finite points are left out
+        @param sy: errors of y giving weights 1/sy**2,
+                   points with zero error get the largest weight of others
+        """
+        x = asarray(x, float)
+        y = asarray(y, float)
+        valid = isfinite(x) & isfinite(y)
+        if sy is None:
+            weights = ones_like(x)
+        else:
+            weights = lsq_weights(sy)
+        weights = where(valid, weights, 0)
+        ### sums are taken around the mean to avoid loss of precision on subtraction
+        self.xmean = x[valid].mean()
+        self.ymean = y[valid].mean()
+        x = where(valid, x - self.xmean, 0)
+        y = where(valid, y - self.ymean, 0)
+        sums = (valid, weights, weights*x, weights*y, weights*x*x, weights*x*y, weights*y*y)
+        self.cumsums = [concatenate(([0], cumsum(s))) for s in sums]
+        self.size = len(x)
+    
+    def fit(self, low, high, minpoints=3):
+        """
+        Fit of data[low:high], low and high can be arrays of indices
+        returns slope, its error, intercept and its error, NaN for ranges
+        with less than minpoints points
+        Errors are scaled with the standard error of the estimate, like in linregr.
+        """
+        n, Sw, Sx, Sy, Sxx, Sxy, Syy = [c[high] - c[low] for c in self.cumsums]
+        with errstate(divide='ignore', invalid='ignore'):
+            det = Sw*Sxx - Sx*Sx
+            slope = (Sw*Sxy - Sx*Sy)/det
+            intercept = (Sy - slope*Sx)/Sw
+            chi2 = (Syy - 2*slope*Sxy - 2*intercept*Sy + slope*slope*Sxx +
+                    2*slope*intercept*Sx + intercept*intercept*Sw)
+            resvar = where(chi2 > 0, chi2, 0)/(n - 2)
+            sd_slope = sqrt(resvar*Sw/det)
+            sd_intercept = sqrt(resvar*(Sxx + 2*self.xmean*Sx + self.xmean**2*Sw)/det)
+            intercept = intercept + self.ymean - slope*self.xmean
+        few = n < max(minpoints, 3)
+        return [where(few, nan, value) for value in (slope, sd_slope, intercept, sd_intercept)]
+    
+    def fit_all(self, minpoints=3):
+        """
+        Fits of all ranges, returns 2d-arrays as fit, indexed with [low, high]
+        for the range data[low:high]
+        """
+        low, high = mgrid[0:self.size+1, 0:self.size+1]
+        return self.fit(low, high, minpoints)
+
+def range_fits(tension, dilation, modelname, minpoints=3):
+    """
+    Fits of tension model for all ranges of data, see RangeFits
+    @param tension, dilation: 2xN arrays of values and errors
+    @param modelname: name of model in TENSLINEARFITS
+    returns 3d-arrays of fitted parameters and their errors,
+    indexed with [param, low, high] for the range data[low:high]
+    """
+    transform, fromline = TENSLINEARFITS[modelname]
+    with errstate(divide='ignore', invalid='ignore'):
+        x = transform(tension[0])
+    fits = RangeFits(x, dilation[0], dilation[1])
+    with errstate(divide='ignore', invalid='ignore', over='ignore'):
+        fit, sd_fit = fromline(*fits.fit_all(minpoints))
+    return asarray(fit), asarray(sd_fit)
+
+def param_units(params, tensdim):
+    """
+    Descriptions of fitted parameters from model meta with units of tension
+    in place of TAU_UNITS
+    @param params: list of (name, texname, units, texunits)
+    @param tensdim: (units, texunits) of tension
+    """
+    described = []
+    for name, texname, dim, texdim in params:
+        if dim == 'TAU_UNITS':
+            dim, texdim = tensdim
+        described.append((name, texname, dim, texdim))
+    return described
+
 def fit_nlsLinear(x, y):
     """
     Linear regression of data made with ONLS
@@ -173,8 +330,49 @@ def fit_gauss(y, sgn):
     gauss_fit = fitcurve(gauss, x, y, pinit)
     return gauss_fit.fit()
 
-def fit_err(*args):
-    return
+def fit_err(fit):
+    """
+    Standard errors of fitted parameters from results of fitcurve.fit,
+    None if they could not be estimated
+    """
+    params, stderr, mesg, success = fit
+    return stderr
+
+def _line_est(x, y):
+    '''slope and intercept of straight line through data, for initial estimates'''
+    if len(x) > 2:
+        slope, sd_slope, intercept, sd_intercept = linregr(x, y)
+    elif len(x) == 2 and x[1] != x[0]:
+        slope = (y[1]-y[0])/(x[1]-x[0])
+        intercept = y[0] - slope*x[0]
+    else:
+        slope, intercept = 0, 0
+    return slope, intercept
+
+def check_jacobians(model, beta, x, step=1e-6):
+    """
+    Compare analytic Jacobians of ODR model with central finite differences
+    @param model: scipy.odr.Model with fjacb and fjacd
+    @param beta: parameters to check Jacobians at
+    @param x: 1d-numpy array of points to check Jacobians at
+    returns largest relative errors of fjacb and fjacd
+    """
+    beta = asarray(beta, float)
+    x = asarray(x, float)
+    fcn = model.fcn
+    numjacb = []
+    for i in range(len(beta)):
+        h = step*(abs(beta[i]) or 1)
+        bplus, bminus = beta.copy(), beta.copy()
+        bplus[i] += h
+        bminus[i] -= h
+        numjacb.append((fcn(bplus, x) - fcn(bminus, x))/(2*h))
+    numjacb = asarray(numjacb)
+    h = step*abs(x) + step*(x == 0)
+    numjacd = (fcn(beta, x+h) - fcn(beta, x-h))/(2*h)
+    errb = abs(model.fjacb(beta, x) - numjacb).max()/abs(numjacb).max()
+    errd = abs(model.fjacd(beta, x) - numjacd).max()/abs(numjacd).max()
+    return errb, errd
 #===============================================================================
 # Evans Model for dilation vs tension
 #===============================================================================
@@ -182,13 +380,21 @@ def bend_evans_fcn(B, x):
     return 1/(8*pi*B[0])*log(x/B[1])
 
 def _bend_evans_fjb(B,x):
-    return
+    kappa, tau0 = B
+    return asarray((-log(x/tau0)/(8*pi*kappa*kappa),
+                    -ones_like(x)/(8*pi*kappa*tau0)))
 
 def _bend_evans_fjd(B,x):
-    return
+    return 1/(8*pi*B[0]*x)
 
-def _bend_evans_est(x):
-    return [1,1]
+def _bend_evans_est(data):
+    ### alpha is linear in log(tau), slope is 1/(8*pi*kappa)
+    x, y = data.x, data.y
+    positive = x > 0
+    slope, intercept = _line_est(log(x[positive]), y[positive])
+    if not slope > 0:
+        return [1,1]
+    return [1/(8*pi*slope), exp(-intercept/slope)]
 
 def _bend_evans_meta():
     return {'name':'Classical Evans model',
@@ -197,11 +403,18 @@ def _bend_evans_meta():
             'equ':['alpha = 1/(8*pi*kappa)*log(tau/tau0)',
                    r'$\alpha = \frac{1}{8*pi*\kappa}*\ln{\frac{\tau}{\tau_0}}$']}
 
-#bend_evans_model = Model(bend_evans_fcn, fjacd=_bend_evans_fjd, fjacb=_bend_evans_fjb,
-#                  estimate=_bend_evans_est, meta=_bend_evans_meta())
-bend_evans_model = Model(bend_evans_fcn,
+def _bend_evans_from_line(slope, sd_slope, intercept, sd_intercept):
+    ### line of alpha vs log(tau)
+    kappa = 1/(8*pi*slope)
+    tau0 = exp(-intercept/slope)
+    sd_kappa = sd_slope/(8*pi*slope*slope)
+    sd_tau0 = tau0*sqrt((sd_intercept/slope)**2 + (intercept*sd_slope/slope**2)**2)
+    return (kappa, tau0), (sd_kappa, sd_tau0)
+
+bend_evans_model = Model(bend_evans_fcn, fjacd=_bend_evans_fjd, fjacb=_bend_evans_fjb,
                   estimate=_bend_evans_est, meta=_bend_evans_meta())
 TENSFITMODELS['Bend Evans'] = bend_evans_model
+TENSLINEARFITS['Bend Evans'] = (log, _bend_evans_from_line)
 #------------------------------------------------------------------------------ 
 
 #===============================================================================
@@ -211,13 +424,17 @@ def stretch_simple_fcn(B,x):
     return x/B[0]+B[1]
 
 def _stretch_simple_fjb(B,x):
-    return 
+    return asarray((-x/(B[0]*B[0]), ones_like(x)))
 
 def _stretch_simple_fjd(B,x):
-    return 
+    return ones_like(x)/B[0]
 
-def _stretch_simple_est(x):
-    return [1,1]
+def _stretch_simple_est(data):
+    ### alpha is linear in tau, slope is 1/K
+    slope, intercept = _line_est(data.x, data.y)
+    if not slope > 0:
+        return [1,1]
+    return [1/slope, intercept]
 
 def _stretch_simple_meta():
     return {'name':'Simple elastic stretching model',
@@ -226,11 +443,21 @@ def _stretch_simple_meta():
             'equ':['alpha = tau/K+alpha0',
                    r'$\alpha = \frac{\tau}{K}+\alpha_0$']}
     
-stretch_simple_model = Model(stretch_simple_fcn,
+stretch_simple_model = Model(stretch_simple_fcn, fjacd=_stretch_simple_fjd, fjacb=_stretch_simple_fjb,
                   estimate=_stretch_simple_est, meta=_stretch_simple_meta())
 
 TENSFITMODELS['Stretch simple'] = stretch_simple_model
+
+def _stretch_simple_from_line(slope, sd_slope, intercept, sd_intercept):
+    ### line of alpha vs tau
+    return (1/slope, intercept), (sd_slope/(slope*slope), sd_intercept)
+
+TENSLINEARFITS['Stretch simple'] = (lambda x: x, _stretch_simple_from_line)
 #------------------------------------------------------------------------------
 
 if __name__ == '__main__':
     print __doc__
+    ### check analytic Jacobians of tension fit models
+    for name, model in sorted(TENSFITMODELS.items()):
+        print '%s: fjacb error %g, fjacd error %g'%(
+                    (name,) + check_jacobians(model, (20, 1e-3), linspace(0.01, 1, 20)))
@@ -2,14 +2,28 @@
 """
 loading of various data for VAMP project
 """
-import os
+import glob, hashlib, multiprocessing, os, struct
+from multiprocessing.pool import ThreadPool
 import numpy as np
 ### for loading images to numpy arrays with PIL
 from scipy import misc
-from calc.common import PIX_ERR
+from calc.common import PIX_ERR, SIDES, STACK_CACHE_PREFIX
+from calc.cache import files_digest
+from calc.features import SPLINE_MARGIN
 
-def read_grey_image(filename):
-    '''read single greyscale image'''
+# rows kept beyond pipette walls and SPLINE_MARGIN in the region of interest,
+# for the axis found on images to deviate from its estimate
+ROI_MARGIN = 16
+
+def read_grey_image(filename, region=None):
+    '''read single greyscale image
+    
+    only the region (see crop_region) is kept if it is given,
+    uncompressed TIFF images are read straight from the file (see _map_grey_image)
+    '''
+    mapped = _map_grey_image(filename, region)
+    if mapped is not None:
+        return np.array(mapped, mapped.dtype.newbyteorder('=')), None
     mesg = None
     try:
         img = misc.imread(filename) #8bit as uint8, 16bit as int32
@@ -23,8 +37,441 @@ def read_grey_image(filename):
     ### check if the image was more than 8-bit - scipy/PIL has a bug on it
     if img.dtype == np.int32:
         img = np.asarray(np.asfarray(img), np.int32)
+    if region is not None:
+        img = crop_region(img, region)
     return img, mesg
 
+def _map_grey_image(filename, region=None):
+    '''memory-map the region of uncompressed greyscale TIFF image read-only
+    
+    returns None if the image must be decoded instead
+    '''
+    if os.path.splitext(filename)[1].lower() not in ('.tif', '.tiff'):
+        return None
+    try:
+        pages, byteorder = _tiff_pages(filename)
+    except (IOError, ValueError, struct.error):
+        return None
+    if not pages:
+        return None
+    images, mesg = _map_tiff_pages(filename, pages[:1], byteorder)
+    if images is None:
+        return None
+    if region is not None:
+        return crop_region(images[0], region)
+    return images[0]
+
+def read_image_stack(filenames, folder=None, progress=None, region=None):
+    '''read stack of greyscale images of the same size
+    
+    If folder is given, decoded images are stored there once as a .npy file
+    (see stack_cache_name) and next time are just memory-mapped from it
+    read-only, so that stacks larger than RAM can be opened as well.
+    With the region given, only the region of images is kept and cached.
+    @param filenames: list of image file names
+    @param folder: folder to keep the cache in
+    @param progress: callable accepting number of images read so far,
+                     loading is cancelled if it returns False 
+    @param region: (top, bottom, left, right) of images, see roi_region
+    returns 3d array of images and error message if any
+    '''
+    if folder is not None:
+        images = open_stack_cache(folder, filenames, region)
+        if images is not None:
+            return images, None
+    test, mesg = read_grey_image(filenames[0], region)
+    if mesg:
+        return None, mesg
+    shape = (len(filenames),) + test.shape
+    cachename = None
+    if folder is not None:
+        cachename = stack_cache_name(folder, filenames, region)
+        try:
+            images = np.lib.format.open_memmap(cachename+'.part', mode='w+',
+                                               dtype=test.dtype, shape=shape)
+        except (IOError, OSError):
+            cachename = None  # e.g. read-only folder, load into memory
+    if cachename is None:
+        try:
+            images = np.empty(shape, test.dtype)
+        except MemoryError:
+            return None, 'Not enough memory to load images.'
+    
+    stack, mesg = read_grey_stack(filenames, images, progress=progress, region=region)
+    if cachename is None:
+        return stack, mesg
+    images.flush()
+    del images, stack  # close the memory map before renaming the file
+    if mesg:
+        os.remove(cachename+'.part')
+        return None, mesg
+    os.rename(cachename+'.part', cachename)
+    remove_stale_caches(folder, filenames)
+    return np.load(cachename, mmap_mode='r'), None
+
+def iter_grey_images(filenames, orientation=None, crop=None, region=None):
+    '''generate greyscale images one by one from files
+    
+    Images are preprocessed (see preproc_images) if orientation and crop
+    are given, after only the region of them is kept if it is given.
+    Raises IOError with the message of read_grey_image on failure.
+    '''
+    for filename in filenames:
+        img, mesg = read_grey_image(filename, region)
+        if mesg:
+            raise IOError(mesg)
+        if orientation is not None and crop is not None:
+            img = preproc_images(img[np.newaxis], orientation, crop)[0]
+        yield img
+
+def read_grey_stack(filenames, out=None, workers=None, progress=None, region=None):
+    '''read greyscale images of the same size concurrently
+    
+    Images are read on a pool of threads, every image is written into
+    its place in the output array. Uncompressed TIFF images are copied there
+    straight from the file (see _map_grey_image), others are decoded first.
+    @param filenames: list of image file names
+    @param out: preallocated array of shape (N,H,W) to put images into
+    @param workers: number of threads, default is number of CPUs
+    @param progress: callable accepting number of images read so far,
+                     loading is cancelled if it returns False 
+    @param region: (top, bottom, left, right) of images to keep, see roi_region
+    returns 3d array of images (None on failure) and error message if any
+    '''
+    if out is None:
+        test, mesg = read_grey_image(filenames[0], region)
+        if mesg:
+            return None, mesg
+        try:
+            out = np.empty((len(filenames),) + test.shape, test.dtype)
+        except MemoryError:
+            return None, 'Not enough memory to load images.'
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    
+    def read_into(task):
+        index, filename = task
+        img = _map_grey_image(filename, region)
+        if img is None:
+            img, mesg = read_grey_image(filename, region)
+            if mesg:
+                return mesg
+        ### test that the image has the same shape as others
+        if img.shape != out.shape[1:]:
+            return 'Error: Images have different dimensions!'
+        out[index] = img
+    
+    mesg = None
+    pool = ThreadPool(workers)
+    try:
+        results = pool.imap_unordered(read_into, enumerate(filenames))
+        for count, mesg in enumerate(results):
+            if mesg:
+                break
+            if progress is not None and not progress(count+1):
+                mesg = 'Progress cancelled! Not all images have been loaded.'
+                break
+    finally:
+        pool.terminate()
+        pool.join()
+    if mesg:
+        return None, mesg
+    return out, None
+
+def read_stack_file(filename, rawshape=None, rawheader=0, region=None):
+    '''read stack of images stored in a single file
+    
+    multi-page TIFF files (.tif, .tiff) are read with read_tiff_stack,
+    anything else is considered to be a raw stream (see read_raw_stream).
+    With the region given, memory-mapped stacks are only viewed in it,
+    so that nothing outside of the region is ever read from the file.
+    returns 3d array of images and error message if any
+    '''
+    ext = os.path.splitext(filename)[1].lower()
+    if ext in ('.tif', '.tiff'):
+        images, mesg = read_tiff_stack(filename, region)
+    else:
+        images, mesg = read_raw_stream(filename, rawshape, rawheader)
+    if images is not None and region is not None and images.shape[1:] != region_shape(region):
+        images = crop_region(images, region)
+    return images, mesg
+
+def read_raw_stream(filename, shape, header=0, dtype='<u2'):
+    '''memory-map raw stream of frames as read-only 3d array
+    
+    The stream is a header of fixed size followed by frames of the same size,
+    incomplete frame at the end of the stream is ignored.
+    @param shape: (height, width) of a frame in pixels
+    @param header: size of the header in bytes
+    @param dtype: data type of pixels, 16-bit little-endian by default
+    returns 3d array of images and error message if any
+    '''
+    if shape is None or len(shape) != 2:
+        return None, 'Error: Frame size of raw stream %s is unknown!'%filename
+    try:
+        size = os.path.getsize(filename)
+    except OSError:
+        return None, "Error: Can't open file %s!"%filename
+    framesize = shape[0] * shape[1] * np.dtype(dtype).itemsize
+    imgN = (size - header) // framesize
+    if imgN < 1:
+        return None, 'Error: No complete frames in file %s!'%filename
+    images = np.memmap(filename, dtype=dtype, mode='r', offset=header,
+                       shape=(imgN, shape[0], shape[1]))
+    return images, None
+
+def read_tiff_stack(filename, region=None):
+    '''read multi-page greyscale TIFF file as 3d array
+    
+    Uncompressed pages of the same size evenly spaced in the file
+    (as acquisition software writes them) are memory-mapped read-only
+    without reading anything, otherwise all pages are decoded to memory,
+    keeping only the region of them if it is given.
+    returns 3d array of images and error message if any
+    '''
+    try:
+        pages, byteorder = _tiff_pages(filename)
+    except IOError:
+        return None, "Error: Can't open file %s!"%filename
+    except (ValueError, struct.error):
+        pages = None  # not a plain TIFF, let PIL try it
+    if pages:
+        images, mesg = _map_tiff_pages(filename, pages, byteorder)
+        if images is not None or mesg:
+            return images, mesg
+    return _decode_tiff_pages(filename, region)
+
+TIFF_TAGS = {256:'width', 257:'height', 258:'bits', 259:'compression',
+             273:'offsets', 277:'samples', 279:'counts', 339:'format'}
+TIFF_TYPES = {1:'B', 3:'H', 4:'I'}
+
+def _tiff_pages(filename):
+    '''parse IFDs of (classic) TIFF file
+    
+    returns list of dictionaries of tags from TIFF_TAGS, one per page,
+    and byte order of the file as numpy dtype prefix
+    '''
+    tiff = open(filename, 'rb')
+    try:
+        order = {'II':'<', 'MM':'>'}[tiff.read(2)]
+        magic, ifd = struct.unpack(order+'HI', tiff.read(6))
+        if magic != 42:
+            raise ValueError('not a classic TIFF file')
+        pages = []
+        while ifd:
+            tiff.seek(ifd)
+            count, = struct.unpack(order+'H', tiff.read(2))
+            entries = tiff.read(12*count)
+            ifd, = struct.unpack(order+'I', tiff.read(4))
+            page = {'compression':1, 'samples':1, 'format':1, 'bits':1}
+            for index in range(count):
+                tag, valtype, N, value = struct.unpack(order+'HHI4s',
+                                                    entries[12*index:12*index+12])
+                if tag not in TIFF_TAGS or valtype not in TIFF_TYPES:
+                    continue
+                fmt = order + N*TIFF_TYPES[valtype]
+                if struct.calcsize(fmt) > 4:
+                    tiff.seek(struct.unpack(order+'I', value)[0])
+                    value = tiff.read(struct.calcsize(fmt))
+                else:
+                    value = value[:struct.calcsize(fmt)]
+                values = struct.unpack(fmt, value)
+                if TIFF_TAGS[tag] in ('offsets', 'counts'):
+                    page[TIFF_TAGS[tag]] = values
+                else:
+                    page[TIFF_TAGS[tag]] = values[0]
+            pages.append(page)
+    finally:
+        tiff.close()
+    return pages, order
+
+def _map_tiff_pages(filename, pages, byteorder):
+    '''memory-map pages of TIFF file as 3d array if the layout allows it
+    
+    returns None without error message if pages must be decoded instead
+    '''
+    first = pages[0]
+    if first['samples'] != 1:
+        return None, 'Error: file %s is not greyscale!'%filename
+    if first['bits'] not in (8, 16, 32) or first['format'] not in (1, 2, 3):
+        return None, None
+    dtype = np.dtype(byteorder + 'uif'[first['format']-1] + str(first['bits']//8))
+    shape = first['height'], first['width']
+    framesize = shape[0] * shape[1] * dtype.itemsize
+    starts = []
+    for page in pages:
+        for key in ('width', 'height', 'bits', 'format', 'samples', 'compression'):
+            if page.get(key) != first.get(key):
+                return None, None
+        offsets, counts = page.get('offsets'), page.get('counts')
+        if page['compression'] != 1 or not offsets or sum(counts) < framesize:
+            return None, None
+        # strips of the page must follow each other
+        for index in range(len(offsets)-1):
+            if offsets[index] + counts[index] != offsets[index+1]:
+                return None, None
+        starts.append(offsets[0])
+    step = starts[1] - starts[0] if len(starts) > 1 else framesize
+    if step < framesize or np.any(np.diff(starts) != step):
+        return None, None
+    filebytes = np.memmap(filename, dtype=np.uint8, mode='r')
+    images = np.ndarray((len(pages),) + shape, dtype, filebytes, starts[0],
+                        (step, shape[1]*dtype.itemsize, dtype.itemsize))
+    return images, None
+
+def _decode_tiff_pages(filename, region=None):
+    '''decode all pages of multi-page TIFF file to memory with PIL'''
+    from PIL import Image
+    try:
+        tiff = Image.open(filename)
+        first = np.asarray(tiff)
+    except IOError:
+        return None, "Error: Can't open file %s!"%filename
+    if first.ndim > 2:
+        return None, 'Error: file %s is not greyscale!'%filename
+    imgN = getattr(tiff, 'n_frames', 1)
+    shape = first.shape
+    if region is not None:
+        shape = crop_region(first, region).shape
+    try:
+        images = np.empty((imgN,) + shape, first.dtype)
+    except MemoryError:
+        return None, 'Not enough memory to load images.'
+    for index in range(imgN):
+        tiff.seek(index)
+        img = np.asarray(tiff)
+        if img.shape != first.shape:
+            return None, 'Error: Images have different dimensions!'
+        if region is not None:
+            img = crop_region(img, region)
+        images[index] = img
+    return images, None
+
+def stack_cache_name(folder, filenames, region=None):
+    '''name of the cache file for the stack of images
+    
+    The name starts with hash of names of image files (see stack_cache_group),
+    followed by hash of their names, modification times and sizes,
+    so that any change to them invalidates the cache,
+    and the region of images if only it is cached.
+    '''
+    name = stack_cache_group(filenames)+files_digest(filenames)
+    if region is not None:
+        name += '-roi%i-%i-%i-%i'%tuple(region)
+    return os.path.join(folder, name+'.npy')
+
+def stack_cache_group(filenames):
+    '''common start of names of caches of these image files, whatever their content'''
+    names = '\n'.join([os.path.basename(filename) for filename in filenames])
+    return STACK_CACHE_PREFIX+hashlib.md5(names).hexdigest()[:8]+'-'
+
+def remove_stale_caches(folder, filenames):
+    '''remove caches of earlier versions of these image files
+    
+    Caches of other files, and of other regions of the same files, are kept.
+    Caches still memory-mapped (which can not be removed on Windows) are
+    left for the next time.
+    '''
+    current = stack_cache_group(filenames)+files_digest(filenames)
+    for cachename in glob.glob(os.path.join(folder, stack_cache_group(filenames)+'*.npy')):
+        if not os.path.basename(cachename).startswith(current):
+            try:
+                os.remove(cachename)
+            except OSError:
+                pass
+
+def open_stack_cache(folder, filenames, region=None):
+    '''memory-map cached stack of images read-only, None if there is no valid cache'''
+    try:
+        images = np.load(stack_cache_name(folder, filenames, region), mmap_mode='r')
+    except (IOError, OSError, ValueError):
+        return None
+    if images.ndim != 3 or images.shape[0] != len(filenames):
+        return None
+    if region is not None and images.shape[1:] != region_shape(region):
+        return None
+    return images
+
+def frame_shape(filename, rawshape=None):
+    '''(height, width) of images in the file, read from its header without decoding
+    
+    @param rawshape: frame size of raw streams (see read_stack_file),
+                     returned for files other than TIFF when it is given
+    returns shape and error message if any
+    '''
+    from PIL import Image
+    ext = os.path.splitext(filename)[1].lower()
+    if rawshape is not None and ext not in ('.tif', '.tiff'):
+        if len(rawshape) != 2:
+            return None, 'Error: Frame size of raw stream %s is unknown!'%filename
+        return tuple(rawshape), None
+    try:
+        width, height = Image.open(filename).size
+    except IOError:
+        return None, "Error: Can't open file %s!"%filename
+    return (height, width), None
+
+def roi_region(shape, params, margin=ROI_MARGIN):
+    '''Region of interest of raw images for features.locate
+    
+    Walls are searched for on two columns near the axis estimate,
+    and brightness is profiled along the axis through the whole image,
+    so only a band of rows of preprocessed images is ever used. The band covers
+    the axis estimate over the whole width, pipette walls, SPLINE_MARGIN of
+    profile interpolation and the margin.
+    @param shape: (height, width) of raw images
+    @param params: 'orient', 'crop', 'axis', 'pipette' and 'aspves' as for locate
+    returns (top, bottom, left, right) of the region on raw images
+    and (first, last) rows of the band on preprocessed images
+    '''
+    sizey, sizex = shape
+    crop = params['crop']
+    top, bottom = crop['top'], sizey - crop['bottom']
+    left, right = crop['left'], sizex - crop['right']
+    orientation = params['orient']
+    height, width = bottom - top, right - left
+    if orientation in ('top', 'bottom'):
+        height, width = width, height
+    axis = params['axis']
+    piprad, pipthick = params['pipette']
+    slope = (axis[1] - axis[0]) / float(max(params['aspves'][0], 1))
+    ends = (axis[0], axis[1], axis[0] + slope * (width - 1))
+    half = piprad + pipthick + SPLINE_MARGIN + margin
+    first = max(0, int(np.floor(min(ends))) - half)
+    last = min(height, int(np.ceil(max(ends))) + half + 1)
+    ### rows of preprocessed images to raw ones, as rotated by preproc_images
+    if orientation == 'right':
+        region = bottom - last, bottom - first, left, right
+    elif orientation == 'top':
+        region = top, bottom, right - last, right - first
+    elif orientation == 'bottom':
+        region = top, bottom, left + first, left + last
+    else:
+        region = top + first, top + last, left, right
+    return region, (first, last)
+
+def roi_params(params, rows):
+    '''parameters of locate for images read in the region given by roi_region
+    
+    The region is already cropped, and the axis is moved to the band of rows,
+    positions of features along the axis are the same as on whole images
+    (errors of subpixel wall positions come from noise of the band only).
+    '''
+    roiparams = dict(params)
+    roiparams['crop'] = dict([(side, 0) for side in SIDES])
+    roiparams['axis'] = [y - rows[0] for y in params['axis']]
+    return roiparams
+
+def crop_region(images, region):
+    '''view of the region (top, bottom, left, right) of every image'''
+    top, bottom, left, right = region
+    return images[..., top:bottom, left:right]
+
+def region_shape(region):
+    '''(height, width) of images in the region'''
+    top, bottom, left, right = region
+    return bottom - top, right - left
+
 def read_conf_file(filename):
     imgcfg = {}
     try:
@@ -42,22 +489,25 @@ def preproc_images(images, orientation, crop):
     '''prepocess images
     orientations - member of vampy.SIDES
     crop - dictionary with keys as vampy.SIDES,
-           with respective relative crop amounts'''
+           with respective relative crop amounts
+    
+    Returns strided view of images, so that nothing is copied or calculated
+    and it takes the same time for stacks of any size (memory-mapped too).
+    The transform is effectively applied to the frame only when it is used.
+    '''
+    imgN, sizey, sizex = images.shape
     ### crop image
-    crop['bottom'] = images.shape[1] - crop['bottom']
-    crop['right'] = images.shape[2] - crop['right']
-    images = images[:, crop['top']:crop['bottom'], 
-                    crop['left']:crop['right']]
+    images = images[:, crop['top']:sizey-crop['bottom'], 
+                    crop['left']:sizex-crop['right']]
     
-    ### rotate according to orientation flag
-    rolled = np.rollaxis(np.rollaxis(images, 1), 2, 1)  # make first axis last
+    ### rotate according to orientation flag, so that pipette is on the left
     if orientation == 'right':
-        rolled = np.rot90(rolled, 2)  # rot90 rotates only 2 first axes
-    if orientation == 'top':
-        rolled = np.rot90(rolled, 1)
+        images = images[:, ::-1, ::-1]
+    elif orientation == 'top':
+        images = images[:, :, ::-1].swapaxes(1, 2)
     elif orientation == 'bottom':
-        rolled = np.rot90(rolled, 3)
-    return np.rollaxis(rolled, 2)  # bring original first axis back from last
+        images = images[:, ::-1, :].swapaxes(1, 2)
+    return images
 
 def read_pressures_file(filename, stage):
     """
@@ -97,7 +547,7 @@ def read_pressures_filenames(filenames, stage):
         pressures = map(float, press)
     except ValueError:
         mesg = 'Wrong filenames format!'
-        return None, mesg
+        return None, None, mesg
     #reduce sequences of identical values to respective single value
     pressure = [
             x for i,x in enumerate(pressures) if i == 0 or x != pressures[i-1]]
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+'''Part of VAMP project, only for import.
+
+Analysis of an experiment as a chain of stages
+    images -> features -> geometry -> averaged geometry -> tensions -> fit
+where every stage is recalculated only if its own parameters
+or any stage upstream of it have changed.
+
+prerequisites - installed numpy, scipy
+'''
+from analysis import get_geometry, averageImages, TensionFitModel, TENSMODELS
+from cache import ResultCache, stage_key
+from fitting import TENSFITMODELS
+from resample import fit_uncertainty
+import features
+
+STAGES = ('features', 'geometry', 'averaged', 'tensions', 'fit', 'uncertainty')
+# stage: (stage it is calculated from, names of its own parameters)
+DEPENDS = {'features':(None, ('locate',)),
+           'geometry':('features', ()),
+           'averaged':('geometry', ('aver',)),
+           'tensions':('averaged', ('tensmodel', 'pressures', 'pressacc', 'scale')),
+           'fit':('tensions', ('fitmodel', 'fitrange')),
+           'uncertainty':('tensions', ('fitmodel', 'fitrange', 'resample', 'samples',
+                                       'exact')),
+           }
+# averaging is cheaper than loading its result from disk
+DISK_CACHED = ('features', 'geometry', 'tensions', 'fit', 'uncertainty')
+
+class AnalysisPipeline(object):
+    '''Lazily calculated results of analysis stages
+
+    Parameters are set with set():
+    images - preprocessed images, or frames - function returning iterable
+    of preprocessed images read one by one instead (see features.locate_stream),
+    imagekey - identity of image files
+    (see cache.files_digest), locate - parameters of features.locate
+    other than images, aver - number of images per pressure,
+    tensmodel - name of tension model from TENSMODELS, pressures, pressacc, scale,
+    fitmodel - name of model from TENSFITMODELS, fitrange - (low, high)
+    numbers (starting from 1) of first and last tensions fitted or None for all,
+    resample - resampling method, samples - number of resampled data sets,
+    exact - refit them by ODR or by linear forms of models
+    (see resample.fit_uncertainty), workers - processes locating features
+    (see features.locate), which does not change any result.
+
+    Results are requested with get(stage), which returns result of the stage
+    and error message if any. Every result is kept in memory with the key of
+    everything it depends on (see cache.stage_key), and is recalculated only
+    when the key has changed. With the cache given, results are also stored
+    on disk and survive between sessions.
+    '''
+    def __init__(self, cache=None):
+        self.cache = cache or ResultCache(None)
+        self.params = {}
+        self.results = {}  # stage: (key, (result, mesg))
+        self.roots = {}  # stage: key, for stages with results given by start_at
+
+    def set(self, **params):
+        self.params.update(params)
+
+    def start_at(self, stage, result, key):
+        '''start the chain at the stage with known result (e.g. read from file)
+
+        key identifies the result, stages upstream of it are not used
+        '''
+        self.roots[stage] = key
+        self.results[stage] = key, (result, None)
+
+    def copy(self):
+        '''independent pipeline sharing results calculated so far'''
+        other = AnalysisPipeline(self.cache)
+        other.params = dict(self.params)
+        other.results = dict(self.results)
+        other.roots = dict(self.roots)
+        return other
+
+    def key(self, stage):
+        '''key of the stage results with current parameters'''
+        if stage in self.roots:
+            return self.roots[stage]
+        parent, names = DEPENDS[stage]
+        if parent is None:
+            parentkey = self.params['imagekey']
+        else:
+            parentkey = self.key(parent)
+        params = dict([(name, self.params[name]) for name in names])
+        return stage_key(stage, parentkey, params)
+
+    def get(self, stage):
+        '''result of the stage and error message if any'''
+        key = self.key(stage)
+        if stage in self.results and self.results[stage][0] == key:
+            return self.results[stage][1]
+        parent = DEPENDS[stage][0]
+        if parent is None:
+            parentresult = self.params.get('images')
+        else:
+            parentresult, mesg = self.get(parent)
+            if mesg:
+                return None, mesg
+        result = None
+        if stage in DISK_CACHED:
+            result = self.cache.get(key)
+        if result is None:
+            result = getattr(self, '_'+stage)(parentresult)
+            if stage in DISK_CACHED and not result[1]:
+                self.cache.put(key, result)
+        self.results[stage] = key, result
+        return result
+
+    def _features(self, images):
+        argsdict = dict(self.params['locate'])
+        argsdict['workers'] = self.params.get('workers', 1)
+        if self.params.get('frames') is not None:
+            return features.locate_stream(self.params['frames'](), argsdict), None
+        argsdict['images'] = images
+        return features.locate(argsdict), None
+
+    def _geometry(self, located):
+        out, extra_out = located
+        return get_geometry(out)
+
+    def _averaged(self, geometry):
+        return averageImages(self.params['aver'], **geometry), None
+
+    def _tensions(self, avergeom):
+        model = TENSMODELS[self.params['tensmodel']]
+        return model(self.params['pressures'], self.params['pressacc'],
+                     self.params['scale'], avergeom), None
+
+    def _fit_range(self, tensions):
+        '''tension and dilation in the fit range'''
+        low, high = self.params['fitrange'] or (1, tensions['tension'].shape[-1])
+        return tensions['tension'][:,low-1:high], tensions['dilation'][:,low-1:high]
+
+    def _fit(self, tensions):
+        datax, datay = self._fit_range(tensions)
+        fitmodel = TensionFitModel(datax, datay, TENSFITMODELS[self.params['fitmodel']],
+                                   tensions['tensdim'])
+        return fitmodel.fit(), None
+
+    def _uncertainty(self, tensions):
+        datax, datay = self._fit_range(tensions)
+        return fit_uncertainty(datax, datay, self.params['fitmodel'], tensions['tensdim'],
+                               self.params['resample'], self.params['samples'],
+                               exact=self.params['exact'],
+                               workers=self.params.get('workers', 1))
+
+if __name__ == '__main__':
+    # this is executed only if this source file is run separately
+    # and not imported as module to another source file.
+    print __doc__
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+'''Part of VAMP project, only for import.
+
+Fits of tension models to many vesicles at once, for population statistics.
+
+Tensions and dilations of all vesicles are stacked as 2 x vesicles x points
+arrays of values and errors, series of different lengths are padded with NaN
+(see stack_series). Models with linear forms (fitting.TENSLINEARFITS) are
+fitted to all vesicles at once as weighted least squares lines, which leave out
+errors of tension. Nonlinear least squares models (fitting.TENSNLSFITS) and
+exact ODR fits of TENSFITMODELS are run on a pool of processes instead.
+
+prerequisites - installed numpy, scipy
+'''
+import multiprocessing
+
+import numpy as np
+
+from analysis import TensionFitModel
+from fitting import TENSFITMODELS, TENSLINEARFITS, TENSNLSFITS
+from fitting import lsq_weights, param_units, weighted_lines
+
+CHUNKS_PER_WORKER = 4
+
+def stack_series(serieslist):
+    '''stack 2xN arrays of values and errors of different N into 2 x len x maxN array,
+    missing points are NaN
+    '''
+    size = max([np.shape(series)[-1] for series in serieslist])
+    stacked = np.empty((2, len(serieslist), size))
+    stacked.fill(np.nan)
+    for i, series in enumerate(serieslist):
+        series = np.asarray(series)
+        stacked[:, i, :series.shape[-1]] = series
+    return stacked
+
+def model_params(modelname):
+    '''descriptions of fitted parameters of the model, with TAU_UNITS'''
+    if modelname in TENSNLSFITS:
+        return TENSNLSFITS[modelname][1]
+    return TENSFITMODELS[modelname].meta['params']
+
+def linear_fits(tension, dilation, modelname):
+    '''fits of all vesicles at once by linear form of the model
+
+    @param tension, dilation: 2 x vesicles x points arrays of values and errors
+    returns params x vesicles arrays of fitted parameters and their errors
+    '''
+    transform, fromline = TENSLINEARFITS[modelname]
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        line = weighted_lines(transform(tension[0]), dilation[0], lsq_weights(dilation[1]))
+        fit, sd_fit = fromline(*line)
+    return np.asarray(fit), np.asarray(sd_fit)
+
+def _fit_chunk(task):
+    '''nonlinear fits of a chunk of vesicles, runs in worker processes'''
+    modelname, tension, dilation, tensdim = task
+    params = len(model_params(modelname))
+    fits = np.empty((params, tension.shape[1]))
+    fits.fill(np.nan)
+    sd_fits = fits.copy()
+    for i in range(tension.shape[1]):
+        tens, dil = tension[:,i], dilation[:,i]
+        known = np.isfinite(tens).all(axis=0) & np.isfinite(dil).all(axis=0)
+        if known.sum() <= params:
+            continue
+        tens, dil = tens[:,known], dil[:,known]
+        try:
+            if modelname in TENSNLSFITS:
+                fit, stderr, mesg, success = TENSNLSFITS[modelname][0](tens[0], dil[0])
+                if success not in (1, 2, 3, 4):
+                    continue
+            else:
+                fitmodel = TensionFitModel(tens, dil, TENSFITMODELS[modelname], tensdim)
+                report = fitmodel.fit()
+                fit, stderr = report['fit'], report['sd_fit']
+        except Exception: # e.g. ODRPACK or leastsq errors on degenerate data
+            continue
+        fits[:,i] = fit
+        if stderr is not None:
+            sd_fits[:,i] = stderr
+    return fits, sd_fits
+
+def pool_fits(tension, dilation, modelname, tensdim, workers=None):
+    '''fits of every vesicle by NLS or ODR on a pool of processes
+
+    @param tension, dilation: 2 x vesicles x points arrays of values and errors
+    returns params x vesicles arrays of fitted parameters and their errors
+    '''
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    size = tension.shape[1]
+    bounds = np.linspace(0, size, min(size, workers * CHUNKS_PER_WORKER) + 1).astype(int)
+    tasks = [(modelname, tension[:,start:stop], dilation[:,start:stop], tensdim)
+             for start, stop in zip(bounds[:-1], bounds[1:])]
+    if workers == 1:
+        chunks = map(_fit_chunk, tasks)
+    else:
+        pool = multiprocessing.Pool(workers)
+        try:
+            chunks = pool.map(_fit_chunk, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    fits, sd_fits = zip(*chunks)
+    return np.hstack(fits), np.hstack(sd_fits)
+
+def fit_population(tension, dilation, modelname, tensdim, exact=False, workers=None):
+    '''Fit tension model to every vesicle
+
+    @param tension, dilation: 2 x vesicles x points arrays of values and errors,
+                              or lists of 2xN arrays of every vesicle
+    @param modelname: name of model in TENSFITMODELS or TENSNLSFITS
+    @param tensdim: units of tension
+    @param exact: fit models with linear forms by ODR too
+    @param workers: processes for NLS and ODR fits, all CPUs by default
+    returns report dictionary and error message if any, 'method' of the report
+    is 'linearised', 'NLS' or 'ODR'; vesicles fitted by NLS with some parameters
+    left at their initial guess (see fitting.fitcurve) are among 'failed' ones
+    '''
+    if modelname not in TENSFITMODELS and modelname not in TENSNLSFITS:
+        return None, 'Unknown tension fit model %s'%modelname
+    if isinstance(tension, list):
+        tension, dilation = stack_series(tension), stack_series(dilation)
+    if modelname in TENSLINEARFITS and not exact:
+        method = 'linearised'
+        fit, sd_fit = linear_fits(tension, dilation, modelname)
+    else:
+        method = modelname in TENSNLSFITS and 'NLS' or 'ODR'
+        fit, sd_fit = pool_fits(tension, dilation, modelname, tensdim, workers)
+    failed = ~np.isfinite(fit).all(axis=0)
+    if failed.all():
+        return None, 'All fits failed'
+    good = fit[:,~failed]
+    spread = np.zeros(len(good))
+    if good.shape[1] > 1:
+        spread = good.std(axis=1, ddof=1)
+    report = {'params':param_units(model_params(modelname), tensdim),
+              'model':modelname, 'method':method,
+              'exact':exact or modelname not in TENSLINEARFITS,
+              'fit':fit, 'sd_fit':sd_fit, 'failed':failed,
+              'points':(np.isfinite(tension[0]) & np.isfinite(dilation[0])).sum(axis=-1),
+              'mean':good.mean(axis=1), 'sd':spread, 'median':np.median(good, axis=1)}
+    return report, None
+
+def population_data(report):
+    '''fitted parameters of all vesicles as dictionary for output.DataWriter'''
+    data = {}
+    for i, (name, texname, dim, texdim) in enumerate(report['params']):
+        data[name] = np.asarray((report['fit'][i], report['sd_fit'][i]))
+    return data
+
+if __name__ == '__main__':
+    # this is executed only if this source file is run separately
+    # and not imported as module to another source file.
+    print __doc__
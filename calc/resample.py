@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+'''Part of VAMP project, only for import.
+
+Uncertainty of fitted elastic moduli by resampling.
+
+Errors of kappa and K given by ODR are first-order estimates propagated
+from errors of features. Here the fit is repeated on many resampled data sets,
+and the distribution of fitted parameters gives their errors and confidence
+intervals directly. Resampling methods are
+bootstrap - points of the tension curve are drawn with replacement,
+montecarlo - every point is shifted by normal noise with its own errors
+             of tension and dilation.
+Samples are refitted by ODR with TensionFitModel, the same estimator as
+the fit they describe, on a pool of processes. Much faster refits by
+linear forms of models (fitting.TENSLINEARFITS) fit all samples at once
+as arrays, but weigh points by errors of dilation only and leave out
+errors of tension, so their intervals are reported as linearised.
+
+prerequisites - installed numpy, scipy
+'''
+import multiprocessing
+
+import numpy as np
+
+from analysis import TensionFitModel
+from fitting import TENSFITMODELS, TENSLINEARFITS, lsq_weights, param_units, weighted_lines
+
+RESAMPLING = ('bootstrap', 'montecarlo')
+CHUNKS_PER_WORKER = 4
+
+def resample(tension, dilation, method='bootstrap', size=2000, seed=None):
+    '''Resampled data sets
+
+    @param tension, dilation: 2xN arrays of values and errors
+    @param method: one of RESAMPLING
+    @param size: number of data sets
+    @param seed: seed of random numbers, for reproducible results
+    returns tension and dilation as 2 x size x N arrays of values and errors
+    '''
+    random = np.random.RandomState(seed)
+    N = tension.shape[-1]
+    if method == 'bootstrap':
+        index = random.randint(0, N, (size, N))
+        return tension[:,index], dilation[:,index]
+    elif method == 'montecarlo':
+        ones = np.ones((size, 1))
+        tens = tension[0] + tension[1] * random.standard_normal((size, N))
+        dil = dilation[0] + dilation[1] * random.standard_normal((size, N))
+        return (np.asarray((tens, tension[1] * ones)),
+                np.asarray((dil, dilation[1] * ones)))
+    raise ValueError('Unknown resampling method %s'%method)
+
+def linear_refits(tension, dilation, modelname):
+    '''parameters of model fitted to every data set by its linear form
+
+    @param tension, dilation: 2 x size x N arrays of values and errors
+    returns params x size array
+    '''
+    transform, fromline = TENSLINEARFITS[modelname]
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        slope, sd_slope, intercept, sd_intercept = weighted_lines(
+                    transform(tension[0]), dilation[0], lsq_weights(dilation[1]), minpoints=2)
+        fit, sd_fit = fromline(slope, 0, intercept, 0)
+    return np.asarray(fit)
+
+def _odr_refits(task):
+    '''ODR fits of chunk of data sets, runs in worker processes'''
+    modelname, tension, dilation, tensdim = task
+    model = TENSFITMODELS[modelname]
+    fits = np.empty((len(model.meta['params']), tension.shape[1]))
+    for i in range(tension.shape[1]):
+        fitmodel = TensionFitModel(tension[:,i], dilation[:,i], model, tensdim)
+        try:
+            fits[:,i] = fitmodel.fit()['fit']
+        except Exception: # e.g. ODRPACK errors on degenerate samples
+            fits[:,i] = np.nan
+    return fits
+
+def odr_refits(tension, dilation, modelname, tensdim, workers=None):
+    '''parameters of model fitted to every data set by ODR on a pool of processes
+
+    @param tension, dilation: 2 x size x N arrays of values and errors
+    returns params x size array
+    '''
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    size = tension.shape[1]
+    bounds = np.linspace(0, size, min(size, workers * CHUNKS_PER_WORKER) + 1).astype(int)
+    tasks = [(modelname, tension[:,start:stop], dilation[:,start:stop], tensdim)
+             for start, stop in zip(bounds[:-1], bounds[1:])]
+    if workers == 1:
+        return np.hstack(map(_odr_refits, tasks))
+    pool = multiprocessing.Pool(workers)
+    try:
+        return np.hstack(pool.map(_odr_refits, tasks))
+    finally:
+        pool.close()
+        pool.join()
+
+def fit_uncertainty(tension, dilation, modelname, tensdim, method='bootstrap',
+                    size=2000, level=0.95, seed=0, exact=True, workers=None):
+    '''Distribution of fitted parameters over resampled data sets
+
+    @param tension, dilation: 2xN arrays of values and errors of the fitted range
+    @param modelname: name of model in TENSFITMODELS
+    @param tensdim: units of tension
+    @param method: one of RESAMPLING
+    @param size: number of resampled data sets
+    @param level: confidence level of intervals
+    @param seed: seed of random numbers, fixed by default for reproducible results
+    @param exact: refit by ODR, otherwise by linear form of the model
+    @param workers: processes for exact refits, all CPUs by default
+    returns report dictionary and error message if any
+    '''
+    if method not in RESAMPLING:
+        return None, 'Unknown resampling method %s'%method
+    if not exact and modelname not in TENSLINEARFITS:
+        return None, 'Model %s has no linear form, use exact refits'%modelname
+    tens, dil = resample(tension, dilation, method, size, seed)
+    if exact:
+        samples = odr_refits(tens, dil, modelname, tensdim, workers)
+    else:
+        samples = linear_refits(tens, dil, modelname)
+    finite = np.isfinite(samples).all(axis=0)
+    if not finite.any():
+        return None, 'All resampled fits failed'
+    good = samples[:,finite]
+    params = param_units(TENSFITMODELS[modelname].meta['params'], tensdim)
+    tail = 50 * (1 - level)
+    report = {'params':params, 'method':method, 'size':size, 'level':level,
+              'exact':exact, 'failed':size - finite.sum(), 'samples':samples,
+              'mean':good.mean(axis=1), 'sd':good.std(axis=1, ddof=1),
+              'median':np.median(good, axis=1),
+              'interval':np.transpose(np.percentile(good, (tail, 100 - tail), axis=1))}
+    return report, None
+
+if __name__ == '__main__':
+    # this is executed only if this source file is run separately
+    # and not imported as module to another source file.
+    print __doc__
@@ -3,11 +3,20 @@ Created on May 11, 2010
 
 @author: pshchelo
 '''
+from collections import OrderedDict
+
 import numpy as np
 from scipy import ndimage
 
+# smoothing filters, all are called as
+# filter(y, order, window, diff=0, axis=-1, **kwargs)
+# and smooth (and differentiate) all profiles along the axis of N-D array y,
+# filters are added with register_filter
 SMOOTHFILTERS = {}
 
+SG_CACHE_SIZE = 16  # number of Savitzky-Golay coefficient sets to keep
+_sg_coeffs = OrderedDict()
+
 def savitzky_golay(y, order, window_size, diff=0):
     r"""Smooth data with a Savitzky-Golay filter.
     
@@ -59,6 +68,21 @@ def savitzky_golay(y, order, window_size, diff=0):
        W.H. Press, S.A. Teukolsky, W.T. Vetterling, B.P. Flannery
        Cambridge University Press ISBN-13: 9780521880688
     """
+    m = savitzky_golay_coeffs(order, window_size, diff)
+    half_window = (m.size -1) // 2
+    # pad the signal at the extremes with
+    # values taken from the signal itself
+    firstvals = y[0] - np.abs( y[1:half_window+1][::-1] - y[0] )
+    lastvals = y[-1] + np.abs(y[-half_window-1:-1][::-1] - y[-1])
+    y = np.concatenate((firstvals, y, lastvals))
+    return np.convolve(m, y, mode='valid')
+
+def savitzky_golay_coeffs(order, window_size, diff=0):
+    '''Coefficients of Savitzky-Golay filter (see savitzky_golay).
+    
+    Coefficients are memoized, up to SG_CACHE_SIZE last used sets are kept.
+    Returned array is read-only.
+    '''
     try:
         window_size = np.abs(np.int(window_size))
         order = np.abs(np.int(order))
@@ -68,19 +92,62 @@ def savitzky_golay(y, order, window_size, diff=0):
         raise TypeError("window_size size must be a positive odd number")
     if window_size < order + 2:
         raise TypeError("window_size is too small for the polynomials order")
-    order_range = range(order+1)
-    half_window = (window_size -1) // 2
-    # precompute coefficients
-    b = np.mat([[k**i for i in order_range] for k in range(-half_window, half_window+1)])
-    m = np.linalg.pinv(b).A[diff]
-    # pad the signal at the extremes with
-    # values taken from the signal itself
-    firstvals = y[0] - np.abs( y[1:half_window+1][::-1] - y[0] )
-    lastvals = y[-1] + np.abs(y[-half_window-1:-1][::-1] - y[-1])
-    y = np.concatenate((firstvals, y, lastvals))
-    return np.convolve(m, y, mode='valid')
+    key = (order, window_size, diff)
+    m = _sg_coeffs.pop(key, None)
+    if m is None:
+        order_range = range(order+1)
+        half_window = (window_size -1) // 2
+        b = np.array([[k**i for i in order_range] for k in range(-half_window, half_window+1)])
+        m = np.linalg.pinv(b)[diff]
+        m.flags.writeable = False
+        if len(_sg_coeffs) >= SG_CACHE_SIZE:
+            _sg_coeffs.popitem(last=False)  # evict least recently used
+    _sg_coeffs[key] = m
+    return m
 
-SMOOTHFILTERS['Savitzky-Golay'] = savitzky_golay
+def savitzky_golay_batch(y, order, window_size, diff=0, axis=-1):
+    '''Savitzky-Golay filter of all 1D profiles along the axis of N-D array at once.
+    
+    Same as applying savitzky_golay to every profile, 
+    but done in one ndimage.convolve1d call.
+    '''
+    m = savitzky_golay_coeffs(order, window_size, diff)
+    half_window = (m.size -1) // 2
+    y = np.asarray(y, dtype=float)
+    y = np.rollaxis(y, axis, y.ndim)
+    # pad the signals at the extremes the same way as savitzky_golay does
+    first = y[..., :1]
+    last = y[..., -1:]
+    firstvals = first - np.abs(y[..., half_window:0:-1] - first)
+    lastvals = last + np.abs(y[..., -2:-half_window-2:-1] - last)
+    padded = np.concatenate((firstvals, y, lastvals), axis=-1)
+    smoothed = ndimage.convolve1d(padded, m, axis=-1)
+    smoothed = smoothed[..., half_window:half_window+y.shape[-1]]
+    return np.rollaxis(smoothed, -1, axis % y.ndim)
+
+def along_axis(filter):
+    '''Make filter of a single 1D profile conform to SMOOTHFILTERS signature
+    
+    the resulting filter applies the original one to all profiles along the axis
+    '''
+    def batched(y, order, window, diff=0, axis=-1, **kwargs):
+        return np.apply_along_axis(filter, axis, np.asarray(y, dtype=float),
+                                   order, window, diff, **kwargs)
+    batched.__doc__ = filter.__doc__
+    return batched
+
+def register_filter(name, filter, batched=True):
+    '''Add filter to SMOOTHFILTERS under the name
+    
+    filters of a single 1D profile (batched=False) are applied
+    to all profiles along the axis by along_axis
+    '''
+    if not batched:
+        filter = along_axis(filter)
+    SMOOTHFILTERS[name] = filter
+    return filter
+
+register_filter('Savitzky-Golay', savitzky_golay_batch)
 
 def gauss(y, sigma, window=0, diff=0, axis=-1, output=None, mode='reflect', cval=0.0):
     '''Gauss smoothing
@@ -88,9 +155,24 @@ def gauss(y, sigma, window=0, diff=0, axis=-1, output=None, mode='reflect', cval
     window is a dumb parameter for compatibility with windowed filters'''
     return ndimage.gaussian_filter1d(y, sigma, axis, diff, output, mode, cval)
 
-SMOOTHFILTERS['Gauss'] = gauss
+register_filter('Gauss', gauss)
+
+def median(y, order, window, diff=0, axis=-1):
+    '''Median smoothing over window points, differentiated diff times
+    
+    order is a dumb parameter for compatibility with polynomial filters'''
+    y = np.asarray(y, dtype=float)
+    size = [1]*y.ndim
+    size[axis] = int(window)
+    smoothed = ndimage.median_filter(y, size=size, mode='nearest')
+    for i in range(int(diff)):
+        smoothed = np.gradient(smoothed, axis=axis)
+    return smoothed
+
+register_filter('Median', median)
 
-def smooth1d(y, mode, order, window, diff=0, **kwargs):
+def smooth1d(y, mode, order, window, diff=0, axis=-1, **kwargs):
+    '''Smooth profile(s) along the axis with filter from SMOOTHFILTERS'''
     filter = SMOOTHFILTERS[mode]
-    smoothed = filter(y, order, window, diff, **kwargs)
+    smoothed = filter(y, order, window, diff, axis=axis, **kwargs)
     return smoothed
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+'''Part of VAMP project, only for import.
+
+Synthetic images of micropipette aspiration with known positions
+of pipette walls and tip, aspirated vesicle tip and outer vesicle edge,
+for benchmarking and checking the accuracy of image analysis.
+
+All positions are in pixels along the pipette axis (x coordinate),
+edges are rendered analytically (smoothed with erf), so that the
+ground truth is known with subpixel accuracy.
+
+prerequisites - installed numpy, scipy
+'''
+import numpy as np
+from scipy.special import erf
+
+from common import PIX_ERR
+
+def aspiration_truth(N, shape=(128, 256), piprad=12.0, tilt=0.0,
+                     aspl=(14.0, 40.0), vesl=(60.0, 52.0)):
+    '''Ground truth geometry of a pressure ramp.
+
+    @param N: number of frames
+    @param shape: (height, width) of images
+    @param piprad: inner pipette radius
+    @param tilt: slope of the pipette axis (dy/dx)
+    @param aspl: aspirated length in first and last frames
+    @param vesl: outer vesicle length in first and last frames
+    returns dictionary of arrays of ground truth positions
+    '''
+    sizey, sizex = shape
+    ramp = np.linspace(0, 1, N)
+    truth = {}
+    truth['shape'] = shape
+    truth['tilt'] = tilt
+    truth['axis'] = sizey / 2.0 - tilt * sizex / 2.0  # axis y at x=0
+    truth['piprad'] = np.ones(N) * piprad
+    truth['pips'] = np.ones(N) * sizex * 0.45
+    truth['asps'] = truth['pips'] - (aspl[0] + (aspl[1] - aspl[0]) * ramp)
+    truth['vess'] = truth['pips'] + (vesl[0] + (vesl[1] - vesl[0]) * ramp)
+    return truth
+
+def aspiration_features(truth):
+    '''features dictionary as returned by features.locate, from ground truth'''
+    N = len(truth['pips'])
+    metric = np.sqrt(1 + truth['tilt']**2)
+    pix_err = np.ones(N) * PIX_ERR
+    out = {}
+    out['metrics'] = np.asarray((np.ones(N) * metric, np.zeros(N)))
+    out['piprads'] = np.asarray((truth['piprad'], pix_err))  # tilt-corrected
+    out['pips'] = np.asarray((truth['pips'], pix_err))
+    out['asps'] = np.asarray((truth['asps'], pix_err))
+    out['vess'] = np.asarray((truth['vess'], pix_err))
+    return out
+
+def aspiration_params(truth, mode='phc', polar='left'):
+    '''parameters for features.locate which the user would set for these images'''
+    sizey, sizex = truth['shape']
+    pip = int(truth['pips'].mean())
+    piprad = int(truth['piprad'].min() * 0.6)
+    minaspest = int(truth['asps'].max() + (pip - truth['asps'].max()) / 2)
+    minvesest = int(pip + (truth['vess'].min() - pip) / 2)
+    axis = truth['axis'] + truth['tilt'] * np.asarray((0, minaspest))
+    params = {'mode':mode, 'polar':polar, 'smoothing':'Savitzky-Golay',
+              'window':11., 'order':2., 'subpix':False, 'mismatch':3.,
+              'extra':False, 'darktip':mode == 'phc',
+              'aspves':(minaspest, minvesest),
+              'tip':(pip - 6, pip + 7),
+              'axis':tuple(int(round(y)) for y in axis),
+              'pipette':(piprad, int(truth['piprad'].max()) - piprad + 6),
+              }
+    return params
+
+def aspiration_image(truth, index, mode='phc', polar='left', noise=2.0,
+                     blur=1.5, random=np.random):
+    '''Render single frame as float array.
+
+    Phase contrast: dark vesicle interior with smooth edges, dark pipette walls
+    and dark pipette tip between two bright halos.
+    DIC: derivative of the vesicle along the axis (sign by polar)
+    on grey background, bright pipette tip.
+    '''
+    sizey, sizex = truth['shape']
+    k = truth['tilt']
+    norm = np.sqrt(1 + k*k)
+    y, x = np.mgrid[0:sizey, 0:sizex].astype(float)
+    # coordinates along (scaled to x) and across the axis
+    u = (x + k * (y - truth['axis'])) / (norm * norm)
+    v = (y - truth['axis'] - k * x) / norm
+
+    pip = truth['pips'][index]
+    asp = truth['asps'][index]
+    ves = truth['vess'][index]
+    piprad = truth['piprad'][index]
+
+    def inside(dist):
+        '''smooth indicator of negative signed distance'''
+        return 0.5 * (1 - erf(dist / (np.sqrt(2) * blur)))
+
+    ulen = u * norm  # lengths along the axis
+    # aspirated part, a cylinder with hemispherical cap at asp
+    capcenter = (asp + piprad) * norm
+    capdist = np.sqrt((ulen - capcenter)**2 + v*v) - piprad
+    tonguedist = np.where(ulen < capcenter, capdist, np.fabs(v) - piprad)
+    tongue = inside(tonguedist) * inside(ulen - pip * norm)
+    # outer part, a sphere crossing the pipette mouth
+    vesl = ves - pip
+    vesrad = 0.5 * (vesl**2 + piprad**2) / vesl * norm
+    outer = inside(np.sqrt((ulen - ves * norm + vesrad)**2 + v*v) - vesrad)
+    outer *= inside(pip * norm - ulen)
+    vesicle = np.minimum(tongue + outer, 1)
+
+    walls = (np.exp(-0.5 * ((np.fabs(v) - piprad) / blur)**2) *
+             inside(ulen - pip * norm))
+    mouth = np.exp(-0.5 * ((ulen - pip * norm) / blur)**2) * inside(np.fabs(v) - piprad)
+    halo = (np.exp(-0.5 * ((ulen - pip * norm - 3 * blur) / blur)**2) +
+            np.exp(-0.5 * ((ulen - pip * norm + 3 * blur) / blur)**2))
+    halo *= inside(np.fabs(v) - piprad)
+
+    if mode == 'phc':
+        img = 140 - 50 * vesicle - 70 * walls - 40 * mouth + 30 * halo
+    elif mode == 'dic':
+        relief = np.gradient(vesicle, axis=1) * 2 * blur
+        if polar == 'right':
+            relief = -relief
+        img = 128 + 60 * relief - 50 * walls + 60 * mouth
+    return img + random.normal(0, noise, img.shape)
+
+def aspiration_images(truth, mode='phc', polar='left', noise=2.0, seed=0):
+    '''Render all frames of the ramp as 3d uint8 array'''
+    random = np.random.RandomState(seed)
+    N = len(truth['pips'])
+    images = np.empty((N,) + tuple(truth['shape']), np.uint8)
+    for index in range(N):
+        img = aspiration_image(truth, index, mode, polar, noise, random=random)
+        images[index] = np.clip(img, 0, 255)
+    return images
+
+def aspiration_pressures(N, maximum=500.0):
+    '''pressures (Pa) of the ramp, starting from zero'''
+    return np.linspace(0, maximum, N)
+
+if __name__ == '__main__':
+    # this is executed only if this source file is run separately
+    # and not imported as module to another source file.
+    print __doc__
@@ -0,0 +1,58 @@
+'''Regression tests of vesicle geometry'''
+import unittest
+
+import numpy as np
+
+from calc import analysis, synthetic
+
+class GeometryTest(unittest.TestCase):
+    '''geometry of many vesicles at once against known shapes and single vesicles'''
+
+    def test_truth(self):
+        truth = synthetic.aspiration_truth(10, tilt=0.02)
+        geometry, mesg = analysis.get_geometry(synthetic.aspiration_features(truth))
+        self.assertEqual(mesg, None)
+        metric = np.sqrt(1 + 0.02**2)
+        piprad = truth['piprad'][0]
+        aspl = (truth['pips'] - truth['asps']) * metric
+        vesl = (truth['vess'] - truth['pips']) * metric
+        np.testing.assert_allclose(geometry['aspl'][0], aspl)
+        np.testing.assert_allclose(geometry['vesl'][0], vesl)
+        np.testing.assert_allclose(geometry['piprad'][0], piprad)
+        np.testing.assert_allclose(geometry['vesrad'][0], (vesl**2 + piprad**2) / (2*vesl))
+        # outer spherical cap and cylinder with hemispherical end inside the pipette
+        np.testing.assert_allclose(geometry['area'][0],
+                                   np.pi*(vesl**2 + piprad**2) + 2*np.pi*piprad*aspl)
+        np.testing.assert_allclose(geometry['volume'][0],
+                                   np.pi*vesl*(3*piprad**2 + vesl**2)/6 +
+                                   np.pi*piprad**2*(aspl - piprad/3))
+
+    def test_batch(self):
+        featurelist = [synthetic.aspiration_features(synthetic.aspiration_truth(N, piprad=r))
+                       for N, r in ((10, 12.0), (7, 10.0), (12, 14.0))]
+        batch, mesg = analysis.get_geometry_batch(analysis.pad_features(featurelist))
+        self.assertEqual(batch['valid'].shape, (3, 12))
+        for i, features in enumerate(featurelist):
+            single = analysis.get_geometry(features)[0]
+            N = len(features['pips'][0])
+            self.assertTrue(batch['valid'][i, :N].all())
+            self.assertFalse(batch['valid'][i, N:].any())
+            np.testing.assert_allclose(batch['piprad'][:, i], single['piprad'])
+            for key in ('aspl', 'vesl', 'vesrad', 'area', 'volume'):
+                np.testing.assert_allclose(batch[key][:, i, :N], single[key], err_msg=key)
+                self.assertTrue(np.isnan(batch[key][:, i, N:]).all(), key)
+
+    def test_invalid(self):
+        features = synthetic.aspiration_features(synthetic.aspiration_truth(10))
+        # aspirated tip outside of the pipette
+        features['asps'][0, 3] = features['pips'][0, 3] + 5
+        batch = analysis.get_geometry_batch(analysis.pad_features([features]))[0]
+        np.testing.assert_array_equal(batch['valid'][0], np.arange(10) != 3)
+        self.assertTrue(np.isnan(batch['area'][:, 0, 3]).all())
+        self.assertTrue(np.isfinite(batch['area'][:, 0, 4]).all())
+        geometry, mesg = analysis.get_geometry(features)
+        self.assertEqual(geometry, None)
+        self.assertTrue(mesg.startswith('Error with detected features'))
+
+if __name__ == '__main__':
+    unittest.main()
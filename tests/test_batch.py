@@ -0,0 +1,73 @@
+'''Regression tests of non-interactive analysis of experiment folders'''
+import os, shutil, tempfile, unittest
+
+import numpy as np
+from PIL import Image
+
+from calc import batch, features, synthetic
+
+class AnalyseFolderTest(unittest.TestCase):
+    '''folders of synthetic images are analysed the same way with any settings'''
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix='vampy-test')
+        self.truth = synthetic.aspiration_truth(20, shape=(192, 256))
+        self.params = synthetic.aspiration_params(self.truth)
+        images = np.clip(np.round(synthetic.aspiration_images(self.truth)), 0, 255)
+        self.images = images.astype(np.uint8)
+        for index, img in enumerate(self.images):
+            Image.fromarray(img).save(os.path.join(self.folder, '%03i.png'%index))
+        np.savetxt(os.path.join(self.folder, 'press.txt'),
+                   np.repeat(synthetic.aspiration_pressures(11)[1:, np.newaxis], 2, axis=1))
+        cfg = open(os.path.join(self.folder, 'vampy.cfg'), 'w')
+        for key in ('mode', 'polar'):
+            cfg.write('%s\t%s\n'%(key, self.params[key]))
+        cfg.write('orient\tleft\nleft\t0\nright\t0\ntop\t0\nbottom\t0\nfromnames\t0\n')
+        cfg.write('darktip\t%i\n'%self.params['darktip'])
+        for key in ('aspves', 'tip', 'axis', 'pipette'):
+            cfg.write('%s\t%i\t%i\n'%((key,) + tuple(self.params[key])))
+        cfg.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def analyse(self, **settings):
+        results, mesg = batch.analyse_folder(self.folder, dict(settings, pressfile='press.txt'))
+        self.assertEqual(mesg, None)
+        return results
+
+    def test_geometry(self):
+        results = self.analyse(cache=False)
+        located = features.locate(dict(self.params, images=self.images))[0]
+        # two images per pressure are averaged
+        aspl = (located['pips'][0] - located['asps'][0]) * located['metrics'][0]
+        aspl = aspl.reshape(10, 2).mean(axis=1)
+        np.testing.assert_allclose(results['geometry']['aspl'][0], aspl)
+        self.assertEqual(results['tensions']['tension'].shape, (2, 10))
+        self.assertEqual(len(results['fitted']), 2)
+
+    def test_settings(self):
+        results = self.analyse(cache=False)
+        for settings in ({'roi':True}, {'stream':True}, {'cache':True}, {'cache':True}):
+            other = self.analyse(**settings)
+            for key in results['geometry']:
+                np.testing.assert_allclose(other['geometry'][key], results['geometry'][key],
+                                           err_msg='%s %s'%(settings, key))
+
+    def test_process(self):
+        outdir = tempfile.mkdtemp(prefix='vampy-test')
+        try:
+            done = list(batch.process_folders([self.folder, outdir],
+                                              {'pressfile':'press.txt', 'outdir':outdir}, 1))
+        finally:
+            written = sorted(os.listdir(outdir))
+            shutil.rmtree(outdir)
+        self.assertEqual(done[0][2], None)
+        self.assertEqual(done[1][1], None)
+        self.assertTrue(done[1][2].startswith('No vampy.cfg'))
+        name = os.path.basename(self.folder)
+        self.assertEqual(written, [name+'-'+batch.GEOMETRY_FILENAME,
+                                   name+'-'+batch.TENSIONS_FILENAME])
+
+if __name__ == '__main__':
+    unittest.main()
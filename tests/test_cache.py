@@ -0,0 +1,81 @@
+'''Regression tests of the cache of analysis results'''
+import os, shutil, tempfile, time, unittest
+
+import numpy as np
+
+from calc import cache
+
+class DigestTest(unittest.TestCase):
+    '''keys change with anything results depend on, and only with it'''
+
+    def test_params(self):
+        params = {'a':1, 'b':np.arange(3.), 'c':{'x':'y'}}
+        same = {'c':{'x':'y'}, 'b':np.arange(3.), 'a':1}
+        self.assertEqual(cache.params_digest(params), cache.params_digest(same))
+        for key, value in (('a', 2), ('b', np.arange(4.)), ('b', np.arange(3)),
+                           ('c', {'x':'z'})):
+            changed = dict(params)
+            changed[key] = value
+            self.assertNotEqual(cache.params_digest(params), cache.params_digest(changed))
+
+    def test_stage_key(self):
+        key = cache.stage_key('fit', 'parent', {'fitmodel':'Bend Evans'})
+        self.assertEqual(key, cache.stage_key('fit', 'parent', {'fitmodel':'Bend Evans'}))
+        self.assertNotEqual(key, cache.stage_key('fit', 'other', {'fitmodel':'Bend Evans'}))
+        self.assertNotEqual(key, cache.stage_key('fit', 'parent', {'fitmodel':'Stretch simple'}))
+        self.assertNotEqual(key, cache.stage_key('uncertainty', 'parent', {'fitmodel':'Bend Evans'}))
+
+    def test_files(self):
+        folder = tempfile.mkdtemp(prefix='vampy-test')
+        try:
+            filename = os.path.join(folder, 'img.png')
+            open(filename, 'wb').write('image')
+            digest = cache.files_digest([filename])
+            self.assertEqual(digest, cache.files_digest([filename]))
+            open(filename, 'wb').write('changed image')
+            self.assertNotEqual(digest, cache.files_digest([filename]))
+        finally:
+            shutil.rmtree(folder)
+
+class ResultCacheTest(unittest.TestCase):
+    '''results are stored and read back by key, the least recently used are removed'''
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix='vampy-test')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_round_trip(self):
+        results = cache.ResultCache(self.folder)
+        self.assertEqual(results.get('key'), None)
+        results.put('key', ({'fit':np.arange(3.)}, None))
+        result, mesg = cache.ResultCache(self.folder).get('key')
+        np.testing.assert_array_equal(result['fit'], np.arange(3.))
+        self.assertEqual(mesg, None)
+
+    def test_no_folder(self):
+        results = cache.ResultCache(None)
+        results.put('key', (1, None))
+        self.assertEqual(results.get('key'), None)
+
+    def test_corrupt(self):
+        results = cache.ResultCache(self.folder)
+        results.put('key', (1, None))
+        open(results.filename('key'), 'wb').write('truncated')
+        self.assertEqual(results.get('key'), None)
+
+    def test_trim(self):
+        results = cache.ResultCache(self.folder, size=3)
+        for index in range(3):
+            results.put('key%i'%index, (index, None))
+            past = time.time() - 100 + index
+            os.utime(results.filename('key%i'%index), (past, past))
+        results.get('key0')  # recently used now
+        results.put('key3', (3, None))
+        self.assertEqual(results.get('key1'), None)
+        for index in (0, 2, 3):
+            self.assertEqual(results.get('key%i'%index), (index, None))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+'''Regression tests of vesicle outlines and circle fits'''
+import unittest
+
+import numpy as np
+from scipy.special import erf
+
+from calc import contour
+
+def disc_image(center, radius, shape=(128, 160), blur=1.5):
+    '''bright disc with smooth edge on dark background'''
+    y, x = np.indices(shape, dtype=float)
+    dist = np.hypot(y - center[0], x - center[1])
+    return 100 + 50*erf((radius - dist)/blur)
+
+class VesicleOutlineTest(unittest.TestCase):
+    '''rims on polar grid are on the edge of synthetic discs'''
+
+    centers = [(64.3, 70.6), (60.0, 80.2), (66.7, 75.5)]
+    radii = [30.0, 25.4, 35.8]
+
+    def test_image(self):
+        center, radius = self.centers[0], self.radii[0]
+        x, y, err = contour.vesicle_outline(disc_image(center, radius), center, 45)
+        self.assertEqual(x.shape, (360,))
+        dist = np.hypot(y - center[0], x - center[1])
+        np.testing.assert_allclose(dist, radius, atol=0.1)
+
+    def test_stack(self):
+        images = np.asarray([disc_image(c, r) for c, r in zip(self.centers, self.radii)])
+        x, y, err = contour.vesicle_outline(images, self.centers, 45, angles=90)
+        self.assertEqual(x.shape, (3, 90))
+        for i, (center, radius) in enumerate(zip(self.centers, self.radii)):
+            single = contour.vesicle_outline(images[i], center, 45, angles=90)
+            np.testing.assert_allclose(x[i], single[0])
+            np.testing.assert_allclose(y[i], single[1])
+            dist = np.hypot(y[i] - center[0], x[i] - center[1])
+            np.testing.assert_allclose(dist, radius, atol=0.1)
+
+class FitCirclesTest(unittest.TestCase):
+    '''algebraic circle fits of many sets of points at once'''
+
+    def points(self, arc, sets=4, size=40, noise=0.3):
+        random = np.random.RandomState(0)
+        t = random.uniform(0, arc, (sets, size))
+        x = 10 + 50*np.cos(t) + random.normal(0, noise, t.shape)
+        y = -4 + 50*np.sin(t) + random.normal(0, noise, t.shape)
+        return x, y
+
+    def test_full_circle(self):
+        x, y = self.points(2*np.pi)
+        for method in contour.CIRCLEFITS:
+            fit, sd_fit = contour.fit_circles(x, y, method)
+            self.assertEqual(fit.shape, (3, 4))
+            np.testing.assert_allclose(fit, [[50]*4, [10]*4, [-4]*4], atol=0.3, err_msg=method)
+            self.assertTrue(np.all(sd_fit < 0.3), method)
+
+    def test_short_arc(self):
+        # Kasa fit is biased to smaller circles on short arcs, Pratt and Taubin are not
+        x, y = self.points(1.0, noise=1.0)
+        kasa = contour.fit_circles(x, y, 'kasa')[0]
+        self.assertTrue(np.all(kasa[0] < 49))
+        for method in ('pratt', 'taubin'):
+            fit = contour.fit_circles(x, y, method)[0]
+            self.assertTrue(np.all(np.fabs(fit[0] - 50) < np.fabs(kasa[0] - 50)), method)
+            refined = contour.fit_circles(x, y, method, refine=True)[0]
+            self.assertTrue(np.all(np.isfinite(refined)), method)
+
+    def test_sets(self):
+        x, y = self.points(2*np.pi)
+        x[1, :5] = np.nan
+        for method in contour.CIRCLEFITS:
+            fits = contour.fit_circles(x, y, method)[0]
+            for i in range(x.shape[0]):
+                valid = np.isfinite(x[i])
+                single = contour.fit_circles(x[i][valid], y[i][valid], method)[0]
+                np.testing.assert_allclose(fits[:,i], single, rtol=1e-10, err_msg=method)
+
+    def test_newton_root(self):
+        # positive root, negative one and a step increasing the polynomial
+        roots = contour._newton_root(lambda t: (t - np.asarray((2., -1., 0.))) * (1 + t*t),
+                                     lambda t: 1 + t*t + 2*t*(t - np.asarray((2., -1., 0.))),
+                                     (3,))
+        np.testing.assert_allclose(roots, (2, 0, 0))
+        wrong = contour._newton_root(lambda t: t*t + 1, lambda t: 2*t + 1, (1,))
+        np.testing.assert_array_equal(wrong, (0,))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+'''Regression tests of features, stacked versus serial location'''
+import os, shutil, tempfile, unittest
+
+import numpy as np
+
+from calc import features, load, synthetic
+
+class LocateStackTest(unittest.TestCase):
+    '''locate_stack gives the same features as the reference locate_serial'''
+
+    def compare(self, mode, tilt=0.0, integer=False, subpix=False):
+        truth = synthetic.aspiration_truth(40, tilt=tilt)
+        params = synthetic.aspiration_params(truth, mode, 'left')
+        images = synthetic.aspiration_images(truth, mode, 'left', 2.0)
+        if integer:
+            images = np.round(images).astype(np.uint8)
+        params.update(images=images, subpix=subpix)
+        stacked = features.locate_stack(params)[0]
+        serial = features.locate_serial(params)[0]
+        for key in serial:
+            np.testing.assert_allclose(stacked[key], serial[key], atol=1e-9, err_msg=key)
+
+    def test_phc(self):
+        self.compare('phc')
+
+    def test_dic(self):
+        self.compare('dic')
+
+    def test_integer_ties(self):
+        # integer images have exact ties of brightness on the untilted axis
+        self.compare('phc', integer=True)
+        self.compare('dic', integer=True)
+
+    def test_tilted(self):
+        self.compare('phc', tilt=0.02)
+
+    def test_subpix(self):
+        self.compare('phc', subpix=True)
+        self.compare('dic', subpix=True)
+
+    def test_profiles(self):
+        truth = synthetic.aspiration_truth(4, tilt=0.02)
+        images = synthetic.aspiration_images(truth)
+        point1 = np.zeros((4, 2, 2))
+        point2 = np.zeros((4, 2, 2))
+        point1[:,0,0] = truth['axis'] + np.arange(4)
+        point2[:,0] = 50 + truth['axis'] + 0.02 * 200, 200
+        stacked = features.line_profile_stack(images, point1, point2)[2]
+        for image, p1, p2, profile in zip(images, point1, point2, stacked):
+            np.testing.assert_allclose(profile, features.line_profile(image, p1, p2)[2])
+
+    def test_ragged(self):
+        # a steep axis on one image gives a longer profile than on the others
+        images = synthetic.aspiration_images(synthetic.aspiration_truth(4))
+        point2 = np.zeros((4, 2, 2))
+        point2[:,0,1] = 200
+        point2[3,0,0] = 300
+        self.assertRaises(features.StackShapeError, features.line_profile_stack,
+                          images, np.zeros((4, 2, 2)), point2)
+
+class LocateParallelTest(unittest.TestCase):
+    '''workers map cropped and rotated views of cached stacks from the cache file'''
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_views(self):
+        filename = os.path.join(self.tmpdir, 'stack.npy')
+        np.save(filename, np.random.RandomState(0).rand(3, 20, 30))
+        stack = np.load(filename, mmap_mode='r')
+        crop = {'top':2, 'bottom':3, 'left':4, 'right':1}
+        for orientation in ('left', 'right', 'top', 'bottom'):
+            images = load.preproc_images(stack, orientation, crop)
+            view, tmpdir = features._share_stack(images)
+            self.assertEqual(tmpdir, None)
+            self.assertEqual(view[0], filename)
+            np.testing.assert_array_equal(features._open_view(view), images)
+
+    def test_parallel(self):
+        truth = synthetic.aspiration_truth(16)
+        params = synthetic.aspiration_params(truth, polar='right')
+        images = synthetic.aspiration_images(truth, polar='right')
+        filename = os.path.join(self.tmpdir, 'stack.npy')
+        np.save(filename, images[:,::-1,::-1])
+        crop = dict.fromkeys(load.SIDES, 0)
+        mapped = load.preproc_images(np.load(filename, mmap_mode='r'), 'right', crop)
+        whole = features.locate(dict(params, images=images))[0]
+        parallel = features.locate_parallel(dict(params, images=mapped), 2)[0]
+        for key in whole:
+            np.testing.assert_allclose(parallel[key], whole[key], err_msg=key)
+
+class TrackTest(unittest.TestCase):
+    '''tracking from image to image against the full search of every image'''
+
+    def test_clean(self):
+        truth = synthetic.aspiration_truth(40)
+        for mode in ('phc', 'dic'):
+            params = synthetic.aspiration_params(truth, mode)
+            images = synthetic.aspiration_images(truth, mode)
+            params.update(images=images)
+            full = features.locate_stack(params)[0]
+            tracked = features.locate_stack(dict(params, track=True))[0]
+            for key in full:
+                np.testing.assert_array_equal(tracked[key], full[key], err_msg=key)
+
+    def test_spurious(self):
+        truth = synthetic.aspiration_truth(40)
+        params = synthetic.aspiration_params(truth)
+        images = synthetic.aspiration_images(truth)
+        # strong dark spot far from the aspirated tip on a few images
+        images[20:23, :, 5:9] -= 200
+        params.update(images=images)
+        full = features.locate_stack(params)[0]['asps'][0]
+        tracked = features.locate_stack(dict(params, track=True))[0]['asps'][0]
+        self.assertTrue(np.all(np.fabs(full - truth['asps'])[20:23] > 20))
+        self.assertTrue(np.all(np.fabs(tracked - truth['asps']) < 2))
+
+class LocateStreamTest(unittest.TestCase):
+    '''images supplied one by one give the same features as the whole stack'''
+
+    def test_stream(self):
+        truth = synthetic.aspiration_truth(40)
+        params = synthetic.aspiration_params(truth)
+        images = synthetic.aspiration_images(truth)
+        whole = features.locate(dict(params, images=images))[0]
+        streamed = features.locate_stream(iter(images), params, chunk=16)[0]
+        for key in whole:
+            np.testing.assert_allclose(streamed[key], whole[key], atol=1e-9, err_msg=key)
+
+    def test_stream_pool(self):
+        truth = synthetic.aspiration_truth(40)
+        params = synthetic.aspiration_params(truth)
+        images = synthetic.aspiration_images(truth)
+        whole = features.locate(dict(params, images=images))[0]
+        streamed = features.locate_stream(iter(images), dict(params, workers=2), chunk=8)[0]
+        for key in whole:
+            np.testing.assert_allclose(streamed[key], whole[key], atol=1e-9, err_msg=key)
+
+if __name__ == '__main__':
+    unittest.main()
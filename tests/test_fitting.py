@@ -0,0 +1,35 @@
+'''Regression tests of fitting'''
+import unittest
+
+import numpy as np
+
+from calc import fitting
+
+class RangeFitsTest(unittest.TestCase):
+    '''fits of RangeFits are the same as linregr of every range'''
+
+    def test_all_ranges(self):
+        random = np.random.RandomState(0)
+        x = np.linspace(1, 20, 15)
+        y = 0.5*x + 3 + random.standard_normal(x.size)
+        fits = fitting.RangeFits(x, y).fit_all()
+        for low in range(x.size):
+            for high in range(low+3, x.size+1):
+                np.testing.assert_allclose([fit[low, high] for fit in fits],
+                                           fitting.linregr(x[low:high], y[low:high]),
+                                           rtol=1e-8, atol=1e-10)
+        self.assertTrue(np.isnan(fits[0][0, 2]))
+
+class JacobiansTest(unittest.TestCase):
+    '''analytic Jacobians of tension fit models agree with finite differences'''
+
+    def test_models(self):
+        x = np.linspace(0.01, 1, 20)
+        for name, model in sorted(fitting.TENSFITMODELS.items()):
+            for beta in ((20, 1e-3), (5, 0.1), (100, 1e-5)):
+                errb, errd = fitting.check_jacobians(model, beta, x)
+                self.assertTrue(errb < 1e-6, '%s fjacb at %s: %g'%(name, beta, errb))
+                self.assertTrue(errd < 1e-6, '%s fjacd at %s: %g'%(name, beta, errd))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,165 @@
+'''Round trips of stacks of images through files'''
+import os, shutil, tempfile, unittest
+
+import numpy as np
+from PIL import Image
+
+from calc import features, load, synthetic
+
+class StackFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix='vampy-test')
+        truth = synthetic.aspiration_truth(5)
+        self.images = np.round(synthetic.aspiration_images(truth)*100).astype(np.uint16)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def save_tiff(self, **options):
+        filename = os.path.join(self.folder, 'stack.tif')
+        pages = [Image.fromarray(img) for img in self.images]
+        pages[0].save(filename, save_all=True, append_images=pages[1:], **options)
+        return filename
+
+    def test_tiff_mapped(self):
+        images, mesg = load.read_tiff_stack(self.save_tiff())
+        self.assertEqual(mesg, None)
+        # uncompressed pages are memory-mapped, not decoded
+        self.assertFalse(images.flags.owndata)
+        np.testing.assert_array_equal(images, self.images)
+
+    def test_tiff_decoded(self):
+        images, mesg = load.read_tiff_stack(self.save_tiff(compression='tiff_deflate'))
+        self.assertEqual(mesg, None)
+        np.testing.assert_array_equal(images, self.images)
+
+    def test_raw_stream(self):
+        filename = os.path.join(self.folder, 'stack.raw')
+        stream = open(filename, 'wb')
+        stream.write('H'*100)
+        stream.write(self.images.astype('<u2').tostring())
+        stream.write('\0'*10)  # incomplete frame
+        stream.close()
+        images, mesg = load.read_raw_stream(filename, self.images.shape[1:], 100)
+        self.assertEqual(mesg, None)
+        np.testing.assert_array_equal(images, self.images)
+        images, mesg = load.read_stack_file(filename, self.images.shape[1:], 100)
+        np.testing.assert_array_equal(images, self.images)
+
+class ReadGreyStackTest(unittest.TestCase):
+    '''images read concurrently are the same as read one by one'''
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix='vampy-test')
+        truth = synthetic.aspiration_truth(6)
+        self.images = np.round(synthetic.aspiration_images(truth)*100).astype(np.uint16)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def save(self, ext, images, **options):
+        filenames = []
+        for index, img in enumerate(images):
+            filename = os.path.join(self.folder, 'img%02i%s'%(index, ext))
+            Image.fromarray(img).save(filename, **options)
+            filenames.append(filename)
+        return filenames
+
+    def compare(self, filenames, region=None):
+        serial = [load.read_grey_image(filename, region)[0] for filename in filenames]
+        stack, mesg = load.read_grey_stack(filenames, workers=3, region=region)
+        self.assertEqual(mesg, None)
+        np.testing.assert_array_equal(stack, serial)
+        return stack
+
+    def test_tiff(self):
+        filenames = self.save('.tif', self.images)
+        # uncompressed TIFF files are mapped, in their own data type
+        self.assertTrue(load._map_grey_image(filenames[0]) is not None)
+        stack = self.compare(filenames)
+        self.assertEqual(stack.dtype, np.uint16)
+        np.testing.assert_array_equal(stack, self.images)
+        stack = self.compare(filenames, (10, 50, 20, 200))
+        np.testing.assert_array_equal(stack, self.images[:, 10:50, 20:200])
+
+    def test_decoded(self):
+        images = (self.images // 256).astype(np.uint8)
+        for ext, options in (('.png', {}), ('.tif', {'compression':'tiff_deflate'})):
+            filenames = self.save(ext, images, **options)
+            self.assertTrue(load._map_grey_image(filenames[0]) is None)
+            np.testing.assert_array_equal(self.compare(filenames), images)
+            np.testing.assert_array_equal(self.compare(filenames, (10, 50, 20, 200)),
+                                          images[:, 10:50, 20:200])
+
+    def test_different(self):
+        filenames = self.save('.png', (self.images // 256).astype(np.uint8))
+        filenames += self.save('.tif', [self.images[0, :-1]])
+        stack, mesg = load.read_grey_stack(filenames, workers=3)
+        self.assertEqual(stack, None)
+        self.assertEqual(mesg, 'Error: Images have different dimensions!')
+
+class PreprocImagesTest(unittest.TestCase):
+    '''cropped and rotated views are the same as rotated copies of images'''
+
+    def rotated(self, images, orientation, crop):
+        # crop and rotation by copies, as preproc_images used to do it
+        imgN, sizey, sizex = images.shape
+        rolled = np.rollaxis(images[:, crop['top']:sizey-crop['bottom'],
+                                    crop['left']:sizex-crop['right']], 0, 3)
+        turns = {'left':0, 'right':2, 'top':1, 'bottom':3}[orientation]
+        return np.rollaxis(np.rot90(rolled, turns), 2)
+
+    def test_orientations(self):
+        images = np.random.RandomState(0).rand(3, 20, 30)
+        crop = {'top':2, 'bottom':3, 'left':4, 'right':1}
+        for orientation in load.SIDES:
+            view = load.preproc_images(images, orientation, crop)
+            self.assertTrue(view.base is not None, orientation)
+            self.assertTrue(np.may_share_memory(view, images), orientation)
+            np.testing.assert_array_equal(view, self.rotated(images, orientation, crop),
+                                          err_msg=orientation)
+        self.assertEqual(crop, {'top':2, 'bottom':3, 'left':4, 'right':1})
+
+class RoiRegionTest(unittest.TestCase):
+    '''region of interest of raw images maps to the band of preprocessed ones'''
+
+    crop = {'top':3, 'bottom':5, 'left':7, 'right':2}
+
+    def raw_images(self, images, orientation):
+        # inverse of preproc_images, padded by the crop
+        if orientation == 'right':
+            images = images[:, ::-1, ::-1]
+        elif orientation == 'top':
+            images = images.swapaxes(1, 2)[:, :, ::-1]
+        elif orientation == 'bottom':
+            images = images.swapaxes(1, 2)[:, ::-1, :]
+        crop = self.crop
+        raw = np.zeros((images.shape[0], images.shape[1] + crop['top'] + crop['bottom'],
+                        images.shape[2] + crop['left'] + crop['right']))
+        raw[:, crop['top']:raw.shape[1]-crop['bottom'],
+            crop['left']:raw.shape[2]-crop['right']] = images
+        return raw
+
+    def test_orientations(self):
+        truth = synthetic.aspiration_truth(6, shape=(256, 200), tilt=0.02)
+        params = synthetic.aspiration_params(truth)
+        images = synthetic.aspiration_images(truth)
+        nocrop = dict.fromkeys(load.SIDES, 0)
+        for orientation in load.SIDES:
+            raw = self.raw_images(images, orientation)
+            np.testing.assert_array_equal(load.preproc_images(raw, orientation, self.crop),
+                                          images, err_msg=orientation)
+            params.update(orient=orientation, crop=self.crop)
+            region, rows = load.roi_region(raw.shape[1:], params)
+            self.assertTrue(0 < rows[0] and rows[1] < 256, orientation)
+            roi = load.preproc_images(load.crop_region(raw, region), orientation, nocrop)
+            np.testing.assert_array_equal(roi, images[:, rows[0]:rows[1]], err_msg=orientation)
+            whole = features.locate(dict(params, images=images))[0]
+            part = features.locate(dict(load.roi_params(params, rows), images=roi))[0]
+            for key in whole:
+                np.testing.assert_allclose(part[key], whole[key], atol=1e-9,
+                                           err_msg=orientation+' '+key)
+
+if __name__ == '__main__':
+    unittest.main()
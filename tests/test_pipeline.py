@@ -0,0 +1,79 @@
+'''Regression tests of the incremental analysis pipeline'''
+import shutil, tempfile, unittest
+
+import numpy as np
+
+from calc import cache, pipeline, synthetic
+
+class PipelineTest(unittest.TestCase):
+    '''stages are recalculated only when their parameters or upstream stages change'''
+
+    def setUp(self):
+        truth = synthetic.aspiration_truth(20)
+        self.params = dict(images=synthetic.aspiration_images(truth),
+                           imagekey='images', locate=synthetic.aspiration_params(truth),
+                           aver=2, tensmodel='Evans',
+                           pressures=synthetic.aspiration_pressures(11)[1:],
+                           pressacc=1.0, scale=0.1, fitmodel='Bend Evans', fitrange=None,
+                           resample=None, samples=100, exact=True, workers=1)
+        self.folder = tempfile.mkdtemp(prefix='vampy-test')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def pipeline(self, folder=None):
+        analysis = pipeline.AnalysisPipeline(cache.ResultCache(folder))
+        analysis.set(**self.params)
+        self.calls = []
+        for stage in pipeline.STAGES:
+            calculate = getattr(analysis, '_'+stage)
+            def counted(parent, stage=stage, calculate=calculate):
+                self.calls.append(stage)
+                return calculate(parent)
+            setattr(analysis, '_'+stage, counted)
+        return analysis
+
+    def recalculated(self, analysis, **params):
+        self.calls = []
+        analysis.set(**params)
+        result, mesg = analysis.get('fit')
+        self.assertEqual(mesg, None)
+        return self.calls
+
+    def test_memory(self):
+        analysis = self.pipeline()
+        self.assertEqual(self.recalculated(analysis),
+                         ['features', 'geometry', 'averaged', 'tensions', 'fit'])
+        self.assertEqual(self.recalculated(analysis), [])
+        self.assertEqual(self.recalculated(analysis, workers=2), [])
+        self.assertEqual(self.recalculated(analysis, fitrange=(2, 10)), ['fit'])
+        self.assertEqual(self.recalculated(analysis, scale=0.2), ['tensions', 'fit'])
+        self.assertEqual(self.recalculated(analysis, aver=4, pressures=self.params['pressures'][:5]),
+                         ['averaged', 'tensions', 'fit'])
+        locate = dict(self.params['locate'], window=9.)
+        self.assertEqual(self.recalculated(analysis, locate=locate),
+                         ['features', 'geometry', 'averaged', 'tensions', 'fit'])
+        # the earlier parameters are calculated again, not remembered
+        self.assertEqual(len(self.recalculated(analysis, locate=self.params['locate'])), 5)
+
+    def test_disk(self):
+        first = self.pipeline(self.folder)
+        fit = first.get('fit')[0]
+        # averaging is not cached on disk, the rest is read back
+        self.assertEqual(self.recalculated(self.pipeline(self.folder)), ['averaged'])
+        second = self.pipeline(self.folder)
+        np.testing.assert_array_equal(second.get('fit')[0]['fit'], fit['fit'])
+        self.assertEqual(self.recalculated(self.pipeline(self.folder), imagekey='other'),
+                         ['features', 'geometry', 'averaged', 'tensions', 'fit'])
+
+    def test_start_at(self):
+        analysis = self.pipeline()
+        tensions = analysis.get('tensions')[0]
+        other = self.pipeline()
+        other.start_at('tensions', tensions, 'from file')
+        self.assertEqual(self.recalculated(other), ['fit'])
+        copied = other.copy()
+        self.assertTrue(copied.get('fit') is other.get('fit'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+'''Regression tests of population fits'''
+import os, shutil, tempfile, unittest
+
+import numpy as np
+
+from calc import batch, fitting, population
+
+TENSDIM = ('mN/m', 'mN/m')
+
+def stretch_series(params, sizes):
+    '''exact tension and dilation series of Stretch simple model'''
+    tension, dilation = [], []
+    for (K, alpha0), size in zip(params, sizes):
+        tens = np.linspace(0.1, 2, size)
+        tension.append(np.asarray((tens, np.ones(size)*0.01)))
+        dilation.append(np.asarray((tens/K + alpha0, np.ones(size)*1e-4)))
+    return tension, dilation
+
+class FitPopulationTest(unittest.TestCase):
+    '''fits of every vesicle recover parameters of the model'''
+
+    params = [(100., 0.01), (150., 0.02), (200., 0.0)]
+
+    def test_linearised(self):
+        tension, dilation = stretch_series(self.params, (10, 12, 8))
+        report, mesg = population.fit_population(tension, dilation, 'Stretch simple', TENSDIM)
+        self.assertEqual(mesg, None)
+        self.assertEqual(report['method'], 'linearised')
+        np.testing.assert_allclose(report['fit'], np.transpose(self.params), atol=1e-8)
+        np.testing.assert_array_equal(report['points'], (10, 12, 8))
+        np.testing.assert_allclose(report['mean'], (150, 0.01))
+
+    def test_exact(self):
+        tension, dilation = stretch_series(self.params, (10, 12, 8))
+        report, mesg = population.fit_population(tension, dilation, 'Stretch simple',
+                                                 TENSDIM, exact=True, workers=1)
+        self.assertEqual(report['method'], 'ODR')
+        np.testing.assert_allclose(report['fit'], np.transpose(self.params), rtol=1e-4, atol=1e-6)
+
+    def test_not_moved(self):
+        # kappa and tau0 of Rawitz model stay at initial guess on these data
+        tens = np.linspace(0.01, 5, 30)
+        dil = fitting.alpha_Rawitz('sphere')([20, 0.001, 200], tens)
+        fit, stderr, mesg, success = fitting.nls_Rawitz(tens, dil, 'sphere')
+        self.assertEqual(success, fitting.FIT_NOT_MOVED)
+        series = np.asarray((tens, np.ones(tens.size)*0.01)), np.asarray((dil, np.ones(tens.size)*1e-4))
+        report, mesg = population.fit_population([series[0]], [series[1]], 'Rawitz sphere',
+                                                 TENSDIM, workers=1)
+        self.assertEqual(report, None)
+        self.assertEqual(mesg, 'All fits failed')
+
+class SavePopulationTest(unittest.TestCase):
+    '''population table names the model and the fit method'''
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_header(self):
+        tension, dilation = stretch_series([(100., 0.01), (150., 0.02)], (10, 10))
+        report = population.fit_population(tension, dilation, 'Stretch simple', TENSDIM)[0]
+        filename = os.path.join(self.tmpdir, 'population.dat')
+        self.assertFalse(batch.save_population(filename, ['ves1', 'ves2'], report))
+        text = open(filename).read()
+        self.assertTrue('Stretch simple model, linearised' in text)
+        self.assertTrue('#2: ves2' in text)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,38 @@
+'''Tests of uncertainty of fitted moduli by resampling'''
+import unittest
+
+import numpy as np
+
+from calc import analysis, fitting, resample
+
+class FitUncertaintyTest(unittest.TestCase):
+
+    def setUp(self):
+        random = np.random.RandomState(0)
+        tau = np.logspace(-3, -0.5, 12)
+        alpha = np.log(tau/1e-4)/(8*np.pi*20)
+        self.tension = np.asarray((tau, 0.05*tau))
+        self.dilation = np.asarray((alpha + random.normal(0, 0.002, tau.size),
+                                    0.002*np.ones(tau.size)))
+        self.tensdim = ('mN/m', 'mN/m')
+
+    def test_exact_by_default(self):
+        '''intervals describe the ODR fit they are reported with'''
+        report, mesg = resample.fit_uncertainty(self.tension, self.dilation, 'Bend Evans',
+                                                self.tensdim, size=200, workers=1)
+        self.assertEqual(mesg, None)
+        self.assertTrue(report['exact'])
+        fit = analysis.TensionFitModel(self.tension, self.dilation,
+                                       fitting.TENSFITMODELS['Bend Evans'], self.tensdim).fit()
+        for (low, high), value in zip(report['interval'], fit['fit']):
+            self.assertTrue(low < value < high)
+
+    def test_linearised(self):
+        report, mesg = resample.fit_uncertainty(self.tension, self.dilation, 'Bend Evans',
+                                                self.tensdim, size=200, exact=False)
+        self.assertEqual(mesg, None)
+        self.assertFalse(report['exact'])
+        self.assertEqual(report['failed'], 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+'''Regression tests of smoothing filters'''
+import unittest
+
+import numpy as np
+
+from calc import smooth
+
+class SavitzkyGolayBatchTest(unittest.TestCase):
+    '''savitzky_golay_batch is savitzky_golay applied to every profile'''
+
+    def setUp(self):
+        self.profiles = np.random.RandomState(0).standard_normal((5, 64)).cumsum(axis=-1)
+
+    def test_profiles(self):
+        for diff in (0, 1, 2):
+            batch = smooth.savitzky_golay_batch(self.profiles, 3, 11, diff)
+            for profile, smoothed in zip(self.profiles, batch):
+                np.testing.assert_allclose(smoothed,
+                        smooth.savitzky_golay(profile, 3, 11, diff), atol=1e-10)
+
+    def test_axis(self):
+        batch = smooth.savitzky_golay_batch(self.profiles.T, 2, 7, axis=0)
+        np.testing.assert_allclose(batch.T,
+                smooth.savitzky_golay_batch(self.profiles, 2, 7), atol=1e-12)
+
+    def test_list(self):
+        np.testing.assert_allclose(smooth.savitzky_golay_batch(self.profiles.tolist(), 2, 7),
+                                   smooth.savitzky_golay_batch(self.profiles, 2, 7))
+
+class RegisterFilterTest(unittest.TestCase):
+    '''filters of a single profile are applied along the axis of N-D arrays'''
+
+    def tearDown(self):
+        smooth.SMOOTHFILTERS.pop('test', None)
+
+    def test_single_profile_filter(self):
+        smooth.register_filter('test', smooth.savitzky_golay, batched=False)
+        profiles = np.random.RandomState(1).standard_normal((4, 50, 3))
+        np.testing.assert_allclose(smooth.smooth1d(profiles, 'test', 2, 9, 1, axis=1),
+                                   smooth.savitzky_golay_batch(profiles, 2, 9, 1, axis=1),
+                                   atol=1e-12)
+
+if __name__ == '__main__':
+    unittest.main()
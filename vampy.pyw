@@ -1,5 +1,7 @@
 #!/usr/bin/env python
 "Main file for VAMPy project"
+import multiprocessing
+
 import wx
 from wxgui import uimain, resources
 
@@ -13,5 +15,8 @@ class VamPyApp(wx.App):
         frame.Show()
         return True
 
-app = VamPyApp(False)
-app.MainLoop()
+if __name__ == '__main__':
+    # features are located on a pool of processes, which import this file
+    multiprocessing.freeze_support()
+    app = VamPyApp(False)
+    app.MainLoop()
@@ -12,7 +12,7 @@ from matplotlib.backends.backend_wxagg import FigureCanvasWxAgg as FigureCanvas
 from matplotlib.backends.backend_wxagg import NavigationToolbar2WxAgg as NavigationToolbar2
 from matplotlib.figure import Figure
 
-from calc import load, output, analysis
+from calc import load, output, analysis, cache, pipeline
 from calc.common import DATWILDCARD
 from calc.common import grid_size
 from dialogs import VampyOtherUserDataDialog
@@ -111,7 +111,10 @@ class GeometryFrame(wx.Frame):
     
     def OnFit(self, evt):
         pressures, pressacc, scale = self.userdata[:3]
-        tensionframe = TensionsFrame(self, -1, pressures, pressacc, scale, self.data)
+        fitpipeline = pipeline.AnalysisPipeline()
+        fitpipeline.start_at('averaged', self.data, cache.params_digest(self.data))
+        fitpipeline.set(pressures=pressures, pressacc=pressacc, scale=scale)
+        tensionframe = TensionsFrame(self, -1, fitpipeline)
         tensionframe.Show()
         evt.Skip()
     
@@ -1,6 +1,8 @@
 #!/usr/bin/env python
 '''Frame to display dilation vs tension plot and provide fitting facilities
 '''
+import threading
+
 import wx
 
 import numpy as np
@@ -12,15 +14,27 @@ from matplotlib.figure import Figure
 
 from calc.common import DATWILDCARD
 from calc import analysis, load, output
-from calc.fitting import TENSFITMODELS
+from calc.fitting import TENSFITMODELS, TENSLINEARFITS, range_fits
 
 from resources import PLOT, SAVETXT, OPENTXT
 import widgets
 
+FIT_DELAY = 150 # ms, fit is started when the slider rests that long
+
 class TensionsFrame(wx.Frame):
-    def __init__(self, parent, id, *inputdata):
+    def __init__(self, parent, id, pipeline=None):
         wx.Frame.__init__(self, parent, id, title = 'Dilation vs Tension')
         
+        ### fit reports of current data by (low, high, fit model name)
+        self.fits = {}
+        ### fit models of TENSFITMODELS are shared and ODRPACK is not reentrant,
+        ### so fits in the GUI and worker threads never run at the same time
+        self.fitlock = threading.Lock()
+        ### changes with data, results of fits of earlier data are discarded
+        self.fitgeneration = 0
+        self.fitthread = None
+        self.fittimer = None
+        
         self.panel = wx.Panel(self, -1)
 
         self.toolbar = widgets.SimpleToolbar(self, *self.ToolbarData())
@@ -33,9 +47,10 @@ class TensionsFrame(wx.Frame):
         self.MakeModelPanel()
         self.MakePlotOptPanel()
         
-        if inputdata:
-            self.inputdata = inputdata
-            self.data = self.TensionData(inputdata)
+        ### calc.pipeline.AnalysisPipeline with everything up to averaged geometry set
+        self.pipeline = pipeline
+        if pipeline is not None:
+            self.data = self.TensionData()
             self.tensmodelchoice.Enable()
         else:
             self.data={}
@@ -116,11 +131,14 @@ class TensionsFrame(wx.Frame):
     def ToolbarData(self):
         bmpsavetxt = wx.ArtProvider.GetBitmap(SAVETXT, wx.ART_TOOLBAR, (32,32))
         bmpopentxt = wx.ArtProvider.GetBitmap(OPENTXT, wx.ART_TOOLBAR, (32,32))
+        bmpplot = wx.ArtProvider.GetBitmap(PLOT, wx.ART_TOOLBAR, (32,32))
         return (
                 ((bmpopentxt, 'Open Data file', 'Open tensions data file', False),
                  self.OnOpen),
                 ((bmpsavetxt, 'Save Data File', 'Save tensions data file', False),
                  self.OnSave),
+                ((bmpplot, 'Fit Ranges', 'Map of fitted parameters over all fit ranges', False),
+                 self.OnRangeMap),
                 )
         
     def MakeModelPanel(self):
@@ -169,10 +187,10 @@ class TensionsFrame(wx.Frame):
         
         self.plotoptpanel.SetSizer(plotoptbox)
     
-    def TensionData(self, inputdata):
+    def TensionData(self):
         modelname = self.tensmodelchoice.GetStringSelection()
-        model = analysis.TENSMODELS[modelname]
-        tensiondata = model(*inputdata)
+        self.pipeline.set(tensmodel=modelname)
+        tensiondata, mesg = self.pipeline.get('tensions')
         return tensiondata
     
     def OnFitModel(self, evt):
@@ -182,7 +200,8 @@ class TensionsFrame(wx.Frame):
         evt.Skip()
         
     def OnChangeTensionModel(self, evt):
-        self.data = self.TensionData(self.inputdata)
+        self.data = self.TensionData()
+        self.ResetFits()
         self.Draw()
         evt.Skip()
     
@@ -197,6 +216,21 @@ class TensionsFrame(wx.Frame):
         self.highlabel.SetLabel('%i'%self.slider.GetHigh())
         self.Draw()
         evt.Skip()
+    
+    def SetFitRange(self, low, high):
+        self.slider.SetValue((low, high))
+        self.lowlabel.SetLabel('%i'%low)
+        self.highlabel.SetLabel('%i'%high)
+        self.Draw()
+    
+    def OnRangeMap(self, evt):
+        name = self.fitmodelchoice.GetStringSelection()
+        if name not in TENSLINEARFITS:
+            self.OnError('Model %s has no linear form to map fit ranges with'%name)
+            return
+        rangeframe = RangeMapFrame(self, -1, self.data, name)
+        rangeframe.Show()
+        evt.Skip()
         
     def OnSave(self, evt):
         savedlg = wx.FileDialog(self, 'Save data', self.GetParent().folder,
@@ -208,9 +242,10 @@ class TensionsFrame(wx.Frame):
         datname = savedlg.GetPath()
         savedlg.Destroy()
         header = 'Vesicle tensions, %s model\n'%self.tensmodelchoice.GetStringSelection()
-        for key in self.fittedparams:
+        fittedparams = self.FittedParams(self.CurrentFit())
+        for key in fittedparams:
             paramname, texparamname, paramdim, texparamdim = key
-            value, error = self.fittedparams[key]
+            value, error = fittedparams[key]
             header += '#%s = %f +- %f %s\n'%(paramname, value, error, paramdim)
         header +='#'
         writer = output.DataWriter(self.data, title=header)
@@ -233,6 +268,7 @@ class TensionsFrame(wx.Frame):
             self.OnError(msg)
             return
         else:
+            self.ResetFits()
             dim = self.data['tension'].shape[-1]
             self.slider.SetRange(1, dim)
             self.slider.SetValue((1,dim))
@@ -252,37 +288,182 @@ class TensionsFrame(wx.Frame):
         errDlg.Destroy()
     
     def Draw(self):
+        '''plot data in the current range, the fit is shown when ready'''
         low, high = self.slider.GetValue()
-        x, sx = self.data['tension'][:,low-1:high]
-        y, sy = self.data['dilation'][:,low-1:high]
+        x = self.data['tension'][0,low-1:high]
+        y = self.data['dilation'][0,low-1:high]
         
         self.dataplot.set_data(x, y)
-                
-        fitmodel = analysis.TensionFitModel((x,sx),(y,sy), self.fitmodel, self.data['tensdim'])
-        result = fitmodel.fit()
+        self.fitplot.set_data([], [])
+        self.axes.set_title('')
         
-        func = fitmodel.get_func()
-        self.fitplot.set_data(x, func(result['fit'], x))
-        self.fitplot.set_label(self.fitmodelchoice.GetStringSelection())
+        self.axes.relim()
+        if mplt.__version__ >= '0.99': #  to fight strange bug under Fedora8 linux matplotlib 0.98.3
+            self.axes.autoscale_view(tight=False)
+        else:
+            self.axes.set_xlim(x.min()-x.ptp()*0.05, x.max()+x.ptp()*0.05)
+            self.axes.set_ylim(y.min()-y.ptp()*0.05, y.max()+y.ptp()*0.05)
         
-        self.fittedparams = dict(zip(result['params'], zip(result['fit'], result['sd_fit'])))
+        self.RequestFit()
+        self.canvas.draw_idle()
+    
+    def ShowFit(self, result):
+        '''plot fit report of the current range'''
+        if result is None:
+            return
+        low, high = self.slider.GetValue()
+        x = self.data['tension'][0,low-1:high]
+        self.fitplot.set_data(x, self.fitmodel.fcn(result['fit'], x))
+        self.fitplot.set_label(self.fitmodelchoice.GetStringSelection())
         
+        fittedparams = self.FittedParams(result)
         title = ''
-        for key in self.fittedparams.keys():
+        for key in fittedparams.keys():
             paramname, texparamname, paramdim, texparamdim = key
-            value, error = self.fittedparams[key]
+            value, error = fittedparams[key]
             title+='%s = %.2f $\\pm$ %.2f %s'%(texparamname, value, error, texparamdim)
             title += '\t'
         
         self.axes.set_title(title)
         self.axes.legend(loc=4)
-        
-        self.axes.relim()
-        if mplt.__version__ >= '0.99': #  to fight strange bug under Fedora8 linux matplotlib 0.98.3
-            self.axes.autoscale_view(tight=False)
+        self.canvas.draw_idle()
+    
+    def FittedParams(self, result):
+        if result is None:
+            return {}
+        return dict(zip(result['params'], zip(result['fit'], result['sd_fit'])))
+    
+    def ResetFits(self):
+        '''forget fits of previous data, including those still running'''
+        self.fits = {}
+        self.fitgeneration += 1
+    
+    def FitKey(self):
+        low, high = self.slider.GetValue()
+        return low, high, self.fitmodelchoice.GetStringSelection()
+    
+    def Fit(self, data, key):
+        '''fit report for data in (low, high, fit model name), None if fit failed'''
+        low, high, name = key
+        fitmodel = analysis.TensionFitModel(data['tension'][:,low-1:high],
+                                            data['dilation'][:,low-1:high],
+                                            TENSFITMODELS[name], data['tensdim'])
+        try:
+            with self.fitlock:
+                return fitmodel.fit()
+        except Exception: # e.g. ODRPACK errors on degenerate data
+            return None
+    
+    def CurrentFit(self):
+        '''fit report of the current range, fitted right away if not done yet'''
+        key = self.FitKey()
+        if key not in self.fits:
+            self.fits[key] = self.Fit(self.data, key)
+        return self.fits[key]
+    
+    def RequestFit(self):
+        '''show fit of the current range, fitted in background if not done yet
+        
+        Fitting starts only after the slider rests for FIT_DELAY,
+        so that ranges passed while dragging are not fitted at all.
+        '''
+        key = self.FitKey()
+        if key in self.fits:
+            self.ShowFit(self.fits[key])
+        elif self.fittimer is None:
+            self.fittimer = wx.CallLater(FIT_DELAY, self.StartFit)
         else:
-            self.axes.set_xlim(x.min()-x.ptp()*0.05, x.max()+x.ptp()*0.05)
-            self.axes.set_ylim(y.min()-y.ptp()*0.05, y.max()+y.ptp()*0.05)
+            self.fittimer.Restart(FIT_DELAY)
+    
+    def StartFit(self):
+        if self.fitthread is not None and self.fitthread.isAlive():
+            return # OnFitDone starts the fit of the latest range
+        key = self.FitKey()
+        if key in self.fits:
+            self.ShowFit(self.fits[key])
+            return
+        self.fitthread = threading.Thread(target=self.FitWorker,
+                                          args=(self.data, key, self.fitgeneration))
+        self.fitthread.setDaemon(True)
+        self.fitthread.start()
+    
+    def FitWorker(self, data, key, generation):
+        '''runs in the worker thread, the result is passed to the GUI thread'''
+        result = self.Fit(data, key)
+        wx.CallAfter(self.OnFitDone, key, result, generation)
+    
+    def OnFitDone(self, key, result, generation):
+        if not self: # frame was closed while fitting
+            return
+        ### fits of earlier data are stale, the range may have been fitted
+        ### meanwhile by CurrentFit, its result is kept then
+        if generation == self.fitgeneration and key not in self.fits:
+            self.fits[key] = result
+        current = self.FitKey()
+        if current in self.fits:
+            if current == key:
+                self.ShowFit(self.fits[key])
+        elif not self.fittimer.IsRunning():
+            self.StartFit()
 
-        self.canvas.draw()
 
+
+class RangeMapFrame(wx.Frame):
+    '''Maps of fitted parameter and its relative error over all fit ranges
+    
+    Ranges are fitted by the linear form of the model (see fitting.range_fits),
+    click on the map sets the range of the parent TensionsFrame.
+    '''
+    def __init__(self, parent, id, data, modelname):
+        wx.Frame.__init__(self, parent, id, size=(900,450), title='Fit Ranges - %s'%modelname)
+        
+        self.statusbar = widgets.PlotStatusBar(self)
+        self.SetStatusBar(self.statusbar)
+        
+        panel = wx.Panel(self, -1)
+        pansizer = wx.BoxSizer(wx.VERTICAL)
+        self.figure = Figure(facecolor = widgets.rgba_wx2mplt(panel.GetBackgroundColour()))
+        self.canvas = FigureCanvas(panel, -1, self.figure)
+        self.canvas.mpl_connect('motion_notify_event', self.statusbar.SetPosition)
+        self.canvas.mpl_connect('button_press_event', self.OnClick)
+        pansizer.Add(self.canvas, 1, wx.GROW)
+        
+        self.navtoolbar = NavigationToolbar2(self.canvas)
+        self.navtoolbar.Realize()
+        pansizer.Add(self.navtoolbar, 0, wx.GROW)
+        panel.SetSizer(pansizer)
+        
+        fit, sd_fit = range_fits(data['tension'], data['dilation'], modelname)
+        ### rows are first points (low), columns are last points (high) of ranges,
+        ### both starting from 1 as on the slider
+        value = fit[0][:-1,1:]
+        relerror = np.fabs(sd_fit[0]/fit[0])[:-1,1:]
+        dim = value.shape[0]
+        extent = (0.5, dim+0.5, 0.5, dim+0.5)
+        paramname, texparamname, paramdim, texparamdim = TENSFITMODELS[modelname].meta['params'][0]
+        
+        finite = np.isfinite(value)
+        if finite.any():
+            ### extreme values of short ranges should not wash out the colours
+            vmin, vmax = np.percentile(value[finite], (5, 95))
+        else:
+            vmin, vmax = 0, 1
+        for index, (title, image, limits) in enumerate((
+                    (texparamname, value, (vmin, vmax)),
+                    ('relative error of %s'%texparamname, relerror, (0, 1)))):
+            axes = self.figure.add_subplot(1, 2, index+1, title=title)
+            masked = np.ma.masked_invalid(image)
+            plot = axes.imshow(masked, origin='lower', extent=extent, aspect='auto',
+                               interpolation='nearest', vmin=limits[0], vmax=limits[1])
+            self.figure.colorbar(plot, ax=axes)
+            axes.set_xlabel('last point')
+            axes.set_ylabel('first point')
+        
+        self.canvas.draw()
+        
+    def OnClick(self, evt):
+        if not evt.inaxes or self.navtoolbar.mode:
+            return
+        low, high = int(round(evt.ydata)), int(round(evt.xdata))
+        if high - low >= 2:
+            self.GetParent().SetFitRange(low, high)
@@ -1,12 +1,10 @@
 #!/usr/bin/env python
 '''Top frame of the VamPy application
 '''
-import glob, os
+import glob, multiprocessing, os
 
 import wx
 
-from numpy import empty
-
 import matplotlib as mplt
 mplt.use('WXAgg', warn=False)
 from matplotlib import cm
@@ -14,12 +12,12 @@ from matplotlib.backends.backend_wxagg import FigureCanvasWxAgg as FigureCanvas
 from matplotlib.backends.backend_wxagg import NavigationToolbar2WxAgg as NavigationToolbar2
 from matplotlib.figure import Figure
 
-from calc import analysis, features, load, smooth
+from calc import analysis, batch, cache, features, load, pipeline, smooth
 
 import tension, debug, geometry, widgets
 
 from resources import MICROSCOPE, SAVETXT, OPENFOLDER
-from calc.common import OWNPATH, SIDES, DATWILDCARD, CFG_FILENAME
+from calc.common import OWNPATH, SIDES, DATWILDCARD, CFG_FILENAME, STACKFORMATS
 from calc.common import split_to_int
 from dialogs import VampyOtherUserDataDialog
 
@@ -124,6 +122,12 @@ class VampyImageConfigPanel(wx.Panel):
         params.update(self.GetCrop())
         return params
     
+    def EnableGeometry(self, enable=True):
+        '''crops and orientation are fixed when only region of interest is read'''
+        for side in SIDES:
+            wx.FindWindowByName(side+'crop').Enable(enable)
+        wx.FindWindowByName('orient').Enable(enable)
+    
     def OnModeChoice(self, evt):
         modectrl = wx.FindWindowByName('mode')
         polarctrl = wx.FindWindowByName('polar')
@@ -394,6 +398,10 @@ class VampyFrame(wx.Frame):
         wx.Frame.__init__(self, parent, id, title=self.maintitle)
         
         self.folder = None
+        self.stackformat = False
+        self.pipeline = None  # analysis of opened images
+        self.roicheck = False  # read only region of interest of images
+        self.roi = None  # (crop, first row of band) of region of interest read
         
         self.menubar = widgets.SimpleMenuBar(self, self.MenuData())
         self.SetMenuBar(self.menubar)
@@ -448,6 +456,9 @@ class VampyFrame(wx.Frame):
     def MenuData(self):
         return [["&File", [
                 ("&Open Folder...\tCtrl+O", "Open folder with images", self.OnOpenFolder),
+                ("Region of &Interest Only", "Read only the band of images around "
+                 "the pipette axis saved in image info, when folder is opened",
+                 self.OnRoi, wx.ITEM_CHECK),
                 ("", "", ""),
                 ("&Exit", "Exit application", self.OnExit)]],
                 ["&Help", [
@@ -474,13 +485,15 @@ class VampyFrame(wx.Frame):
         
         os.chdir(self.folder)
         
-        extensions = ['png','tif']
+        extensions = ['png','tif'] + sorted(STACKFORMATS)
         extDlg = wx.SingleChoiceDialog(self, 'Choose image file type', 'File type', extensions)
         if extDlg.ShowModal() != wx.ID_OK:
             extDlg.Destroy()
             return
         fileext = extDlg.GetStringSelection()
         extDlg.Destroy()
+        self.stackformat = fileext in STACKFORMATS
+        fileext = STACKFORMATS.get(fileext, fileext)
         
         self.imgfilenames = glob.glob(self.folder+'/*.'+fileext)
         if len(self.imgfilenames) == 0:
@@ -489,12 +502,21 @@ class VampyFrame(wx.Frame):
             self.OnOpenFolder(evt)
         else:
             self.imgfilenames.sort()
+            if self.stackformat and len(self.imgfilenames) > 1:
+                names = map(os.path.basename, self.imgfilenames)
+                stackDlg = wx.SingleChoiceDialog(self, 'Choose image stack file', 'Stack file', names)
+                if stackDlg.ShowModal() != wx.ID_OK:
+                    stackDlg.Destroy()
+                    return
+                self.imgfilenames = [self.imgfilenames[stackDlg.GetSelection()]]
+                stackDlg.Destroy()
             self.OpenedImgs, imgcfg, msg = self.LoadImages()
             if msg:
                 self.OnError(msg)
                 self.OnOpenFolder(evt)
             else:
                 self.imgconfpanel.Initialize(imgcfg)
+                self.imgconfpanel.EnableGeometry(self.roi is None)
                 self.analysispanel.Initialize()
                 self.imgpanel.Imgs = self.OpenedImgs
                 self.imgpanel.Initialize()
@@ -506,37 +528,59 @@ class VampyFrame(wx.Frame):
                 self.SetTitle(title)
     
     def LoadImages(self):
-        self.OpenedImgs = empty(1)
         imgcfgfilename = os.path.join(self.folder, CFG_FILENAME)
         imgcfg = load.read_conf_file(imgcfgfilename)
-        test, mesg = load.read_grey_image(self.imgfilenames[0])
-        if mesg:
-            return None, imgcfg, mesg
-        try:
-            images = empty((len(self.imgfilenames), test.shape[0], test.shape[1]), test.dtype)
-        except MemoryError:
-            mesg = 'Memory Leak. Restart the application.'
-            self.OnError(mesg)
-            return
-        progressdlg = wx.ProgressDialog('Loading images','Loading images',len(self.imgfilenames),
-                                        style = wx.PD_AUTO_HIDE|wx.PD_CAN_ABORT|wx.PD_REMAINING_TIME)
-        keepLoading = True
-        for index, filename in enumerate(self.imgfilenames):
-            ### open the image file
-            keepLoading = progressdlg.Update(index+1)
-            if not keepLoading:
-                mesg = 'Progress cancelled! Not all images have been loaded.'
-                break
-            img, mesg = load.read_grey_image(filename)
-            if mesg:
-                return None, imgcfg, mesg
-            ### test that the image has the same shape as others
-            if img.shape != test.shape:
-                mesg = 'Error: Images have different dimensions!'
-                return None, imgcfg, mesg
-            images[index, :] = img
-        progressdlg.Destroy()
+        rawshape = None
+        if self.stackformat:
+            ### frame size and header size of raw streams are set in config file
+            rawshape, mesg = split_to_int(imgcfg.get('rawshape', ''))
+            rawheader = int(imgcfg.get('rawheader', 0))
+        region, imgcfg = self.ImageRegion(imgcfg, rawshape)
+        if self.stackformat:
+            images, mesg = load.read_stack_file(self.imgfilenames[0], rawshape, rawheader, region)
+            imagekey = cache.stage_key('images', cache.files_digest(self.imgfilenames),
+                                       {'rawshape':rawshape, 'rawheader':rawheader})
+        else:
+            progressdlg = wx.ProgressDialog('Loading images','Loading images',len(self.imgfilenames),
+                                            style = wx.PD_AUTO_HIDE|wx.PD_CAN_ABORT|wx.PD_REMAINING_TIME)
+            images, mesg = load.read_image_stack(self.imgfilenames, self.folder,
+                                                 progressdlg.Update, region)
+            progressdlg.Destroy()
+            imagekey = cache.files_digest(self.imgfilenames)
+        if region is not None:
+            imagekey = cache.stage_key('images', imagekey, {'region':region})
+        self.pipeline = pipeline.AnalysisPipeline(cache.ResultCache(self.folder))
+        self.pipeline.set(imagekey=imagekey, workers=multiprocessing.cpu_count())
         return images, imgcfg, mesg
+    
+    def ImageRegion(self, imgcfg, rawshape):
+        '''region of interest of images to read, and image settings for it
+        
+        With 'Region of Interest Only' checked and the pipette saved in image info,
+        only the band of images around the pipette axis is read (see load.roi_region).
+        The band is shown without crops and with the axis moved to it,
+        settings are moved back to whole images when saved.
+        returns region (None for whole images) and image settings
+        '''
+        self.roi = None
+        if not self.roicheck:
+            return None, imgcfg
+        params, mesg = batch.folder_params(imgcfg)
+        if not mesg:
+            shape, mesg = load.frame_shape(self.imgfilenames[0], rawshape)
+        if mesg:
+            self.statusbar.SetStatusText('Whole images are read: %s'%mesg, 0)
+            return None, imgcfg
+        region, rows = load.roi_region(shape, params)
+        self.roi = params['crop'], rows[0]
+        roicfg = dict(imgcfg)
+        for side in SIDES:
+            roicfg[side] = '0'
+        roicfg['axis'] = '%i\t%i'%tuple(load.roi_params(params, rows)['axis'])
+        return region, roicfg
+    
+    def OnRoi(self, evt):
+        self.roicheck = evt.IsChecked()
         
     def OnError(self, msg):
         """
@@ -579,16 +623,19 @@ class VampyFrame(wx.Frame):
             pressures, pressacc, scale, aver = self.GetExtraUserData(params['fromnames'], len(params['images']))
         except(TypeError): # catching type error
             return
-        out, extra_out = features.locate(params)
-        geometrydata, mesg = analysis.get_geometry(out)
+        ### only stages with changed parameters are recalculated
+        locateparams = dict(params)
+        images = locateparams.pop('images')
+        self.pipeline.set(images=images, locate=locateparams, aver=aver,
+                          pressures=pressures, pressacc=pressacc, scale=scale)
+        avergeom, mesg = self.pipeline.get('averaged')
         if mesg:
             self.OnError(mesg)
             return
-        avergeom = analysis.averageImages(aver, **geometrydata)
         geometryframe = geometry.GeometryFrame(self, -1, avergeom)
         geometryframe.Show()
         
-        tensionframe = tension.TensionsFrame(self, -1, pressures, pressacc, scale, avergeom)
+        tensionframe = tension.TensionsFrame(self, -1, self.pipeline.copy())
         tensionframe.Show()
         evt.Skip()
         
@@ -631,6 +678,11 @@ class VampyFrame(wx.Frame):
         stringparams = self.imgconfpanel.GetChoices()
         intparams.update(self.imgconfpanel.GetBools())
         intparams.update(self.imgpanel.GetSlidersPos())
+        if self.roi is not None:
+            ### settings of region of interest back to whole images
+            crop, top = self.roi
+            intparams.update(crop)
+            intparams['axis'] = tuple([y + top for y in intparams['axis']])
         lines = []
         for key in stringparams.keys():
             lines.append('%s\t%s\n'%(key, stringparams[key]))
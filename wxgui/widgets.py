@@ -33,7 +33,8 @@ class SimpleMenuBar(wx.MenuBar):
         """
         
         @param parent:
-        @param menudata: nested list [[top menu item, [(menu item title, hint, handler), ...]], ...]
+        @param menudata: nested list [[top menu item, [(menu item title, hint, handler), ...]], ...],
+                         menu item may have wx item kind (e.g. wx.ITEM_CHECK) after the handler
         """
         wx.MenuBar.__init__(self)
         for eachMenuData in menudata:
@@ -42,11 +43,15 @@ class SimpleMenuBar(wx.MenuBar):
 
     def CreateMenu(self, menuData, parent):
         menu = wx.Menu()
-        for eachLabel, eachStatus, eachHandler in menuData:
+        for eachItem in menuData:
+            eachLabel, eachStatus, eachHandler = eachItem[:3]
             if not eachLabel:
                 menu.AppendSeparator()
                 continue
-            menuItem = menu.Append(-1, eachLabel, eachStatus)
+            eachKind = wx.ITEM_NORMAL
+            if len(eachItem) > 3:
+                eachKind = eachItem[3]
+            menuItem = menu.Append(-1, eachLabel, eachStatus, eachKind)
             parent.Bind(wx.EVT_MENU, eachHandler, menuItem)
         return menu
 